@@ -28,10 +28,12 @@ mrad. Defocusing in horizontal is done by going to a smaller pitch angle, here
 
 Three distorted surfaces are of Gaussian, waviness and as measured shapes, see
 below. They were normalized such that the meridional slope error be 1 µrad rms.
-The surfaces are determined on a 2D mesh. Interpolation splines for the height
-and the normal vector are found at the time of mirror instantiation and used in
-two special methods: ``local_z_distorted`` and ``local_n_distorted``, see
-Section :ref:`distorted`. If the distorted shape is known analytically, as for
+The surfaces are determined on a 2D mesh and passed to the mirror as an
+instance of :class:`~xrt.backends.raycing.distortions.GriddedDistortion`. Its
+bicubic interpolation coefficients for the height and the normal vector are
+found at the time of mirror instantiation and used in two special methods:
+``local_z_distorted`` and ``local_n_distorted``, see Section
+:ref:`distorted`. If the distorted shape is known analytically, as for
 waviness, the two methods may directly invoke the corresponding functions
 without interpolation. The scattered circles in the figures are random samples
 where the height is calculated by interpolation (cf. the color (height) of the
@@ -84,12 +86,12 @@ __author__ = "Konstantin Klementiev", "Roman Chernikov"
 __date__ = "08 Mar 2016"
 import os, sys; sys.path.append(os.path.join('..', '..', '..'))  # analysis:ignore
 import numpy as np
-from scipy import ndimage
 import matplotlib.pyplot as plt
 
 import xrt.backends.raycing as raycing
 import xrt.backends.raycing.sources as rs
 import xrt.backends.raycing.oes as roe
+import xrt.backends.raycing.distortions as rdist
 import xrt.backends.raycing.screens as rsc
 import xrt.backends.raycing.run as rr
 import xrt.backends.raycing.waves as rw
@@ -200,12 +202,11 @@ else:
 
 class ToroidMirrorDistorted(roe.ToroidMirror):
     def __init__(self, *args, **kwargs):
-        roe.ToroidMirror.__init__(self, *args, **kwargs)
 ### here you specify the bump and its mesh ###
         if get_distorted_surface is None:
-            self.limPhysX = [-5, 5]
-            self.limPhysY = [-125, 125]
-            self.get_surface_limits()
+            kwargs['limPhysX'] = [-5, 5]
+            kwargs['limPhysY'] = [-125, 125]
+            roe.ToroidMirror.__init__(self, *args, **kwargs)
             return
         self.warpX, self.warpY, self.warpZ, self.distortedSurfaceName =\
             get_distorted_surface()
@@ -214,9 +215,8 @@ class ToroidMirrorDistorted(roe.ToroidMirror):
 #        print(self.warpY.min(), self.warpY.max())
 #        print(self.warpZ.min(), self.warpZ.max())
         self.warpNX, self.warpNY = len(self.warpX), len(self.warpY)
-        self.limPhysX = np.min(self.warpX), np.max(self.warpX)
-        self.limPhysY = np.min(self.warpY), np.max(self.warpY)
-        self.get_surface_limits()
+        kwargs['limPhysX'] = np.min(self.warpX), np.max(self.warpX)
+        kwargs['limPhysY'] = np.min(self.warpY), np.max(self.warpY)
         self.warpA, self.warpB = np.gradient(self.warpZ)
         dx = self.warpX[1] - self.warpX[0]
         dy = self.warpY[1] - self.warpY[0]
@@ -224,35 +224,11 @@ class ToroidMirrorDistorted(roe.ToroidMirror):
         self.warpB = np.arctan(self.warpB/dy)
 #        print(self.warpZ.shape)
 #end# here you specify the bump and its mesh ###
-        self.warpSplineZ = ndimage.spline_filter(self.warpZ)
-        self.warpSplineA = ndimage.spline_filter(self.warpA)
-        self.warpSplineB = ndimage.spline_filter(self.warpB)
-
-    def local_z_distorted(self, x, y):
-        if get_distorted_surface is None:
-            return 0
-        coords = np.array(
-            [(x-self.limPhysX[0]) /
-             (self.limPhysX[1]-self.limPhysX[0]) * (self.warpNX-1),
-             (y-self.limPhysY[0]) /
-             (self.limPhysY[1]-self.limPhysY[0]) * (self.warpNY-1)])
-# coords.shape = (2, self.nrays)
-        z = ndimage.map_coordinates(self.warpSplineZ, coords, prefilter=True)
-        return z
-
-    def local_n_distorted(self, x, y):
-        if get_distorted_surface is None:
-            return
-#        a = np.zeros_like(x)
-#        b = np.ones_like(x)
-        coords = np.array(
-            [(x-self.limPhysX[0]) /
-             (self.limPhysX[1]-self.limPhysX[0]) * (self.warpNX-1),
-             (y-self.limPhysY[0]) /
-             (self.limPhysY[1]-self.limPhysY[0]) * (self.warpNY-1)])
-        a = ndimage.map_coordinates(self.warpSplineA, coords, prefilter=True)
-        b = ndimage.map_coordinates(self.warpSplineB, coords, prefilter=True)
-        return b, -a
+# the bicubic interpolation coefficients of the height map are calculated
+# once; the distortion then serves local_z_distorted and local_n_distorted:
+        kwargs['distortion'] = rdist.GriddedDistortion(
+            x=self.warpX, y=self.warpY, z=self.warpZ)
+        roe.ToroidMirror.__init__(self, *args, **kwargs)
 
 
 def see_the_bump():
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+r"""
+Beam copies in a reflect, slit and screen chain
+-----------------------------------------------
+
+| Script: ``\tests\speed\10_beamCopies_speed.py``.
+
+This script passes a beam through a mirror, a slit and a screen, as in a
+typical beamline, and measures the time and the peak memory of the chain
+with :mod:`tracemalloc`. Every beam made by ``Beam(copyFrom=...)`` is an
+independent copy gathered into one contiguous buffer per dtype. The script
+checks that no field of the output beams shares memory with the input beam
+or with another output beam, and that the peak memory does not exceed the
+output beams plus one beam of temporary arrays.
+"""
+__author__ = "Konstantin Klementiev", "Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import tracemalloc
+import itertools
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.oes as roe
+import xrt.backends.raycing.apertures as ra
+import xrt.backends.raycing.screens as rsc
+
+nrays = 200000
+
+
+def beam_size(beam):
+    return sum(block.nbytes for block in beam._blocks if block is not None)
+
+
+def main():
+    raycing._VERBOSITY_ = 0
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(
+        beamLine, 'GeometricSource', (0, 0, 0), nrays=nrays,
+        dxprime=1e-4, dzprime=1e-4)
+    mirror = roe.OE(beamLine, 'M1', (0, 10000, 0), pitch=3e-3,
+                    limPhysX=(-10, 10), limPhysY=(-200, 200))
+    slit = ra.RectangularAperture(
+        beamLine, 'slit', (0, 15000, 90), ('left', 'right', 'bottom', 'top'),
+        [-0.5, 0.5, -0.5, 0.5])
+    screen = rsc.Screen(beamLine, 'FSM', (0, 20000, 120))
+    beam = source.shine()
+
+    tracemalloc.start()
+    startTime = time.time()
+    beamGlobal, beamLocal = mirror.reflect(beam)
+    beamSlit = slit.propagate(beamGlobal)
+    beamScreen = screen.expose(beamGlobal)
+    spent = time.time() - startTime
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    outBeams = [beamGlobal, beamLocal, beamSlit, beamScreen]
+    outSize = sum(beam_size(b) for b in outBeams)
+    print('chain of {0} rays: {1:.3f} s; peak memory {2:.1f} MB for {3:.1f} '
+          'MB of output beams'.format(nrays, spent, peak/2**20,
+                                      outSize/2**20))
+    for beam1, beam2 in itertools.combinations([beam] + outBeams, 2):
+        for name in set(beam1._fields) & set(beam2._fields):
+            assert not np.shares_memory(
+                getattr(beam1, name), getattr(beam2, name)), name
+    assert peak < outSize + beam_size(beam), (peak, outSize)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+r"""
+Cached flow passes
+------------------
+
+| Script: ``\tests\speed\11_flowCache_speed.py``.
+
+This script records the flow of a source, a mirror, a slit and a screen and
+propagates it with *cacheFlow* of :class:`~xrt.backends.raycing.BeamLine`
+switched on, as xrtQook does after each edit of an element. It repeats
+unchanged passes with and without *startFrom* and checks that no segment is
+re-run, then changes the slit and checks that only the slit and the screen
+(which takes the beam modified in place by the slit) are re-run. A segment is
+counted as re-run when its output beams are replaced in *beamsDict*.
+"""
+__author__ = "Konstantin Klementiev", "Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.oes as roe
+import xrt.backends.raycing.apertures as ra
+import xrt.backends.raycing.screens as rsc
+
+nrays = 100000
+repeats = 3
+
+
+def build_beamline():
+    beamLine = raycing.BeamLine()
+    rs.GeometricSource(
+        beamLine, 'GeometricSource', (0, 0, 0), nrays=nrays,
+        dxprime=1e-4, dzprime=1e-4)
+    beamLine.m1 = roe.OE(beamLine, 'M1', (0, 10000, 0), pitch=3e-3,
+                         limPhysX=(-10, 10), limPhysY=(-200, 200))
+    beamLine.slit = ra.RectangularAperture(
+        beamLine, 'slit', (0, 15000, 90), ('left', 'right', 'bottom', 'top'),
+        [-0.5, 0.5, -0.5, 0.5])
+    beamLine.fsm = rsc.Screen(beamLine, 'FSM', (0, 20000, 120))
+    return beamLine
+
+
+def run_process(beamLine):
+    beamSource = beamLine.sources[0].shine()
+    beamM1global, beamM1local = beamLine.m1.reflect(beamSource)
+    beamSlit = beamLine.slit.propagate(beamM1global)
+    beamFSM = beamLine.fsm.expose(beamM1global)
+    beamLine.prepare_flow()
+    return beamSlit, beamFSM
+
+
+def propagate(beamLine, startFrom=0):
+    """Returns the names of the elements whose segments were re-run."""
+    oldBeams = dict(beamLine.beamsDict)
+    startTime = time.time()
+    beamLine.propagate_flow(startFrom=startFrom)
+    spent = time.time() - startTime
+    rerun = [segment[0] for segment in beamLine.flow
+             if any(beamLine.beamsDict[name] is not oldBeams.get(name)
+                    for name in segment[3].values())]
+    print('startFrom={0}: {1:.3f} s, re-run {2}'.format(
+        startFrom, spent, rerun))
+    return rerun
+
+
+def main():
+    raycing._VERBOSITY_ = 0
+    beamLine = build_beamline()
+    beamLine.recordFlow = True
+    run_process(beamLine)
+    beamLine.cacheFlow = True
+    names = [segment[0] for segment in beamLine.flow]
+    assert propagate(beamLine) == names
+    iSlit = names.index('slit')
+
+    for repeat in range(repeats):
+        assert propagate(beamLine, startFrom=iSlit) == []
+    assert propagate(beamLine) == []
+
+    beamLine.slit.opening = [-0.4, 0.4, -0.2, 0.2]
+    assert propagate(beamLine, startFrom=iSlit) == ['slit', 'FSM']
+    for repeat in range(repeats):
+        assert propagate(beamLine, startFrom=iSlit) == []
+    assert propagate(beamLine) == []
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+r"""
+Gridded distortions of a DCM in threads
+---------------------------------------
+
+| Script: ``\tests\speed\12_distortionThreads_speed.py``.
+
+This script reflects the same beam off a DCM whose two crystals have
+different gridded distortions, *distortion* and *distortion2*, first in one
+thread and then in several threads that share the DCM, as the threads of
+:func:`~xrt.runner.run_ray_tracing` do. The distortion of the crystal being
+intersected is kept per thread, so the script checks that each threaded
+result is identical to the single-thread one. It also checks that the counts
+in *intersectionStats* of the DCM, added by all the threads, are the counts
+of one reflection times the number of reflections.
+"""
+__author__ = "Konstantin Klementiev", "Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import threading
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.oes as roe
+import xrt.backends.raycing.materials as rm
+from xrt.backends.raycing.distortions import GriddedDistortion
+
+nrays = 50000
+threads = 4
+repeats = 10
+E0 = 9000.
+xmax, ymax = 10., 60.
+
+
+def make_distortion(amplitude, yWaveLength):
+    x = np.linspace(-xmax, xmax, 41)
+    y = np.linspace(-ymax, ymax, 241)
+    z = amplitude * np.cos(2*np.pi/yWaveLength * y) * np.ones((len(x), 1))
+    return GriddedDistortion(x=x, y=y, z=z)
+
+
+def main():
+    raycing._VERBOSITY_ = 0
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(
+        beamLine, 'GeometricSource', (0, 0, 0), nrays=nrays,
+        dxprime=1e-4, dzprime=1e-4, distE='flat', energies=(E0-2, E0+2))
+    dcm = roe.DCM(
+        beamLine, 'DCM', (0, 10000, 0), material=rm.CrystalSi(),
+        limPhysX=(-xmax, xmax), limPhysY=(-ymax, ymax),
+        limPhysX2=(-xmax, xmax), limPhysY2=(-ymax, ymax),
+        distortion=make_distortion(2e-4, 20.),
+        distortion2=make_distortion(-5e-4, 7.))
+    dcm.bragg = dcm.material.get_Bragg_angle(E0)
+    beam = source.shine()
+
+    startTime = time.time()
+    dcm.reset_intersection_stats()
+    reference = dcm.double_reflect(beam)[0]
+    print('one thread: {0:.3f} s'.format(time.time() - startTime))
+    referenceStats = dict(dcm.intersectionStats)
+    dcm.reset_intersection_stats()
+
+    results = []
+    start = threading.Event()
+
+    def reflect():
+        start.wait()
+        for repeat in range(repeats):
+            results.append(dcm.double_reflect(beam)[0])
+
+    if hasattr(sys, 'setswitchinterval'):  # switch threads more often
+        sys.setswitchinterval(1e-5)
+    startTime = time.time()
+    workers = [threading.Thread(target=reflect) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join()
+    print('{0} threads x {1} repeats: {2:.3f} s'.format(
+        threads, repeats, time.time() - startTime))
+    assert len(results) == threads * repeats
+    for result in results:
+        for name in ('x', 'z', 'a', 'c', 'state'):
+            assert np.array_equal(
+                getattr(result, name), getattr(reference, name)), name
+    for key, value in referenceStats.items():
+        if key != 'maxIterations':
+            value *= threads * repeats
+        assert dcm.intersectionStats[key] == value, (key, value)
+
+
+if __name__ == '__main__':
+    main()
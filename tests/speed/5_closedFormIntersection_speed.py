@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+r"""
+Closed form intersections
+-------------------------
+
+| Script: ``\tests\speed\5_closedFormIntersection_speed.py``.
+
+This script reflects the same rays (the same *seed*) off several optical
+elements whose surfaces have analytic intersections with a ray, once with the
+numerical intersection search (the element's *solve_intersection* returning
+None) and once with the closed form solution of
+:meth:`~xrt.backends.raycing.oes.OE.solve_intersection`. It prints the time
+spent in *find_intersection* and checks that the footprints agree to a
+fraction of a nanometer and that no ray changes its state.
+"""
+__author__ = "Konstantin Klementiev", "Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.oes as roe
+import xrt.backends.raycing.materials as rm
+
+E0 = 9000.
+nrays = 200000
+seed = 2026
+si111 = rm.CrystalSi(hkl=(1, 1, 1))
+mBe = rm.Material('Be', rho=1.848, kind='lens')
+mirrorKW = dict(center=(0, 10000, 0), pitch=3e-3, limPhysX=(-10, 10),
+                limPhysY=(-200, 200))
+lensKW = dict(center=(0, 10000, 0), material=mBe, focus=200., zmax=0.5,
+              t=0.1)
+elements = [
+    (roe.OE, mirrorKW, 'reflect'),
+    (roe.BentFlatMirror, dict(mirrorKW, R=3e6), 'reflect'),
+    (roe.ToroidMirror, dict(mirrorKW, R=3e6, r=30.), 'reflect'),
+    (roe.DCM, dict(center=(0, 10000, 0), bragg=[E0], material=si111,
+                   material2=si111, cryst2perpTransl=10.), 'double_reflect'),
+    (roe.ParaboloidFlatLens, lensKW, 'double_refract'),
+    (roe.DoubleParaboloidLens, lensKW, 'double_refract')]
+
+
+def trace(oeClass, kwargs, method, closedForm):
+    np.random.seed(seed)
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(
+        beamLine, 'GeometricSource', (0, 0, 0), nrays=nrays, distE='flat',
+        energies=(E0-5, E0+5), dx=0.5, dz=0.3, dxprime=3e-4, dzprime=1e-4)
+    oe = oeClass(beamLine, oeClass.__name__, **kwargs)
+    if not closedForm:
+        oe.solve_intersection = lambda *args: None
+    spent = [0]
+    findIntersection = oe.find_intersection
+
+    def timed_find_intersection(*args, **kwargs):
+        startTime = time.time()
+        res = findIntersection(*args, **kwargs)
+        spent[0] += time.time() - startTime
+        return res
+    oe.find_intersection = timed_find_intersection
+    beams = getattr(oe, method)(source.shine())
+    return beams, spent[0]
+
+
+def main():
+    raycing._VERBOSITY_ = 0
+    for oeClass, kwargs, method in elements:
+        beamsN, timeN = trace(oeClass, kwargs, method, False)
+        beamsC, timeC = trace(oeClass, kwargs, method, True)
+        maxDiff, stateDiff = 0, 0
+        for beamN, beamC in zip(beamsN, beamsC):
+            stateDiff += (beamN.state != beamC.state).sum()
+            good = beamC.state == 1
+            for field in ('x', 'y', 'z', 'a', 'b', 'c'):
+                maxDiff = max(maxDiff, abs(getattr(beamN, field)[good] -
+                                           getattr(beamC, field)[good]).max())
+        print('{0}: numerical {1:.3f} s, closed form {2:.3f} s, '
+              'max difference {3:.1e}'.format(
+                  oeClass.__name__, timeN, timeC, maxDiff))
+        assert stateDiff == 0, oeClass.__name__
+        assert maxDiff < 1e-6, oeClass.__name__
+
+
+if __name__ == '__main__':
+    main()
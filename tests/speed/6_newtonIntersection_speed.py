@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+r"""
+Newton intersections
+--------------------
+
+| Script: ``\tests\speed\6_newtonIntersection_speed.py``.
+
+This script reflects the same rays (the same *seed*) off several optical
+elements, once with the default numerical intersection search
+(*intersectionSolver* = 'auto') and once with the bracket-protected Newton
+search (*intersectionSolver* = 'newton'). The closed form solutions are
+switched off to let all rays be searched numerically. It prints the time
+spent in *reflect*, the numbers of surface and normal evaluations per searched
+ray taken from *intersectionStats* and checks that the footprints agree to a
+fraction of a nanometer and that no ray changes its state.
+"""
+__author__ = "Konstantin Klementiev", "Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.oes as roe
+import xrt.backends.raycing.materials as rm
+
+E0 = 9000.
+nrays = 200000
+seed = 2026
+si111 = rm.CrystalSi(hkl=(1, 1, 1))
+mirrorKW = dict(center=(0, 10000, 0), pitch=3e-3, limPhysX=(-10, 10),
+                limPhysY=(-200, 200))
+elements = [
+    (roe.ToroidMirror, dict(mirrorKW, R=3e6, r=30.)),
+    (roe.EllipticalMirrorParam, dict(mirrorKW, p=10000., q=5000.)),
+    (roe.JohannToroid, dict(mirrorKW, pitch=0.22, material=si111, Rm=1000.,
+                            Rs=500.))]
+
+
+def trace(oeClass, kwargs, solver):
+    np.random.seed(seed)
+    beamLine = raycing.BeamLine()
+    source = rs.GeometricSource(
+        beamLine, 'GeometricSource', (0, 0, 0), nrays=nrays, distE='flat',
+        energies=(E0-5, E0+5), dx=0.5, dz=0.3, dxprime=3e-4, dzprime=1e-4)
+    oe = oeClass(beamLine, oeClass.__name__, intersectionSolver=solver,
+                 **kwargs)
+    oe.solve_intersection = lambda *args: None
+    beam = source.shine()
+    startTime = time.time()
+    beams = oe.reflect(beam)
+    return beams, time.time() - startTime, oe.intersectionStats
+
+
+def main():
+    raycing._VERBOSITY_ = 0
+    for oeClass, kwargs in elements:
+        beamsA, timeA, statsA = trace(oeClass, kwargs, 'auto')
+        beamsN, timeN, statsN = trace(oeClass, kwargs, 'newton')
+        maxDiff, stateDiff = 0, 0
+        for beamA, beamN in zip(beamsA, beamsN):
+            stateDiff += (beamA.state != beamN.state).sum()
+            good = beamN.state == 1
+            for field in ('x', 'y', 'z', 'a', 'b', 'c'):
+                maxDiff = max(maxDiff, abs(getattr(beamA, field)[good] -
+                                           getattr(beamN, field)[good]).max())
+        print('{0}: auto {1:.3f} s, {2:.1f} evaluations/ray; newton {3:.3f} '
+              's, {4:.1f} evaluations + {5:.1f} normals/ray; max difference '
+              '{6:.1e}'.format(
+                  oeClass.__name__, timeA,
+                  statsA['evaluations'] / float(statsA['rays']), timeN,
+                  statsN['evaluations'] / float(statsN['rays']),
+                  statsN['normals'] / float(statsN['rays']), maxDiff))
+        assert stateDiff == 0, oeClass.__name__
+        assert maxDiff < 1e-6, oeClass.__name__
+
+
+if __name__ == '__main__':
+    main()
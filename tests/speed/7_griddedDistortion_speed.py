@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+r"""
+Gridded distortions
+-------------------
+
+| Script: ``\tests\speed\7_griddedDistortion_speed.py``.
+
+This script evaluates a waviness figure error, given on a mesh, as done by
+the ray tracing of a distorted surface: the height at the same random points
+*nHeights* times (as during the intersection search) and the normal
+distortion once. This is done in two ways: as in the former version of the
+example ':ref:`warping`', with three spline-filtered maps (height and two
+slope angles) interpolated by :func:`scipy.ndimage.map_coordinates`, and with
+the bicubic coefficients of
+:class:`~xrt.backends.raycing.distortions.GriddedDistortion` calculated once.
+It prints the times and the deviations from the analytic waviness.
+"""
+__author__ = "Konstantin Klementiev", "Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import numpy as np
+from scipy import ndimage
+from xrt.backends.raycing.distortions import GriddedDistortion
+
+npoints = 1000000
+nHeights = 5
+seed = 2026
+xmax, ymax = 5., 125.
+nX, nY = 201, 2001
+amplitude = 1.61e-5
+xWaveLength, yWaveLength = 20., 50.
+
+
+def waviness(x, y):
+    kx, ky = 2*np.pi/xWaveLength, 2*np.pi/yWaveLength
+    z = amplitude * np.cos(kx*x) * np.cos(ky*y)
+    dzdx = -amplitude * kx * np.sin(kx*x) * np.cos(ky*y)
+    dzdy = -amplitude * ky * np.cos(kx*x) * np.sin(ky*y)
+    return z, np.arctan(dzdy), -np.arctan(dzdx)
+
+
+def with_ndimage(x, y, z, px, py):
+    a, b = np.gradient(z)
+    a = np.arctan(a / (x[1]-x[0]))
+    b = np.arctan(b / (y[1]-y[0]))
+    splineZ, splineA, splineB = [ndimage.spline_filter(arr)
+                                 for arr in (z, a, b)]
+    coords = np.array([(px-x[0]) / (x[-1]-x[0]) * (len(x)-1),
+                       (py-y[0]) / (y[-1]-y[0]) * (len(y)-1)])
+    for i in range(nHeights):
+        zi = ndimage.map_coordinates(splineZ, coords, prefilter=True)
+    ai = ndimage.map_coordinates(splineA, coords, prefilter=True)
+    bi = ndimage.map_coordinates(splineB, coords, prefilter=True)
+    return zi, bi, -ai
+
+
+def with_gridded(x, y, z, px, py):
+    distortion = GriddedDistortion(x=x, y=y, z=z)
+    for i in range(nHeights):
+        zi = distortion.local_z(px, py)
+    return (zi,) + distortion.local_n(px, py)
+
+
+def main():
+    x = np.linspace(-xmax, xmax, nX)
+    y = np.linspace(-ymax, ymax, nY)
+    z = waviness(x[:, np.newaxis], y)[0]
+    rng = np.random.default_rng(seed)
+    px = rng.uniform(-xmax, xmax, npoints)
+    py = rng.uniform(-ymax, ymax, npoints)
+    exact = waviness(px, py)
+    for what, func in (('ndimage splines', with_ndimage),
+                       ('GriddedDistortion', with_gridded)):
+        startTime = time.time()
+        res = func(x, y, z, px, py)
+        spent = time.time() - startTime
+        print('{0}: {1:.3f} s; max deviations: height {2:.1e} mm, d_pitch '
+              '{3:.1e} rad, d_roll {4:.1e} rad'.format(
+                  what, spent, *[abs(r - e).max()
+                                 for r, e in zip(res, exact)]))
+
+
+if __name__ == '__main__':
+    main()
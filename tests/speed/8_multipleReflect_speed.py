@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+r"""
+Multiple reflections
+--------------------
+
+| Script: ``\tests\speed\8_multipleReflect_speed.py``.
+
+This script traces the same rays (the same *seed*) in a long concave cylinder
+where they make from a few to tens of grazing reflections, as in the example
+':ref:`multiple`'. This is done in two ways: as in the former version of
+:meth:`~xrt.backends.raycing.oes.OE.multiple_reflect`, where every
+reflection is searched for with a mask over all the rays and the local beam
+grows by all the rays per reflection, and with the present version that
+traces a compact beam of the active rays only. It prints the times, the
+numbers of reflections and of the rays in the local beams and checks that
+the output beams are identical.
+"""
+__author__ = "Konstantin Klementiev", "Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.oes as roe
+
+E0 = 2000.
+nrays = 50000
+seed = 2026
+maxReflections = 1000
+Rm = 5000.
+L = 2000.
+
+
+class Cylinder(roe.OE):
+    def local_z(self, x, y):
+        return Rm - np.sqrt(Rm**2 - y**2)
+
+    def local_n(self, x, y):
+        b = -y / np.sqrt(Rm**2 - y**2)
+        norm = (b**2 + 1)**0.5
+        return [np.zeros_like(x), b/norm, 1./norm]
+
+
+def former_multiple_reflect(oe, beam):
+    gb = rs.Beam(copyFrom=beam)
+    lb = gb
+    good = beam.state > 0
+    raycing.global_to_virgin_local(oe.bl, beam, lb, oe.center, good)
+    for iRefl in range(maxReflections):
+        tmpX, tmpY, tmpZ =\
+            np.copy(lb.x[good]), np.copy(lb.y[good]), np.copy(lb.z[good])
+        oe._reflect_local(good, lb, gb, oe.pitch, oe.roll+oe.positionRoll,
+                          oe.yaw, oe.dx, material=oe.material,
+                          isMulti=iRefl > 0)
+        if iRefl == 0:
+            lb.nRefl = np.zeros_like(lb.state)
+        ov = lb.state[good] == 3
+        lb.x[np.where(good)[0][ov]] = tmpX[ov]
+        lb.y[np.where(good)[0][ov]] = tmpY[ov]
+        lb.z[np.where(good)[0][ov]] = tmpZ[ov]
+        good = (lb.state == 1) | (lb.state == 2)
+        lb.nRefl[good] += 1
+        if iRefl == 0:
+            lbN = rs.Beam(copyFrom=lb, withNumberOfReflections=True)
+        else:
+            lbN.concatenate(lb)
+        if good.sum() == 0:
+            break
+    goodAfter = gb.nRefl > 0
+    gb.state[goodAfter] = 1
+    raycing.virgin_local_to_global(oe.bl, gb, oe.center, goodAfter)
+    rs.copy_beam(gb, beam, ~goodAfter)
+    return gb, lbN
+
+
+def trace(former):
+    np.random.seed(seed)
+    beamLine = raycing.BeamLine(height=0)
+    source = rs.GeometricSource(
+        beamLine, 'GeometricSource', (0, 0, 0), nrays=nrays, dx=0., dz=0.,
+        dxprime=5e-4, dzprime=1e-3, distE='lines', energies=(E0,))
+    oe = Cylinder(beamLine, 'Cylinder', (0, 1000, -0.05), pitch=3e-3,
+                  limPhysX=(-5, 5), limPhysY=(0, L))
+    beam = source.shine()
+    startTime = time.time()
+    if former:
+        beams = former_multiple_reflect(oe, beam)
+    else:
+        beams = oe.multiple_reflect(beam, maxReflections=maxReflections)
+    return beams, time.time() - startTime
+
+
+def main():
+    raycing._VERBOSITY_ = 0
+    for what, former in (('former', True), ('active rays', False)):
+        (gb, lbN), spent = trace(former)
+        print('{0}: {1:.3f} s; {2} reflections, max {3}; {4} rays in the '
+              'local beam'.format(what, spent, gb.nRefl.sum(),
+                                  gb.nRefl.max(), len(lbN.x)))
+        if former:
+            gbFormer, lbNFormer = gb, lbN
+    for field in ('x', 'y', 'z', 'a', 'b', 'c', 'path', 'state', 'nRefl'):
+        assert (getattr(gb, field) == getattr(gbFormer, field)).all(), field
+    assert (np.sort(lbN.y[lbN.state == 1]) ==
+            np.sort(lbNFormer.y[lbNFormer.state == 1])).all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+r"""
+Chunked iterations in threads
+-----------------------------
+
+| Script: ``\tests\speed\9_chunkedThreads_speed.py``.
+
+This script runs the same ray tracing in several threads without and with
+*raysPerChunk* of :func:`~xrt.runner.run_ray_tracing`. The threads share the
+beamline and its sources, whereas each thread splits the rays of its
+iteration into chunks of its own sizes. The script prints the times and
+checks that all the rays of all the repeats are counted and that the
+intensities agree within the statistical error.
+"""
+__author__ = "Konstantin Klementiev", "Roman Chernikov"
+__date__ = "18 Oct 2026"
+
+import os, sys; sys.path.append(os.path.join('..', '..'))  # analysis:ignore
+import time
+import numpy as np
+import xrt.backends.raycing as raycing
+import xrt.backends.raycing.sources as rs
+import xrt.backends.raycing.screens as rsc
+import xrt.backends.raycing.run as rr
+import xrt.plotter as xrtp
+import xrt.runner as xrtr
+
+nrays = 20000
+repeats = 6
+threads = 3
+raysPerChunk = 7000
+
+
+def build_beamline():
+    beamLine = raycing.BeamLine(height=0)
+    for x in (-1, 1):
+        rs.GeometricSource(
+            beamLine, 'GeometricSource', (x, 0, 0), nrays=nrays,
+            dxprime=1e-4, dzprime=1e-4, distE='flat', energies=(9000, 9100))
+    beamLine.fsm = rsc.Screen(beamLine, 'FSM', (0, 10000, 0))
+    return beamLine
+
+
+def run_process(beamLine):
+    outDict = {}
+    for isource, source in enumerate(beamLine.sources):
+        beam = source.shine()
+        outDict['fsm{0}'.format(isource)] = beamLine.fsm.expose(beam)
+    return outDict
+
+
+def main():
+    raycing._VERBOSITY_ = 0
+    rr.run_process = run_process
+    beamLine = build_beamline()
+    intensities = []
+    for chunk in (None, raysPerChunk):
+        plots = [xrtp.XYCPlot(
+            'fsm{0}'.format(isource), (1,),
+            xaxis=xrtp.XYCAxis('x', 'mm', limits=[-3, 3]),
+            yaxis=xrtp.XYCAxis('z', 'mm', limits=[-1, 1]),
+            caxis=xrtp.XYCAxis('energy', 'eV', limits=[8990, 9110]))
+            for isource in range(len(beamLine.sources))]
+        startTime = time.time()
+        xrtr.run_ray_tracing(plots, repeats=repeats, threads=threads,
+                             beamLine=beamLine, raysPerChunk=chunk)
+        print('raysPerChunk={0}: {1:.3f} s'.format(
+            chunk, time.time() - startTime))
+        for plot in plots:
+            assert plot.nRaysAll == nrays * repeats, plot.nRaysAll
+        intensities.append(sum(plot.intensity for plot in plots))
+    for source in beamLine.sources:
+        assert source.nrays == nrays
+    assert abs(intensities[1]/intensities[0] - 1) < 5 / (
+        2 * nrays * repeats)**0.5, intensities
+
+
+if __name__ == '__main__':
+    main()
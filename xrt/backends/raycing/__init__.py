@@ -129,12 +129,15 @@ See the supplied examples."""
 from __future__ import print_function
 import types
 import sys
+import threading
 import numpy as np
 from itertools import compress
 from collections import OrderedDict
 import re
 import copy
 import inspect
+import hashlib
+import time
 
 __module__ = "raycing"
 __author__ = "Konstantin Klementiev, Roman Chernikov"
@@ -153,10 +156,12 @@ else:
     # 'unicode' exists, must be Python 2
     unicode = unicode
     basestring = basestring
+_getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
 
 from .physconsts import SIE0  # analysis:ignore
 
 stateGood, stateOut, stateOver = 1, 2, 3
+stateDropped = -1000000  # rays removed from a beam by BeamLine.compact_rays
 
 zEps = 1e-12  # mm: target accuracy in z while searching for intersection
 misalignmentTolerated = 0.1  # for automatic checking of oe center position
@@ -191,6 +196,94 @@ allBeamFields = ('energy', 'x', 'xprime', 'y', 'z', 'zprime', 'xzprime',
                  'Ep_amp', 'Ep_phase', 'Es_amp', 'Es_phase')
 
 
+class LegacyRandom(object):
+    """
+    Draws from the global random state of :mod:`numpy.random` with the names
+    and signatures of the methods of :class:`numpy.random.Generator` used in
+    raycing. It is the random generator of a thread that has no own one (see
+    :func:`get_rng`), e.g. when a beamline is traced outside of
+    :func:`~xrt.runner.run_ray_tracing` or with numpy < 1.17.
+    """
+    def random(self, size=None):
+        return np.random.random_sample(size)
+
+    def integers(self, low, high=None, size=None, endpoint=False):
+        if high is None:
+            low, high = 0, low
+        if endpoint:
+            high += 1
+        return np.random.randint(low, high, size)
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        return np.random.normal(loc, scale, size)
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return np.random.uniform(low, high, size)
+
+    def standard_normal(self, size=None):
+        return np.random.standard_normal(size)
+
+    def exponential(self, scale=1.0, size=None):
+        return np.random.exponential(scale, size)
+
+
+_legacyRandom = LegacyRandom()
+_threadLocal = threading.local()
+
+
+def get_rng():
+    """Returns the random generator of the current thread: an instance of
+    :class:`numpy.random.Generator` set by :func:`set_rng` or, if not set,
+    :class:`LegacyRandom`. All random numbers in raycing are drawn from it,
+    therefore the threads of a run do not share the random state."""
+    return getattr(_threadLocal, 'rng', _legacyRandom)
+
+
+def set_rng(rng=None):
+    """Sets the random generator of the current thread, see :func:`get_rng`.
+    If *rng* is None, the thread returns to the global state of
+    :mod:`numpy.random`."""
+    if rng is None:
+        _threadLocal.__dict__.pop('rng', None)
+    else:
+        _threadLocal.rng = rng
+
+
+class SourceNrays(object):
+    """
+    The *nrays* attribute of the sources. It returns the number of rays set
+    for the source in the current thread by :func:`set_chunk_nrays`, if any,
+    otherwise the value assigned to the source. A chunked run (see
+    *raysPerChunk* of :func:`~xrt.runner.run_ray_tracing`) thus splits the
+    rays of a source shared by several threads without changing the source.
+    """
+
+    def __get__(self, source, owner=None):
+        if source is None:
+            return self
+        chunkNrays = getattr(_threadLocal, 'chunkNrays', None)
+        if chunkNrays and id(source) in chunkNrays:
+            return chunkNrays[id(source)]
+        try:
+            return source.__dict__['nrays']
+        except KeyError:
+            raise AttributeError('nrays')
+
+    def __set__(self, source, value):
+        source.__dict__['nrays'] = value
+
+
+def set_chunk_nrays(chunkNrays=None):
+    """Sets the numbers of rays of the sources in the current thread as a
+    list of (source, nrays) pairs, see :class:`SourceNrays`. If *chunkNrays*
+    is None, the sources return to their own *nrays*."""
+    if chunkNrays is None:
+        _threadLocal.__dict__.pop('chunkNrays', None)
+    else:
+        _threadLocal.chunkNrays = dict(
+            (id(source), nrays) for source, nrays in chunkNrays)
+
+
 def is_sequence(arg):
     """Checks whether *arg* is a sequence."""
     result = (not hasattr(arg, "strip") and hasattr(arg, "__getitem__") or
@@ -235,41 +328,84 @@ def rotate_z(x, y, cosangle, sinangle):
     return cosangle*x - sinangle*y, sinangle*x + cosangle*y
 
 
+_rotationMatrices = {}
+maxCachedRotations = 1024
+
+
+def rotation_matrix(rotationSequence='RzRyRx', pitch=0, roll=0, yaw=0):
+    """Returns the 3x3 matrix of the rotations by the angles *yaw, roll,
+    pitch* in the sequence given by *rotationSequence* (see
+    :func:`rotate_point`). The matrices are cached, so that an element whose
+    orientation has not changed reuses its matrix."""
+    key = rotationSequence, float(pitch), float(roll), float(yaw)
+    try:
+        return _rotationMatrices[key]
+    except KeyError:
+        pass
+    matrix = np.array([rotate_point(unit, rotationSequence, pitch, roll, yaw)
+                       for unit in np.eye(3)], dtype=np.float64).T
+    if len(_rotationMatrices) >= maxCachedRotations:
+        _rotationMatrices.clear()
+    _rotationMatrices[key] = matrix
+    return matrix
+
+
+def _field_rows(beam, names):
+    rows = beam._rows_view(names) if hasattr(beam, '_rows_view') else None
+    return [getattr(beam, name) for name in names] if rows is None else rows
+
+
+def transform_fields(beamTo, beamFrom, names, matrix=None, indarr=None,
+                     before=None, after=None):
+    """Sets the fields *names* of *beamTo* for the rays *indarr* to
+    *matrix* . (fields of *beamFrom* - *before*) + *after* in one pass over
+    the rays. *names* are consecutive triplets of vector components, e.g.
+    ('x', 'y', 'z', 'a', 'b', 'c'); the 3x3 *matrix* applies to each
+    triplet. *before* and *after* are sequences of len(*names*) or None.
+    The fields that are consecutive rows of a buffer block of the beam are
+    read and written as one 2D array."""
+    src = _field_rows(beamFrom, names)
+    dst = src if beamTo is beamFrom else _field_rows(beamTo, names)
+    if indarr is None:
+        vec = np.asarray(src)
+    elif isinstance(src, np.ndarray):
+        vec = src[:, indarr]
+    else:
+        vec = np.array([field[indarr] for field in src])
+    dtype = vec.dtype
+    if before is not None:
+        vec = vec - np.asarray(before, dtype=dtype)[:, None]
+    if matrix is not None:
+        vec = np.matmul(matrix.astype(dtype, copy=False),
+                        vec.reshape(len(names)//3, 3, -1)).reshape(
+                            len(names), -1)
+    if after is not None:
+        vec = vec + np.asarray(after, dtype=dtype)[:, None]
+    if indarr is None:
+        indarr = slice(None)
+    if isinstance(dst, np.ndarray):
+        dst[:, indarr] = vec
+    else:
+        for field, row in zip(dst, vec):
+            field[indarr] = row
+
+
 def rotate_beam(beam, indarr=None, rotationSequence='RzRyRx',
                 pitch=0, roll=0, yaw=0, skip_xyz=False, skip_abc=False,
                 is2ndXtal=False):
     """Rotates the *beam* indexed by *indarr* by the angles *yaw, roll, pitch*
     in the sequence given by *rotationSequence*. A leading '-' symbol of
-    *rotationSequence* reverses the sequences.
+    *rotationSequence* reverses the sequences. The rotations are applied as
+    one matrix to the positions and the directions together.
     """
-    angles = {'z': yaw, 'y': roll, 'x': pitch}
-    rotates = {'z': rotate_z, 'y': rotate_y, 'x': rotate_x}
-    if not skip_xyz:
-        coords1 = {'z': beam.x, 'y': beam.x, 'x': beam.y}
-        coords2 = {'z': beam.y, 'y': beam.z, 'x': beam.z}
+    if pitch == 0 and roll == 0 and yaw == 0:
+        return
+    names = () if skip_xyz else ('x', 'y', 'z')
     if not skip_abc:
-        vcomps1 = {'z': beam.a, 'y': beam.a, 'x': beam.b}
-        vcomps2 = {'z': beam.b, 'y': beam.c, 'x': beam.c}
-
-    if rotationSequence[0] == '-':
-        seq = rotationSequence[6] + rotationSequence[4] + rotationSequence[2]
-    else:
-        seq = rotationSequence[1] + rotationSequence[3] + rotationSequence[5]
-    for s in seq:
-        angle, rotate = angles[s], rotates[s]
-        if not skip_xyz:
-            c1, c2 = coords1[s], coords2[s]
-        if not skip_abc:
-            v1, v2 = vcomps1[s], vcomps2[s]
-        if angle != 0:
-            cA = np.cos(angle)
-            sA = np.sin(angle)
-            if indarr is None:
-                indarr = slice(None)
-            if not skip_xyz:
-                c1[indarr], c2[indarr] = rotate(c1[indarr], c2[indarr], cA, sA)
-            if not skip_abc:
-                v1[indarr], v2[indarr] = rotate(v1[indarr], v2[indarr], cA, sA)
+        names += ('a', 'b', 'c')
+    if names:
+        transform_fields(beam, beam, names, rotation_matrix(
+            rotationSequence, pitch, roll, yaw), indarr)
 
 
 def rotate_xyz(x, y, z, indarr=None, rotationSequence='RzRyRx',
@@ -278,24 +414,14 @@ def rotate_xyz(x, y, z, indarr=None, rotationSequence='RzRyRx',
     *yaw, roll, pitch* in the sequence given by *rotationSequence*. A leading
     '-' symbol of *rotationSequence* reverses the sequences.
     """
-    angles = {'z': yaw, 'y': roll, 'x': pitch}
-    rotates = {'z': rotate_z, 'y': rotate_y, 'x': rotate_x}
-    coords1 = {'z': x, 'y': x, 'x': y}
-    coords2 = {'z': y, 'y': z, 'x': z}
-
-    if rotationSequence[0] == '-':
-        seq = rotationSequence[6] + rotationSequence[4] + rotationSequence[2]
-    else:
-        seq = rotationSequence[1] + rotationSequence[3] + rotationSequence[5]
-    for s in seq:
-        angle, rotate = angles[s], rotates[s]
-        c1, c2 = coords1[s], coords2[s]
-        if angle != 0:
-            cA = np.cos(angle)
-            sA = np.sin(angle)
-            if indarr is None:
-                indarr = slice(None)
-            c1[indarr], c2[indarr] = rotate(c1[indarr], c2[indarr], cA, sA)
+    if pitch == 0 and roll == 0 and yaw == 0:
+        return x, y, z
+    matrix = rotation_matrix(rotationSequence, pitch, roll, yaw)
+    if indarr is None:
+        indarr = slice(None)
+    vec = np.array([x[indarr], y[indarr], z[indarr]])
+    x[indarr], y[indarr], z[indarr] = np.dot(
+        matrix.astype(vec.dtype, copy=False), vec)
     return x, y, z
 
 
@@ -323,27 +449,25 @@ def rotate_point(point, rotationSequence='RzRyRx', pitch=0, roll=0, yaw=0):
     return newp
 
 
+def _azimuth_matrix(bl, sign=1):
+    a0, b0 = bl.sinAzimuth, bl.cosAzimuth
+    if a0 == 0:
+        return
+    return np.array([[b0, -sign*a0, 0], [sign*a0, b0, 0], [0, 0, 1]],
+                    dtype=np.float64)
+
+
 def global_to_virgin_local(bl, beam, lo, center=None, part=None):
     """Transforms *beam* from the global to the virgin (i.e. with pitch, roll
     and yaw all zeros) local system. The resulting local beam is *lo*. If
     *center* is provided, the rotation Rz is about it, otherwise is about the
     origin of *beam*. The beam arrays can be sliced by *part* indexing array.
     *bl* is an instance of :class:`BeamLine`"""
-    if part is None:
-        part = np.ones(beam.x.shape, dtype=np.bool)
-    a0, b0 = bl.sinAzimuth, bl.cosAzimuth
     if center is None:
         center = [0, 0, 0]
-    lo.x[part] = beam.x[part] - center[0]
-    lo.y[part] = beam.y[part] - center[1]
-    lo.z[part] = beam.z[part] - center[2]
-    if a0 == 0:
-        lo.a[part] = beam.a[part]
-        lo.b[part] = beam.b[part]
-    else:
-        lo.x[part], lo.y[part] = rotate_z(lo.x[part], lo.y[part], b0, a0)
-        lo.a[part], lo.b[part] = rotate_z(beam.a[part], beam.b[part], b0, a0)
-    lo.c[part] = beam.c[part]  # unchanged
+    transform_fields(lo, beam, ('x', 'y', 'z', 'a', 'b', 'c'),
+                     _azimuth_matrix(bl), part,
+                     before=list(center[:3]) + [0, 0, 0])
 
 
 def virgin_local_to_global(bl, vlb, center=None, part=None,
@@ -353,20 +477,18 @@ def virgin_local_to_global(bl, vlb, center=None, part=None,
     *center* is provided, the rotation Rz is about it, otherwise is about the
     origin of *beam*. The beam arrays can be sliced by *part* indexing array.
     *bl* is an instance of :class:`BeamLine`"""
-    if part is None:
-        part = np.ones(vlb.x.shape, dtype=np.bool)
-    a0, b0 = bl.sinAzimuth, bl.cosAzimuth
-    if a0 != 0:
-        if not skip_abc:
-            vlb.a[part], vlb.b[part] = rotate_z(
-                vlb.a[part], vlb.b[part], b0, -a0)
-        if not skip_xyz:
-            vlb.x[part], vlb.y[part] = rotate_z(
-                vlb.x[part], vlb.y[part], b0, -a0)
-    if (center is not None) and (not skip_xyz):
-        vlb.x[part] += center[0]
-        vlb.y[part] += center[1]
-        vlb.z[part] += center[2]
+    matrix = _azimuth_matrix(bl, -1)
+    names, after = (), None
+    if not skip_xyz:
+        names = ('x', 'y', 'z')
+        if center is not None:
+            after = list(center[:3])
+    if not skip_abc and matrix is not None:
+        names += ('a', 'b', 'c')
+        if after is not None:
+            after += [0, 0, 0]
+    if names and not (matrix is None and after is None):
+        transform_fields(vlb, vlb, names, matrix, part, after=after)
 
 
 def check_alarm(self, incoming, beam):
@@ -549,6 +671,30 @@ def get_incidence_angle(beam):
 get_theta = get_incidence_angle
 
 
+def match_rays(beam, otherBeam, values, fill):
+    """Returns *values*, an array over the rays of *otherBeam*, for the rays
+    of *beam*. The two beams may differ in length if lost rays were removed
+    from them (see *compactRays* of :class:`BeamLine`); the rays are then
+    matched by *rayId* and the rays of *beam* absent in *otherBeam* get
+    *fill*."""
+    if otherBeam is beam or not (
+            hasattr(beam, 'rayId') or hasattr(otherBeam, 'rayId')):
+        return values
+    rayId = beam.rayId if hasattr(beam, 'rayId') else np.arange(len(beam.x))
+    otherId = otherBeam.rayId if hasattr(otherBeam, 'rayId') else \
+        np.arange(len(otherBeam.x))
+    if len(rayId) == len(otherId) and (rayId == otherId).all():
+        return values
+    lookup = np.full(max(np.max(rayId, initial=-1),
+                         np.max(otherId, initial=-1)) + 1, -1)
+    lookup[otherId] = np.arange(len(otherId))
+    ind = lookup[rayId]
+    found = ind >= 0
+    res = np.full(len(rayId), fill, dtype=values.dtype)
+    res[found] = values[ind[found]]
+    return res
+
+
 def get_output(plot, beamsReturnedBy_run_process):
     """Used by :mod:`multipro` for creating images of *plot* - instance of
     :class:`XYCPlot`. *beamsReturnedBy_run_process* is a dictionary of
@@ -562,11 +708,13 @@ def get_output(plot, beamsReturnedBy_run_process):
     if plot.beamState is None:
         beamState = beam.state
     else:
-        beamState = beamsReturnedBy_run_process[plot.beamState].state
-    nrays = len(beam.x)
+        beamS = beamsReturnedBy_run_process[plot.beamState]
+        beamState = match_rays(beam, beamS, beamS.state, stateDropped)
+    droppedStates = getattr(beam, 'droppedStates', {})
+    nrays = len(beam.x) + sum(droppedStates.values())
 
     locAlive = (beamState > 0).sum()
-    part = np.zeros(nrays, dtype=np.bool)
+    part = np.zeros(len(beam.x), dtype=np.bool)
     locGood = 0
     locOut = 0
     locOver = 0
@@ -580,7 +728,7 @@ def get_output(plot, beamsReturnedBy_run_process):
         if rayFlag == 3:
             locOver = locPart.sum()
         if rayFlag < 0:
-            locDead += locPart.sum()
+            locDead += locPart.sum() + droppedStates.get(rayFlag, 0)
         part = part | locPart
     if hasattr(beam, 'accepted'):
         locAccepted = beam.accepted
@@ -622,7 +770,8 @@ def get_output(plot, beamsReturnedBy_run_process):
         else:
             beamC = beamsReturnedBy_run_process[plot.beamC]
         if isinstance(plot.caxis.data, types.FunctionType):
-            cData = plot.caxis.data(beamC) * plot.caxis.factor
+            cData = match_rays(beam, beamC, plot.caxis.data(beamC), 0) *\
+                plot.caxis.factor
         elif isinstance(plot.caxis.data, np.ndarray):
             cData = plot.caxis.data * plot.caxis.factor
         else:
@@ -681,27 +830,45 @@ def auto_units_angle(angle):
         return angle
 
 
+def flow_outputs(*beamNames):
+    """Decorator of the propagation methods (*shine*, *reflect*,
+    *propagate*, *expose* etc.) that registers the names of the beams
+    returned by the method and the names of its arguments, so that
+    :func:`append_to_flow` records the flow without inspecting the method at
+    every call. The method itself is not wrapped."""
+    def decorator(meth):
+        meth.flowOutputs = beamNames
+        meth.flowArgs = tuple(_getargspec(meth)[0][1:])
+        return meth
+    return decorator
+
+
 def append_to_flow(meth, bOut, frame):
     oe = meth.__self__
     if oe.bl is None:
         return
-    if oe.bl.flowSource != 'legacy':
+    if not oe.bl.recordFlow or oe.bl.flowSource != 'legacy':
         return
-    argValues = inspect.getargvalues(frame)
-    fdoc = re.findall(r"Returned values:.*", meth.__doc__)
-    if fdoc:
-        fdoc = fdoc[0].replace("Returned values: ", '').split(',')
-        if 'needNewGlobal' in argValues.args[1:]:
-            if argValues.locals['needNewGlobal']:
-                fdoc.insert(0, 'beamGlobal')
+    argLocals = frame.f_locals
+    if hasattr(meth, 'flowOutputs'):
+        argNames = meth.flowArgs
+        fdoc = list(meth.flowOutputs)
+    else:  # not registered by flow_outputs, e.g. a method of a user class
+        argNames = inspect.getargvalues(frame).args[1:]
+        fdoc = re.findall(r"Returned values:.*", meth.__doc__)
+        if fdoc:
+            fdoc = fdoc[0].replace("Returned values: ", '').split(',')
+    if fdoc and 'needNewGlobal' in argNames:
+        if argLocals['needNewGlobal']:
+            fdoc.insert(0, 'beamGlobal')
 
     kwArgsIn = OrderedDict()
     kwArgsOut = OrderedDict()
-    for arg in argValues.args[1:]:
+    for arg in argNames:
         if str(arg) == 'beam':
-            kwArgsIn[arg] = id(argValues.locals[arg])
+            kwArgsIn[arg] = id(argLocals[arg])
         else:
-            kwArgsIn[arg] = argValues.locals[arg]
+            kwArgsIn[arg] = argLocals[arg]
 
     for outstr, outbm in zip(list(fdoc), bOut):
         kwArgsOut[outstr.strip()] = id(outbm)
@@ -709,6 +876,51 @@ def append_to_flow(meth, bOut, frame):
     oe.bl.flow.append([oe.name, meth.__func__, kwArgsIn, kwArgsOut])
 
 
+def fingerprint(obj):
+    """Returns a hex digest of the state of *obj*: its attributes, also
+    those of the contained objects (up to a few levels deep), with arrays
+    hashed by their contents. Beams and the beamline are not looked into.
+    Used by :meth:`BeamLine.propagate_flow` to find the beamline elements
+    whose parameters have changed."""
+    md5 = hashlib.md5()
+    _update_fingerprint(md5, obj, set(), 0)
+    return md5.hexdigest()
+
+
+def _update_fingerprint(md5, obj, seen, depth):
+    if obj is None or isinstance(obj, (bool, int, float, complex,
+                                       basestring)) or np.isscalar(obj):
+        md5.update(repr(obj).encode('utf-8'))
+    elif isinstance(obj, np.ndarray):
+        md5.update('{0}{1}'.format(obj.dtype, obj.shape).encode('utf-8'))
+        if obj.dtype.hasobject:
+            md5.update(repr(obj.tolist()).encode('utf-8'))
+        else:
+            md5.update(np.ascontiguousarray(obj).tobytes())
+    elif id(obj) in seen or depth > 3 or isinstance(obj, (
+            types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+            type, BeamLine)) or type(obj).__name__ == 'Beam':
+        md5.update(getattr(obj, '__name__', type(obj).__name__).encode(
+            'utf-8'))
+    else:
+        seen.add(id(obj))
+        if isinstance(obj, (list, tuple)):
+            items = enumerate(obj)
+        elif isinstance(obj, dict):
+            items = sorted(obj.items(), key=lambda item: str(item[0]))
+        elif hasattr(obj, '__dict__'):
+            md5.update(type(obj).__name__.encode('utf-8'))
+            items = sorted(obj.__dict__.items())
+        else:
+            items = ()
+            md5.update(repr(obj).encode('utf-8'))
+        md5.update(b'(')
+        for key, value in items:
+            md5.update(str(key).encode('utf-8'))
+            _update_fingerprint(md5, value, seen, depth+1)
+        md5.update(b')')
+
+
 def is_auto_align_required(oe):
     needAutoAlign = False
     for autoParam in ["_center", "_pitch", "_bragg"]:
@@ -742,7 +954,8 @@ class BeamLine(object):
             for prop in ['a', 'b', 'c', 'x', 'y', 'z', 'E']:
                 setattr(self, prop, np.zeros(2))
 
-    def __init__(self, azimuth=0., height=0., alignE='auto'):
+    def __init__(self, azimuth=0., height=0., alignE='auto',
+                 compactRays=False, recordFlow=False, cacheFlow=False):
         u"""
         *azimuth*: float
             Is counted in cw direction from the global Y axis. At
@@ -757,6 +970,37 @@ class BeamLine(object):
             Plays a role if the *pitch* or *bragg* parameters of the energy
             dispersive optical elements were set to 'auto'.
 
+        *compactRays*: bool
+            If True, each optical element, aperture and screen removes the
+            lost rays (negative *state*) from its incoming beam before
+            propagating it, so that the downstream elements only process the
+            living rays. The incoming beam is compacted in place. The plots
+            still count the removed rays as dead (see *droppedStates* of
+            :class:`Beam`) but do not histogram them, so set it to False if
+            the positions of the absorbed rays are to be plotted.
+
+        *recordFlow*: bool
+            If True, the propagation methods of the beamline elements record
+            the sequence of their calls (the flow) in *flow*, which is needed
+            by :meth:`export_to_glow`. :meth:`glow` switches it on by
+            itself, so it is normally left False: then the calls in scripted
+            and :func:`~xrt.runner.run_ray_tracing` runs are not recorded at
+            all.
+
+        *cacheFlow*: bool
+            If True, :meth:`propagate_flow` re-runs only those segments of
+            the flow whose element parameters or input beams have changed
+            since their last run; the other ones keep their output beams in
+            *beamsDict*. This is meant for interactive work (xrtQook sets it)
+            and must stay False when the flow is run repeatedly for
+            accumulating rays, as the unchanged sources would then return
+            the same rays. The results of :meth:`auto_align` are then also
+            cached and reused until the incoming beam or the alignment
+            parameters of the element change.
+
+        The time spent in :meth:`auto_align` is accumulated in *alignTime*
+        and per element name in *alignTimes*; both can be reset by the
+        user.
 
         """
         self.azimuth = azimuth
@@ -764,6 +1008,14 @@ class BeamLine(object):
 #        self.cosAzimuth = np.cos(azimuth)  # b0
         self.height = height
         self.alignE = alignE
+        self.compactRays = compactRays
+        self.recordFlow = recordFlow
+        self.cacheFlow = cacheFlow
+        self.flowFingerprints = {}
+        self.alignCache = {}
+        self._alignBeamKey = None
+        self.alignTime = 0.
+        self.alignTimes = OrderedDict()
         self.sources = []
         self.oes = []
         self.slits = []
@@ -823,17 +1075,19 @@ class BeamLine(object):
                     " for {1}.".format(v1, v2)
             print("Warning: the flow seems corrupt. Make sure each propagation"
                   " method assigns returned beams to local variables." + addw)
-        if self.flowSource != 'legacy':
+        if self.flowSource != 'legacy' or not self.recordFlow:
             return
+        from .sources_beams import Beam
+        materialsModule = __name__ + '.materials'
         frame = inspect.currentframe()
         localsDict = frame.f_back.f_locals
         globalsDict = frame.f_back.f_globals
         for objectName, memObject in globalsDict.items():
-            if len(re.findall('raycing.materials', str(type(memObject)))) > 0:
+            if type(memObject).__module__ == materialsModule:
                 self.materialsDict[objectName] = memObject
 
         for objectName, memObject in localsDict.items():
-            if len(re.findall('sources_beams.Beam', str(type(memObject)))) > 0:
+            if isinstance(memObject, Beam):
                 self.beamsDict[objectName] = memObject
                 self.beamsRevDict[id(memObject)] = objectName
             if objectName == 'outDict':
@@ -858,12 +1112,37 @@ class BeamLine(object):
                                 _warning()
         self.flowSource = 'prepared_to_run'
 
+    def compact_rays(self, beam):
+        """Removes the lost rays from *beam* in place if *compactRays* is
+        set."""
+        if not self.compactRays or beam is None:
+            return
+        beam.drop_lost_rays()
+
     def auto_align(self, oe, beam):
+        """Sets the 'auto' center, pitch and bragg of *oe* from the
+        intensity weighted centroid of the incoming *beam*. The time spent
+        here is accumulated in *alignTime* and, per element, in
+        *alignTimes*.
+
+        Under :meth:`propagate_flow` with *cacheFlow*, the results are
+        cached per element and keyed on the fingerprint of the incoming beam
+        (which reflects the source settings and all upstream elements) and
+        on the parameters of *oe* that enter the alignment. They are
+        reused, without looking at the beam, until one of these changes."""
         if self.flowSource == 'Qook':
             self.forceAlign = True
         if not (self.forceAlign or is_auto_align_required(oe)):
             return
+        startTime = time.time()
+        try:
+            self._auto_align(oe, beam)
+        finally:
+            spent = time.time() - startTime
+            self.alignTime += spent
+            self.alignTimes[oe.name] = self.alignTimes.get(oe.name, 0) + spent
 
+    def _auto_align(self, oe, beam):
         autoCenter = [False] * 3
         autoPitch = autoBragg = False
         alignE = self._alignE if hasattr(self, '_alignE') else self.alignE
@@ -889,38 +1168,71 @@ class BeamLine(object):
                 print("Automatic Bragg angle calculation failed.")
                 raise
 
-        if any(autoCenter) or autoPitch or autoBragg:
-            good = (beam.state == 1) | (beam.state == 2)
-            if self.flowSource == 'Qook':
-                beam.state[0] = 1
-#                beam.E[0] = alignE
-            intensity = beam.Jss[good] + beam.Jpp[good]
-            totalI = np.sum(intensity)
-            inBeam = self.aBeam()
-            for fieldName in ['x', 'y', 'z', 'a', 'b', 'c']:
-                field = getattr(beam, fieldName)
-                if totalI == 0:
-                    fNorm = 1.
-                else:
-                    fNorm = np.sum(field[good] * intensity) / totalI
-                try:
-                    setattr(inBeam, fieldName,
-                            np.ones(2) * fNorm)
-                    if self.flowSource == 'Qook':
-                        field[0] = fNorm
-                        setattr(inBeam, fieldName, field)
-                except:
-                    print("Cannot find direction for automatic alignment.")
-                    raise
-            dirNorm = np.sqrt(inBeam.a[0]**2 + inBeam.b[0]**2 + inBeam.c[0]**2)
-            inBeam.a[0] /= dirNorm
-            inBeam.b[0] /= dirNorm
-            inBeam.c[0] /= dirNorm
+        if not (any(autoCenter) or autoPitch or autoBragg):
+            return
 
-            if self.flowSource == 'Qook':
-                beam.a[0] /= dirNorm
-                beam.b[0] /= dirNorm
-                beam.c[0] /= dirNorm
+        alignKey = None
+        if self._alignBeamKey is not None:
+            alignKey = fingerprint((
+                self._alignBeamKey, self.flowSource, alignE, self.azimuth,
+                self.height, getattr(oe, '_center', None),
+                [None if auto else c for auto, c in
+                 zip(autoCenter, oe.center)],
+                getattr(oe, '_pitch', None), getattr(oe, '_bragg', None),
+                None if autoPitch else getattr(oe, 'pitch', None),
+                [getattr(oe, attr, None) for attr in
+                 ('roll', 'positionRoll', 'yaw', 'alpha', 'material')]))
+            cached = self.alignCache.get(oe.name)
+            if cached is not None and cached[0] == alignKey:
+                centroid, assigned = cached[1:]
+                if self.flowSource == 'Qook':
+                    beam.state[0] = 1
+                    for fieldName, value in zip(
+                            ['x', 'y', 'z', 'a', 'b', 'c'], centroid):
+                        getattr(beam, fieldName)[0] = value
+                for attr, value in assigned:
+                    if attr == 'center':
+                        for dim, auto in enumerate(autoCenter):
+                            if auto:
+                                oe.center[dim] = value[dim]
+                    else:
+                        setattr(oe, attr, value)
+                return
+
+        assigned = []
+        good = (beam.state == 1) | (beam.state == 2)
+        if self.flowSource == 'Qook':
+            beam.state[0] = 1
+#            beam.E[0] = alignE
+        intensity = beam.Jss[good] + beam.Jpp[good]
+        totalI = np.sum(intensity)
+        inBeam = self.aBeam()
+        for fieldName in ['x', 'y', 'z', 'a', 'b', 'c']:
+            field = getattr(beam, fieldName)
+            if totalI == 0:
+                fNorm = 1.
+            else:
+                fNorm = np.sum(field[good] * intensity) / totalI
+            try:
+                setattr(inBeam, fieldName,
+                        np.ones(2) * fNorm)
+                if self.flowSource == 'Qook':
+                    field[0] = fNorm
+                    setattr(inBeam, fieldName, field)
+            except:
+                print("Cannot find direction for automatic alignment.")
+                raise
+        dirNorm = np.sqrt(inBeam.a[0]**2 + inBeam.b[0]**2 + inBeam.c[0]**2)
+        inBeam.a[0] /= dirNorm
+        inBeam.b[0] /= dirNorm
+        inBeam.c[0] /= dirNorm
+
+        if self.flowSource == 'Qook':
+            beam.a[0] /= dirNorm
+            beam.b[0] /= dirNorm
+            beam.c[0] /= dirNorm
+        centroid = [getattr(inBeam, fieldName)[0] for fieldName in
+                    ['x', 'y', 'z', 'a', 'b', 'c']]
 
         if any(autoCenter):
             bStartC = np.array([inBeam.x[0], inBeam.y[0], inBeam.z[0]])
@@ -938,6 +1250,7 @@ class BeamLine(object):
                         break
             for dim in autoCoord:
                 oe.center[dim] = newCenter[dim]
+            assigned.append(('center', list(oe.center)))
             if _VERBOSITY_ > 0:
                 print(oe.name, "center:", oe.center)
 
@@ -964,11 +1277,14 @@ class BeamLine(object):
                 if autoBragg:
                     if autoPitch:
                         oe.pitch = 0
+                        assigned.append(('pitch', 0))
                     oe.bragg = targetPitch - oe.pitch
+                    assigned.append(('bragg', oe.bragg))
                     if _VERBOSITY_ > 0:
                         print(oe.name, "Bragg:", oe.bragg)
                 else:  # autoPitch
                     oe.pitch = targetPitch
+                    assigned.append(('pitch', oe.pitch))
                     if _VERBOSITY_ > 0:
                         print(oe.name, "pitch:", oe.pitch)
             except:
@@ -977,19 +1293,31 @@ class BeamLine(object):
                 else:
                     pass
 
+        if alignKey is not None:
+            self.alignCache[oe.name] = alignKey, centroid, assigned
+
     def propagate_flow(self, startFrom=0, signal=None):
+        """Runs the segments of *flow* starting from the segment number
+        *startFrom*. If *cacheFlow* is True, a segment is skipped when the
+        :func:`fingerprint` of its element, its non-beam arguments and the
+        fingerprints of its input beams (see :meth:`_beam_fingerprints`) are
+        the same as at its last run and its output beams are still in
+        *beamsDict*."""
         if self.oesDict is None or self.flow is None:
             return
         totalStages = len(self.flow[startFrom:])
         for iseg, segment in enumerate(self.flow[startFrom:]):
             segOE = self.oesDict[segment[0]][0]
             fArgs = OrderedDict()
+            inBeamNames = []
+            alignBeamKey = None
             for inArg in segment[2].items():
                 if inArg[0].startswith('beam'):
                     if inArg[1] is None:
                         inBeam = None
                         break
                     fArgs[inArg[0]] = self.beamsDict[inArg[1]]
+                    inBeamNames.append(inArg[1])
                     inBeam = fArgs['beam']
                 else:
                     fArgs[inArg[0]] = inArg[1]
@@ -1011,6 +1339,21 @@ class BeamLine(object):
             except:
                 pass
 
+            outNames = [str(name) for name in segment[3].values()]
+            if self.cacheFlow:
+                segKey = self._segment_key(segment)
+                inFingerprints = self._beam_fingerprints(
+                    startFrom + iseg, inBeamNames)
+                if 'beam' in segment[2]:
+                    alignBeamKey = inFingerprints[
+                        inBeamNames.index(segment[2]['beam'])]
+                segFingerprint = self._segment_fingerprint(
+                    segOE, segment, inFingerprints)
+                if self.flowFingerprints.get(segKey) == segFingerprint and\
+                        all(name in self.beamsDict for name in outNames):
+                    continue
+
+            self._alignBeamKey = alignBeamKey
             try:
                 outBeams = segment[1](segOE, **fArgs)
             except:
@@ -1018,6 +1361,8 @@ class BeamLine(object):
                     raise
                 else:
                     continue
+            finally:
+                self._alignBeamKey = None
 
             if isinstance(outBeams, tuple):
                 for outBeam, beamName in zip(list(outBeams),
@@ -1026,6 +1371,49 @@ class BeamLine(object):
             else:
                 self.beamsDict[str(list(segment[3].values())[0])] = outBeams
 
+            if self.cacheFlow:  # the state of the element after its run
+                self.flowFingerprints[segKey] = self._segment_fingerprint(
+                    segOE, segment, inFingerprints)
+
+    def _segment_key(self, segment):
+        return (segment[0], str(segment[1]),
+                tuple(str(name) for name in segment[3].values()))
+
+    def _segment_fingerprint(self, oe, segment, inFingerprints):
+        md5 = hashlib.md5(fingerprint(oe).encode('utf-8'))
+        md5.update(str(segment[1]).encode('utf-8'))
+        md5.update(fingerprint(dict(
+            (key, value) for key, value in segment[2].items()
+            if not key.startswith('beam'))).encode('utf-8'))
+        for inFingerprint in inFingerprints:
+            md5.update(inFingerprint.encode('utf-8'))
+        return md5.hexdigest()
+
+    def _beam_fingerprints(self, iseg, inBeamNames):
+        """Returns the fingerprints of the beams *inBeamNames* as they enter
+        the segment number *iseg* of *flow*. The fingerprint of a beam is made
+        of the stored fingerprint of the last segment before *iseg* that
+        output it and of those of the following segments that took it as
+        input, in flow order, as they may have modified it in place (e.g.
+        *state* by an aperture). It is thus recomputed from the stored
+        segment fingerprints and stays the same over repeated passes of an
+        unchanged flow, whatever *startFrom* is."""
+        fingerprints = []
+        for name in inBeamNames:
+            md5 = hashlib.md5(str(name).encode('utf-8'))
+            for segment in self.flow[:iseg]:
+                segFingerprint = self.flowFingerprints.get(
+                    self._segment_key(segment), '')
+                outNames = [str(outName) for outName in segment[3].values()]
+                if name in outNames:
+                    md5 = hashlib.md5('{0}:{1}'.format(
+                        segFingerprint, outNames.index(name)).encode('utf-8'))
+                elif name in [value for key, value in segment[2].items()
+                              if key.startswith('beam')]:
+                    md5.update(segFingerprint.encode('utf-8'))
+            fingerprints.append(md5.hexdigest())
+        return fingerprints
+
     def glow(self, scale=[], centerAt='', startFrom=0, colorAxis=None,
              colorAxisLimits=None, generator=None, generatorArgs=[]):
         if generator is not None:
@@ -1045,6 +1433,7 @@ class BeamLine(object):
             return
 
         from .run import run_process
+        self.recordFlow = True
         run_process(self)
         if self.blViewer is None:
             app = xrtglow.qt.QApplication(sys.argv)
@@ -141,6 +141,7 @@ class RectangularAperture(object):
             d.append(div*sourceToAperture + sgn*raycing.accuracyInPosition)
         self.opening = d
 
+    @raycing.flow_outputs('beamLocal')
     def propagate(self, beam=None, needNewGlobal=False):
         """Assigns the "lost" value to *beam.state* array for the rays
         intercepted by the aperture. The "lost" value is
@@ -151,6 +152,7 @@ class RectangularAperture(object):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         good = beam.state > 0
 # beam in local coordinates
         lo = rs.Beam(copyFrom=beam)
@@ -251,12 +253,13 @@ class RectangularAperture(object):
         :class:`~xrt.backends.raycing.apertures.RoundAperture`.
         *nrays* of samples are randomly distributed over the slit area.
         """
+        rng = raycing.get_rng()
         if rw is None:
             from . import waves as rw
 
         nrays = int(nrays)
         wave = rs.Beam(nrays=nrays, forceState=1, withAmplitudes=True)
-        xy = np.random.rand(nrays, 2)
+        xy = rng.random((nrays, 2))
         dX = self.limOptX[1] - self.limOptX[0]
         dZ = self.limOptY[1] - self.limOptY[0]
         wave.x[:] = xy[:, 0] * dX + self.limOptX[0]
@@ -454,6 +457,7 @@ class RoundAperture(object):
         ss = [a - b for a, b in zip(self.center - source.center)]
         return self.r * 2 * (np.dot(ss, ss) ** -0.5)
 
+    @raycing.flow_outputs('beamLocal')
     def propagate(self, beam=None, needNewGlobal=False):
         """Assigns the "lost" value to *beam.state* array for the rays
         intercepted by the aperture. The "lost" value is
@@ -464,6 +468,7 @@ class RoundAperture(object):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         good = beam.state > 0
 # beam in local coordinates
         lo = rs.Beam(copyFrom=beam)
@@ -507,12 +512,13 @@ class RoundAperture(object):
         :class:`~xrt.backends.raycing.apertures.RoundAperture`.
         *nrays* of samples are randomly distributed over the slit area.
         """
+        rng = raycing.get_rng()
         if rw is None:
             from . import waves as rw
 
         nrays = int(nrays)
         wave = rs.Beam(nrays=nrays, forceState=1, withAmplitudes=True)
-        xy = np.random.rand(nrays, 2)
+        xy = rng.random((nrays, 2))
         r = xy[:, 0]**0.5 * self.r
         phi = xy[:, 1] * 2*np.pi
         wave.x[:] = r * np.cos(phi)
@@ -574,6 +580,7 @@ class RoundBeamStop(RoundAperture):
 #        if nanSum > 0:
 #            print("{0} NaN rays in {1}!".format(nanSum, strName))
 
+    @raycing.flow_outputs('beamLocal')
     def propagate(self, beam=None, needNewGlobal=False):
         """Assigns the "lost" value to *beam.state* array for the rays
         intercepted by the aperture. The "lost" value is
@@ -584,6 +591,7 @@ class RoundBeamStop(RoundAperture):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         good = beam.state > 0
 # beam in local coordinates
         lo = rs.Beam(copyFrom=beam)
@@ -630,6 +638,7 @@ class DoubleSlit(RectangularAperture):
         self.shadeFraction = kwargs.pop('shadeFraction', 0.5)
         super(DoubleSlit, self).__init__(*args, **kwargs)
 
+    @raycing.flow_outputs('beamLocal')
     def propagate(self, beam=None, needNewGlobal=False):
         """Assigns the "lost" value to *beam.state* array for the rays
         intercepted by the aperture. The "lost" value is
@@ -640,6 +649,7 @@ class DoubleSlit(RectangularAperture):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         shadeMin = (1 - self.shadeFraction) * 0.5
         shadeMax = shadeMin + self.shadeFraction
         good = beam.state > 0
@@ -756,6 +766,7 @@ class PolygonalAperture(object):
         self.limOptY = [np.min(self.vertices[:, 1]),
                         np.max(self.vertices[:, 1])]
 
+    @raycing.flow_outputs('beamLocal')
     def propagate(self, beam=None, needNewGlobal=False):
         """Assigns the "lost" value to *beam.state* array for the rays
         intercepted by the aperture. The "lost" value is
@@ -766,6 +777,7 @@ class PolygonalAperture(object):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         good = beam.state > 0
 # beam in local coordinates
         lo = rs.Beam(copyFrom=beam)
@@ -810,6 +822,7 @@ class PolygonalAperture(object):
         :class:`~xrt.backends.raycing.apertures.RoundAperture`.
         *nrays* of samples are randomly distributed over the slit area.
         """
+        rng = raycing.get_rng()
         from . import waves as rw
 
         nrays = int(nrays)
@@ -823,7 +836,7 @@ class PolygonalAperture(object):
         goodX = []
         goodY = []
         while randRays < nrays:
-            xy = np.random.rand(nrays, 2)
+            xy = rng.random((nrays, 2))
             rndX = xy[:, 0] * dX + self.limOptX[0]
             rndY = xy[:, 1] * dZ + self.limOptY[0]
             inDots = footprint.contains_points(zip(rndX, rndY))
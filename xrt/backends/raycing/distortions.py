@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+r"""
+Gridded distortions
+-------------------
+
+Module :mod:`~xrt.backends.raycing.distortions` defines a figure error given
+as a height map on a rectangular (x, y) mesh, e.g. a metrology measurement.
+The map is interpolated by piecewise bicubic polynomials whose coefficients
+are calculated once, at instantiation; the height and the two slopes at an
+arbitrary number of points are then obtained by vectorized evaluation of the
+polynomials, without interpolating the map anew.
+
+An instance of :class:`GriddedDistortion` is attached to an optical element
+by its parameter *distortion* (and *distortion2* for the second surface of
+:class:`~xrt.backends.raycing.oes.DCM` and its descendants, including the
+lenses). It then serves the methods ``local_z_distorted`` and
+``local_n_distorted`` of the element, see Section :ref:`distorted`.
+
+.. autoclass:: xrt.backends.raycing.distortions.GriddedDistortion()
+   :members: __init__, read_map, local_z, local_n, get_slopes
+
+"""
+__author__ = "Konstantin Klementiev, Roman Chernikov"
+__date__ = "18 Oct 2026"
+__all__ = 'GriddedDistortion',
+import numpy as np
+
+_M = np.array([[1., 0., 0., 0.],
+               [0., 0., 1., 0.],
+               [-3., 3., -2., -1.],
+               [2., -2., 1., 1.]])
+
+
+def _powers(t, derivative=False):
+    """Returns the powers 0 to 3 of *t* (or their derivatives) as columns
+    of a (len(*t*), 4) array."""
+    res = np.empty((len(t), 4))
+    if derivative:
+        res[:, 0] = 0.
+        res[:, 1] = 1.
+        np.multiply(t, 2., out=res[:, 2])
+        np.multiply(t, t, out=res[:, 3])
+        res[:, 3] *= 3.
+    else:
+        res[:, 0] = 1.
+        res[:, 1] = t
+        np.multiply(t, t, out=res[:, 2])
+        np.multiply(res[:, 2], t, out=res[:, 3])
+    return res
+
+
+class GriddedDistortion(object):
+    """Height map of a surface distortion on a rectangular mesh, interpolated
+    by bicubic polynomials."""
+    chunkSize = 2**14
+
+    def __init__(self, x=None, y=None, z=None, fileName=None, xFactor=1.,
+                 yFactor=1., zFactor=1., swapXY=False, centerXY=False):
+        u"""
+        *x*, *y*: 1D arrays
+            Monotonically increasing mesh coordinates in mm in the local
+            system of the optical element. The mesh does not have to be
+            equidistant.
+
+        *z*: 2D array of shape (len(*x*), len(*y*))
+            Heights in mm.
+
+        *fileName*: str
+            If given, the map is read from the file instead of *x*, *y*, *z*.
+            A '.npz' file must contain the arrays 'x', 'y' and 'z' as above.
+            A '.npy' file contains the 2D array *z*; *x* and *y* must then be
+            given as arguments. Any other file is read as text by
+            :func:`numpy.loadtxt` and must have three columns x, y, z, one
+            line per mesh node, in any order but with all the nodes present.
+
+        *xFactor*, *yFactor*, *zFactor*: float
+            Multipliers that convert the coordinates and the heights to mm,
+            e.g. *zFactor* = 1e-6 for heights measured in nm.
+
+        *swapXY*: bool
+            If True, the axes of the map are exchanged, e.g. when the
+            metrology x axis is along the mirror length (our y).
+
+        *centerXY*: bool
+            If True, the mesh is shifted to have its center at x = y = 0.
+
+        Outside of the mesh, the map is continued by its border values.
+        The bicubic coefficients take 16 floats per mesh cell. The points are
+        evaluated in chunks of *chunkSize* (a class attribute).
+        """
+        if fileName is not None:
+            x, y, z = self.read_map(fileName, x, y)
+        x = np.array(x, dtype=np.float64) * xFactor
+        y = np.array(y, dtype=np.float64) * yFactor
+        z = np.array(z, dtype=np.float64) * zFactor
+        if swapXY:
+            x, y, z = y, x, z.T
+        if centerXY:
+            x -= (x[0] + x[-1]) / 2.
+            y -= (y[0] + y[-1]) / 2.
+        if z.shape != (len(x), len(y)):
+            raise ValueError(
+                "the height map must be of shape (len(x), len(y))")
+        if len(x) < 2 or len(y) < 2:
+            raise ValueError("the height map needs at least 2x2 nodes")
+        if (np.diff(x) <= 0).any() or (np.diff(y) <= 0).any():
+            raise ValueError("x and y must be monotonically increasing")
+        self.x, self.y, self.z = x, y, z
+        self.limPhysX = x[0], x[-1]
+        self.limPhysY = y[0], y[-1]
+        self.hx, self.hy = np.diff(x), np.diff(y)
+        self._isUniformX = np.allclose(self.hx, self.hx[0])
+        self._isUniformY = np.allclose(self.hy, self.hy[0])
+        self._set_coefficients()
+
+    @staticmethod
+    def read_map(fileName, x=None, y=None):
+        """Reads a height map from *fileName* (see the constructor) and
+        returns *x*, *y* and *z*."""
+        if fileName.endswith('.npz'):
+            data = np.load(fileName)
+            return data['x'], data['y'], data['z']
+        elif fileName.endswith('.npy'):
+            if x is None or y is None:
+                raise ValueError("x and y must be given for a '.npy' map")
+            return x, y, np.load(fileName)
+        xL, yL, zL = np.loadtxt(fileName, unpack=True)
+        x, ix = np.unique(xL, return_inverse=True)
+        y, iy = np.unique(yL, return_inverse=True)
+        if len(zL) != len(x) * len(y):
+            raise ValueError("the map in {0} is not a full rectangular "
+                             "mesh".format(fileName))
+        z = np.full((len(x), len(y)), np.nan)
+        z[ix, iy] = zL
+        if np.isnan(z).any():
+            raise ValueError("the map in {0} has repeated nodes".format(
+                fileName))
+        return x, y, z
+
+    def _set_coefficients(self):
+        edgeOrder = 2 if min(self.z.shape) > 2 else 1
+        zx, zy = np.gradient(self.z, self.x, self.y, edge_order=edgeOrder)
+        zxy = np.gradient(zx, self.y, axis=1, edge_order=edgeOrder)
+        hx = self.hx[:, np.newaxis]
+        hy = self.hy[np.newaxis, :]
+        # derivatives over the normalized cell coordinates u, v in [0, 1]:
+        fu = [zx[:-1, :-1]*hx, zx[:-1, 1:]*hx, zx[1:, :-1]*hx, zx[1:, 1:]*hx]
+        fv = [zy[:-1, :-1]*hy, zy[:-1, 1:]*hy, zy[1:, :-1]*hy, zy[1:, 1:]*hy]
+        fuv = [zxy[:-1, :-1]*hx*hy, zxy[:-1, 1:]*hx*hy, zxy[1:, :-1]*hx*hy,
+               zxy[1:, 1:]*hx*hy]
+        z = self.z
+        f = [z[:-1, :-1], z[:-1, 1:], z[1:, :-1], z[1:, 1:]]
+        F = np.array([[f[0], f[1], fv[0], fv[1]],
+                      [f[2], f[3], fv[2], fv[3]],
+                      [fu[0], fu[1], fuv[0], fuv[1]],
+                      [fu[2], fu[3], fuv[2], fuv[3]]])
+        # coefficients of u^p v^q as [cell, p, q], cell = ix*(ny-1) + iy:
+        A = np.einsum('ik,kl...,jl->...ij', _M, F, _M)
+        self.coeffs = np.ascontiguousarray(A).reshape(-1, 4, 4)
+
+    def _locate(self, p, mesh, h, isUniform):
+        """Returns the cell indices of the points *p* and their normalized
+        coordinates within the cells."""
+        if isUniform:
+            t = p - mesh[0]
+            t *= 1. / h[0]
+            np.clip(t, 0, len(h), out=t)
+            i = t.astype(np.intp)
+            np.clip(i, 0, len(h)-1, out=i)
+            t -= i
+            return i, t
+        p = np.clip(p, mesh[0], mesh[-1])
+        i = np.searchsorted(mesh, p, side='right') - 1
+        np.clip(i, 0, len(h)-1, out=i)
+        return i, (p - mesh[i]) / h[i]
+
+    def _evaluate(self, x, y, needSlopes):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        x, y = np.broadcast_arrays(x, y)
+        shape = x.shape
+        x, y = x.ravel(), y.ravel()
+        res = [np.empty(len(x)) for i in range(3 if needSlopes else 1)]
+        # in chunks, to limit the gathered coefficients to chunkSize*16
+        for start in range(0, len(x), self.chunkSize):
+            chunk = slice(start, start + self.chunkSize)
+            ix, u = self._locate(x[chunk], self.x, self.hx, self._isUniformX)
+            iy, v = self._locate(y[chunk], self.y, self.hy, self._isUniformY)
+            cell = ix * len(self.hy)
+            cell += iy
+            coeffs = np.take(self.coeffs, cell, axis=0)
+            powU, powV = _powers(u), _powers(v)
+            rows = np.einsum('npq,nq->np', coeffs, powV)
+            res[0][chunk] = np.einsum('np,np->n', rows, powU)
+            if needSlopes:
+                res[1][chunk] = np.einsum(
+                    'np,np->n', rows, _powers(u, True)) / self.hx[ix]
+                drows = np.einsum('npq,nq->np', coeffs, _powers(v, True))
+                res[2][chunk] = np.einsum(
+                    'np,np->n', drows, powU) / self.hy[iy]
+        res = [r.reshape(shape) for r in res]
+        return tuple(res) if needSlopes else res[0]
+
+    def local_z(self, x, y):
+        """Returns the interpolated height at (*x*, *y*)."""
+        return self._evaluate(x, y, False)
+
+    def get_slopes(self, x, y):
+        """Returns the interpolated height and its derivatives dz/dx, dz/dy
+        at (*x*, *y*) as a 3-tuple of arrays."""
+        return self._evaluate(x, y, True)
+
+    def local_n(self, x, y):
+        """Returns the distortion of the normal at (*x*, *y*) as the two
+        rotation angles (d_pitch, d_roll), as expected from
+        :meth:`~xrt.backends.raycing.oes.OE.local_n_distorted`."""
+        z, dzdx, dzdy = self._evaluate(x, y, True)
+        return np.arctan(dzdy), -np.arctan(dzdx)
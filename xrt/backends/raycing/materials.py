@@ -1097,6 +1097,7 @@ class Crystal(Material):
 
     def get_Borrmann_out(self, goodN, oeNormal, lb, a_out, b_out, c_out,
                          alphaAsym=None, Rcurvmm=None, ucl=None, useTT=False):
+        rng = raycing.get_rng()
 
         asymmAngle = alphaAsym if alphaAsym is not None else 0
 
@@ -1214,8 +1215,8 @@ class Crystal(Material):
             counter = 0
             while raysLeft > 0:
                 counter += 1
-                disc = np.random.random(raysLeft)*IhMax[index]
-                rawRand = np.random.random(raysLeft)
+                disc = rng.random(raysLeft)*IhMax[index]
+                rawRand = rng.random(raysLeft)
                 xrand = rawRand * 2. - 1.
                 if useTT:
                     deltaRand, ipLeft = np.modf(rawRand * N_layers)
@@ -1235,7 +1236,7 @@ class Crystal(Material):
                 raysLeft = len(index)
             totalX = 0.5*(totalX + 1.)
         elif self.calcBorrmann == 'uniform':
-            totalX = np.random.random(bLength)
+            totalX = rng.random(bLength)
         else:  # You should never get here
             totalX = 0.5*np.ones(bLength)
 
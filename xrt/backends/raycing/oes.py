@@ -86,6 +86,12 @@ your descendant of the :class:`OE`: ``local_z_distorted`` (or
 latter method returns two angles d_pitch and d_roll or a 3D vector that will be
 added to the local normal. See the docstrings of :meth:`OE.local_n_distorted`
 and the example ':ref:`warping`'.
+
+A figure error known on a mesh, e.g. a metrology height map, does not need
+these methods: create an instance of
+:class:`~xrt.backends.raycing.distortions.GriddedDistortion` and pass it to
+the optical element as *distortion* (*distortion2* for the second surface of
+:class:`DCM` and its descendants).
 """
 from __future__ import print_function
 __author__ = "Konstantin Klementiev, Roman Chernikov"
@@ -134,7 +140,7 @@ from .. import raycing
 from . import stages as rst
 from . import sources as rs
 from .physconsts import CH
-from .oes_base import OE, DCM, allArguments
+from .oes_base import OE, DCM, allArguments, quadratic_roots, first_root_in
 try:
     import pyopencl as cl  # analysis:ignore
     isOpenCL = True
@@ -703,6 +709,12 @@ class BentFlatMirror(OE):
         center."""
         return (y**2 - self.limPhysY[0]**2) / 2.0 / self.R
 
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        """The parabolic cylinder gives a quadratic equation in *t*."""
+        return quadratic_roots(
+            b**2 / 2. / self.R, y*b/self.R - c,
+            (y**2 - self.limPhysY[0]**2) / 2. / self.R - z)
+
     def local_n(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         a = 0.  # -dz/dx
@@ -780,6 +792,32 @@ class ToroidMirror(OE):
         rx[rx < 0] = 0.  # becomes flat at the equator
         return y**2/2.0/self.R + self.r*(1 - rx**0.5)
 
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        """Solves the quadratic equation of the meridional parabola with the
+        sagittal circle linearized at the current intersection point, which
+        converges quadratically to the root of the (quartic) toroid
+        equation. The monomial quartic itself is ill-conditioned for *R* >>
+        *r*. The rays that do not converge are left for the numerical
+        search."""
+        t = 0.5 * (t1 + t2)
+        converged = np.zeros(len(t), dtype=bool)
+        for it in range(8):
+            xt = x + a*t
+            rx = 1 - (xt/self.r)**2
+            inside = rx > 0  # becomes flat at the equator
+            sq = np.sqrt(np.where(inside, rx, 1.))
+            sag = self.r * (1 - np.where(inside, sq, 0.))
+            dsag = np.where(inside, xt / (self.r*sq), 0.)
+            tNew = first_root_in(quadratic_roots(
+                b**2 / 2. / self.R, y*b/self.R - c + dsag*a,
+                y**2 / 2. / self.R + sag + dsag*(x-xt) - z), t1, t2)
+            with np.errstate(invalid='ignore'):
+                converged = abs(tNew - t) <= 1e-12 * np.maximum(abs(t), 1.)
+            t = tNew
+            if converged.all():
+                break
+        return (np.where(converged, t, np.nan),)
+
     def local_n(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         rx = 1 - (np.asarray(x)/self.r)**2
@@ -1032,6 +1070,19 @@ class EllipticalMirror(OE):
         delta_z = -self.p * np.sin(self.alpha)
         return -self.be * np.sqrt(1 - ((y+delta_y)/self.ae)**2) - delta_z
 
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        """The ellipse gives a quadratic equation in *t*; its root must lie
+        on the lower half of the ellipse."""
+        Y = y + self.p*np.cos(self.alpha) - self.ce
+        Z = z - self.p*np.sin(self.alpha)
+        ae2, be2 = self.ae**2, self.be**2
+        roots = quadratic_roots(b**2/ae2 + c**2/be2,
+                                2 * (Y*b/ae2 + Z*c/be2),
+                                Y**2/ae2 + Z**2/be2 - 1)
+        with np.errstate(invalid='ignore'):
+            return [np.where(Z + c*root <= 0, root, np.nan)
+                    for root in roots]
+
     def local_n(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         delta_y = self.p * np.cos(self.alpha) - self.ce
@@ -1097,6 +1148,17 @@ class ParabolicMirror(OE):
     def local_z(self, x, y):
         return -np.sqrt(2 * self.pp * (y+self.delta_y)) - self.delta_z
 
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        """The parabola gives a quadratic equation in *t*; its root must lie
+        on the lower branch of the parabola."""
+        Y = y + self.delta_y
+        Z = z + self.delta_z
+        roots = quadratic_roots(c**2, 2 * (Z*c - self.pp*b),
+                                Z**2 - 2*self.pp*Y)
+        with np.errstate(invalid='ignore'):
+            return [np.where(Z + c*root <= 0, root, np.nan)
+                    for root in roots]
+
     def local_n(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         # delta_y = 0.5*self.p*(1+np.cos(self.alpha))
@@ -1493,6 +1555,7 @@ class Plate(DCM):
     def assign_auto_material_kind(self, material):
         material.kind = 'plate'
 
+    @raycing.flow_outputs('beamGlobal', 'beamLocal1', 'beamLocal2')
     def double_refract(self, beam=None, needLocal=True,
                        returnLocalAbsorbed=None):
         """
@@ -1511,6 +1574,7 @@ class Plate(DCM):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         self.material2 = self.material
         self.cryst2perpTransl = -self.t
         if self.bl is not None:
@@ -1660,6 +1724,34 @@ class ParaboloidFlatLens(Plate):
         """Determines the surface of OE at (x, y) position."""
         return self.local_z(x, y)
 
+    closedFormSurfaces = ('local_z', 'local_z1', 'local_z2')
+
+    def _lens_roots(self, local_f, curved, kx, t1, t2, x, y, z, a, b, c):
+        """Intersections with the surface *local_f* that is either flat or,
+        if its name is in *curved*, the paraboloid (*kx* = 1) or the
+        parabolic cylinder (*kx* = 0) capped at *zmax*."""
+        if local_f is None or local_f.__name__ not in curved:
+            return OE.solve_intersection(self, None, t1, t2, x, y, z, a, b, c)
+        f4 = 4 * self.focus
+        roots = quadratic_roots((kx*a**2 + b**2) / f4,
+                                2 * (kx*x*a + y*b) / f4 - c,
+                                (kx*x**2 + y**2) / f4 - z)
+        if self.zmax is None:
+            return roots
+        with np.errstate(divide='ignore', invalid='ignore'):
+            roots = [np.where(z + c*root <= self.zmax, root, np.nan)
+                     for root in roots]
+            tCap = (self.zmax - z) / c
+            roots.append(np.where(
+                (kx*(x + a*tCap)**2 + (y + b*tCap)**2) / f4 >= self.zmax,
+                tCap, np.nan))
+        return roots
+
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        """The paraboloid gives a quadratic equation in *t*."""
+        return self._lens_roots(
+            local_f, ('local_z1',), 1, t1, t2, x, y, z, a, b, c)
+
     def local_n1(self, x, y):
         """Determines the normal vector of OE at (x, y) position. If OE is an
         asymmetric crystal, *local_n* must return 2 normals: the 1st one of the
@@ -1690,6 +1782,7 @@ class ParaboloidFlatLens(Plate):
         return 2 * self.focus / float(f) /\
             (1. - self.material.get_refractive_index(E).real) * nFactor
 
+    @raycing.flow_outputs('beamGlobal', 'beamLocal1', 'beamLocal2')
     def multiple_refract(self, beam=None, needLocal=True,
                          returnLocalAbsorbed=None):
         """
@@ -1710,6 +1803,7 @@ class ParaboloidFlatLens(Plate):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         if isinstance(self.nCRL, (int, float)):
             nCRL = self.nCRL
         elif isinstance(self.nCRL, (list, tuple)):
@@ -1835,6 +1929,10 @@ class ParabolicCylinderFlatLens(ParaboloidFlatLens):
     def local_z1(self, x, y):
         return ParaboloidFlatLens.local_z1(self, 0, y)
 
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        return self._lens_roots(
+            local_f, ('local_z1',), 0, t1, t2, x, y, z, a, b, c)
+
     def local_n1(self, x, y):
         return ParaboloidFlatLens.local_n1(self, 0, y)
 
@@ -1870,6 +1968,10 @@ class DoubleParaboloidLens(ParaboloidFlatLens):
     def local_z2(self, x, y):
         return self.local_z1(x, y)
 
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        return self._lens_roots(
+            local_f, ('local_z1', 'local_z2'), 1, t1, t2, x, y, z, a, b, c)
+
     def local_n2(self, x, y):
         return self.local_n1(x, y)
 
@@ -1880,6 +1982,10 @@ class DoubleParabolicCylinderLens(ParabolicCylinderFlatLens):
     def local_z2(self, x, y):
         return self.local_z1(x, y)
 
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        return self._lens_roots(
+            local_f, ('local_z1', 'local_z2'), 0, t1, t2, x, y, z, a, b, c)
+
     def local_n2(self, x, y):
         return self.local_n1(x, y)
 
@@ -5,6 +5,8 @@ import time
 import numpy as np
 import inspect
 import copy
+import threading
+import weakref
 
 import matplotlib as mpl
 from .. import raycing
@@ -40,7 +42,8 @@ allArguments = ('bl', 'name', 'center', 'bragg', 'pitch', 'roll', 'yaw',
                 'isCentralZoneBlack', 'thinnestZone', 'f1', 'f2',
                 'phaseShift', 'vorticity', 'grazingAngle',
                 'blaze', 'antiblaze', 'rho', 'aspect', 'depth', 'coeffs',
-                'targetOpenCL', 'precisionOpenCL')
+                'targetOpenCL', 'precisionOpenCL', 'intersectionSolver',
+                'distortion', 'distortion2')
 
 
 def flatten(x):
@@ -52,10 +55,86 @@ def flatten(x):
         return [x]
 
 
+def quadratic_roots(qa, qb, qc):
+    """Returns the two real roots of *qa*\ t\ :sup:`2` + *qb*\ t + *qc* = 0
+    for arrays of coefficients, in the numerically stable form. The roots
+    are NaN where they are complex; where *qa* is 0, the root of the linear
+    equation is returned twice."""
+    qa, qb, qc = np.broadcast_arrays(*[np.asarray(coeff, dtype=np.float64)
+                                       for coeff in (qa, qb, qc)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sqrtD = np.sqrt(qb**2 - 4*qa*qc)
+        q = -0.5 * (qb + np.where(qb < 0, -sqrtD, sqrtD))
+        root1 = q / qa
+        root2 = qc / q
+        linear = qa == 0
+        if linear.any():
+            root1 = np.where(linear, -qc/qb, root1)
+            root2 = np.where(linear, root1, root2)
+    return root1, root2
+
+
+def first_root_in(roots, t1, t2):
+    """Returns the smallest of the *roots* (a sequence of arrays) that lies
+    within [*t1*, *t2*], or NaN where there is none. A root within a few
+    rounding errors outside the interval is moved onto its edge."""
+    eps = 1e-12 * np.maximum(np.maximum(abs(t1), abs(t2)), 1.)
+    best = np.full(np.shape(t1), np.nan)
+    with np.errstate(invalid='ignore'):
+        for root in roots:
+            inside = (root >= t1-eps) & (root <= t2+eps) & ~(best <= root)
+            best = np.where(inside, np.clip(root, t1, t2), best)
+    return best
+
+
+def _scatter(fulls, works, index, sel=None):
+    """Writes the working arrays *works* (or their elements *sel*) into the
+    full arrays *fulls* at *index*."""
+    if sel is not None:
+        index = index[sel]
+        works = [work[sel] for work in works]
+    for full, work in zip(fulls, works):
+        full[index] = work
+
+
+def _defining_class(cls, attr):
+    for base in cls.__mro__:
+        if attr in base.__dict__:
+            return base
+
+
+_threadLocal = threading.local()
+_statsLock = threading.Lock()
+
+
+class CurrentDistortion(object):
+    """
+    The *curDistortion* attribute of OE: the distortion of the surface being
+    intersected, *distortion* or, for the second crystal of a DCM,
+    *distortion2*. It is set by :meth:`OE._reflect_local` for the current
+    thread only, because the threads of a run share the beamline elements.
+    If not set in the thread, it is *distortion*.
+    """
+
+    def __get__(self, oe, owner=None):
+        if oe is None:
+            return self
+        curDistortions = getattr(_threadLocal, 'curDistortions', None)
+        if curDistortions is not None and oe in curDistortions:
+            return curDistortions[oe]
+        return getattr(oe, 'distortion', None)
+
+    def __set__(self, oe, value):
+        if not hasattr(_threadLocal, 'curDistortions'):
+            _threadLocal.curDistortions = weakref.WeakKeyDictionary()
+        _threadLocal.curDistortions[oe] = value
+
+
 class OE(object):
     """The main base class for an optical element. It implements a generic flat
     mirror, crystal, multilayer or grating."""
     hiddenMethods = ['multiple_reflect']
+    curDistortion = CurrentDistortion()
     cl_plist = ["center"]
     cl_local_z = """
     float local_z(float8 cl_plist, int i, float x, float y)
@@ -90,7 +169,8 @@ class OE(object):
         limPhysY=[-raycing.maxHalfSizeOfOE, raycing.maxHalfSizeOfOE],
         limOptY=None, isParametric=False, shape='rect',
         gratingDensity=None, order=None, shouldCheckCenter=False,
-            targetOpenCL=None, precisionOpenCL='float64'):
+            targetOpenCL=None, precisionOpenCL='float64',
+            intersectionSolver='auto', distortion=None):
         u"""
         *bl*: instance of :class:`~xrt.backends.raycing.BeamLine`
             Container for beamline elements. Optical elements are added to its
@@ -233,6 +313,27 @@ class OE(object):
             with double precision are much slower. Double precision may be
             unavailable on your system.
 
+        *intersectionSolver*: 'auto' or 'newton'
+            The numerical search for the intersections of rays with the
+            surface. 'auto' uses the secant method or, for strongly unequal
+            brackets, the Brent method. 'newton' uses the Newton method with
+            the surface normals of :meth:`local_n` (or *local_n1*, *local_n2*
+            for the surfaces *local_z1*, *local_z2*) and
+            :meth:`local_n_distorted`, protected by the bracketing interval:
+            a step that leaves the interval is replaced by bisection. It
+            needs fewer surface evaluations for smooth surfaces whose normals
+            are consistent with their heights. Closed form solutions, if
+            available, are used first in either case. The counts of rays,
+            surface evaluations and iterations are accumulated in the dict
+            *intersectionStats* of the OE.
+
+        *distortion*: None or instance of
+            :class:`~xrt.backends.raycing.distortions.GriddedDistortion`
+            A gridded figure error added to the surface. It is used by the
+            default :meth:`local_z_distorted` and :meth:`local_n_distorted`,
+            so it is ignored if these methods are overridden. Only for
+            non-parametric surfaces.
+
 
         """
         self.bl = bl
@@ -288,6 +389,12 @@ class OE(object):
         self.limOptX = limOptX
         self.limOptY = limOptY
         self.isParametric = isParametric
+        if distortion is not None and isParametric:
+            raise ValueError("'distortion' is only for non-parametric "
+                             "surfaces")
+        self.distortion = distortion
+        self.intersectionSolver = intersectionSolver
+        self.reset_intersection_stats()
         self.use_rays_good_gn = False  # use rays_good_gn instead of rays_good
 
         self.shape = shape
@@ -387,7 +494,10 @@ class OE(object):
         return np.zeros_like(y)  # just flat
 
     def local_z_distorted(self, x, y):
-        return
+        """Distortion to the local height. Here: the height of the gridded
+        distortion attached to the current surface, if any."""
+        if self.curDistortion is not None:
+            return self.curDistortion.local_z(x, y)
 
     def local_g(self, x, y, rho=-100.):
         """For a grating, gives the local reciprocal groove vector (without
@@ -458,8 +568,12 @@ class OE(object):
            `local_n + local_n_distorted` will be normalized internally before
            calculating the reflected beam direction. A tuple of 3 arrays must
            be returned.
+
+        Here: the slopes of the gridded distortion attached to the current
+        surface, if any, in the first way.
         """
-        return
+        if self.curDistortion is not None:
+            return self.curDistortion.local_n(x, y)
 
     _h = 20.
 
@@ -480,6 +594,47 @@ class OE(object):
     def local_r_distorted(self, s, phi):
         return
 
+    closedFormSurfaces = ('local_z',)
+
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        """Returns the ray parameters *t* of the intersections of the rays
+        (*x*, *y*, *z*) + *t*\ (*a*, *b*, *c*) with the surface *local_f*
+        (None means :meth:`local_z`) in closed form, as a sequence of arrays
+        of candidate roots (NaN where absent). :meth:`find_intersection`
+        takes the first candidate within the bracketing [*t1*, *t2*] and
+        searches numerically for the rays that have none.
+
+        A class that overrides :meth:`local_z` can override this method to
+        supply its analytic solution and list in *closedFormSurfaces* the
+        names of the surface methods it solves. The solution is only used
+        for these surfaces and only as long as none of them nor
+        :meth:`local_z_distorted` is overridden in a subclass of the class
+        that defines the solver. Returning None requests the numerical
+        search. Here: the flat surface."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (-z / c,)
+
+    def _closed_form_surface(self, local_f, derivOrder=0):
+        """Tells if :meth:`solve_intersection` applies to *local_f*."""
+        if derivOrder != 0 or self.isParametric or \
+                self.curDistortion is not None:
+            return False
+        if local_f is None:
+            name = 'local_z'
+        elif getattr(local_f, '__self__', None) is self:
+            name = local_f.__name__
+        else:
+            return False
+        if name not in self.closedFormSurfaces:
+            return False
+        cls = type(self)
+        solverClass = _defining_class(cls, 'solve_intersection')
+        for attr in self.closedFormSurfaces + ('local_z_distorted',):
+            if attr in self.__dict__ or not issubclass(
+                    solverClass, _defining_class(cls, attr)):
+                return False
+        return True
+
     def find_dz(
             self, local_f, t, x0, y0, z0, a, b, c, invertNormal, derivOrder=0):
         """Returns the z or r difference (in the local system) between the ray
@@ -525,6 +680,28 @@ class OE(object):
             dz = (a*surf[-3] + b*surf[-2] + c*surf[-1]) * invertNormal
         return dz, x, y, z
 
+    def reset_intersection_stats(self):
+        """Zeroes the counters of :meth:`find_intersection` in the dict
+        *intersectionStats*: the numbers of calls, of rays, of rays solved in
+        closed form, of rays left to the numerical search, of surface and
+        normal evaluations, of unconverged rays and the maximum number of
+        iterations."""
+        with _statsLock:
+            self.intersectionStats = dict(
+                calls=0, rays=0, closedForm=0, searched=0, evaluations=0,
+                normals=0, unconverged=0, maxIterations=0)
+
+    def _add_intersection_stats(self, counts, numit):
+        """Adds the *counts* of one call of :meth:`find_intersection` to
+        *intersectionStats*. The counts are accumulated locally within the
+        call and added here once, under a lock, as the threads of a run
+        share the OE."""
+        with _statsLock:
+            stats = self.intersectionStats
+            for key, value in counts.items():
+                stats[key] += value
+            stats['maxIterations'] = max(stats['maxIterations'], numit)
+
     def find_intersection(self, local_f, t1, t2, x, y, z, a, b, c,
                           invertNormal, derivOrder=0):
         """Finds the ray parameter *t* at the intersection point with the
@@ -548,20 +725,39 @@ class OE(object):
         y2[ind1] = y1[ind1]
         z2[ind1] = z1[ind1]
         ind = ~(ind1 | ind2)  # good rays
-        if abs(dz2).max() > abs(dz1).max()*20:
+        counts = dict(calls=1, rays=len(ind), evaluations=2*len(ind),
+                      normals=0, unconverged=0)
+        nGood = ind.sum()
+        if nGood > 0 and self._closed_form_surface(local_f, derivOrder):
+            ind = self._use_closed_form(
+                local_f, t1, t2, x, y, z, a, b, c, invertNormal,
+                dz2, x2, y2, z2, ind, counts)
+        nSearched = ind.sum()
+        counts['closedForm'] = nGood - nSearched
+        counts['searched'] = nSearched
+        local_n = self._newton_normal(local_f, derivOrder)
+        numit = 0
+        if nSearched == 0:
+            pass
+        elif local_n is not None:
+            t2, x2, y2, z2, numit = self._use_Newton_method(
+                local_f, local_n, t1, t2, x, y, z, a, b, c, invertNormal,
+                dz1, dz2, tMin, tMax, x2, y2, z2, ind, counts)
+        elif abs(dz2).max() > abs(dz1).max()*20:
             t2, x2, y2, z2, numit = self._use_Brent_method(
                 local_f, t1, t2, x, y, z, a, b, c, invertNormal, derivOrder,
-                dz1, dz2, tMin, tMax, x2, y2, z2, ind)
+                dz1, dz2, tMin, tMax, x2, y2, z2, ind, counts)
         else:
             t2, x2, y2, z2, numit = self._use_my_method(
                 local_f, t1, t2, x, y, z, a, b, c, invertNormal, derivOrder,
-                dz1, dz2, tMin, tMax, x2, y2, z2, ind)
+                dz1, dz2, tMin, tMax, x2, y2, z2, ind, counts)
         if numit == raycing.maxIteration and raycing._VERBOSITY_ > 10:
             nn = ind.sum()
             print('maxIteration is reached for {0} ray{1}!!!'.format(
                   nn, 's' if nn > 1 else ''))
         if raycing._VERBOSITY_ > 10:
             print('numit=', numit)
+        self._add_intersection_stats(counts, numit)
         return t2, x2, y2, z2, ind1
 
     def find_intersection_CL(self, local_f, t1, t2, x, y, z, a, b, c,
@@ -610,35 +806,186 @@ class OE(object):
             None, NRAYS)
         return t2, x2, y2, z2
 
+    def _use_closed_form(self, local_f, t1, t2, x, y, z, a, b, c,
+                         invertNormal, dz2, x2, y2, z2, ind, counts):
+        """Puts the intersections given by :meth:`solve_intersection` into
+        *t2*, *dz2*, *x2*, *y2*, *z2* and returns the mask of the rays *ind*
+        that are left for the numerical search. The surface evaluations are
+        counted in the dict *counts* of :meth:`find_intersection`."""
+        iind = np.where(ind)[0]
+        roots = self.solve_intersection(
+            local_f, t1[iind], t2[iind], x[iind], y[iind], z[iind],
+            a[iind], b[iind], c[iind])
+        if roots is None:
+            return ind
+        t = first_root_in(roots, t1[iind], t2[iind])
+        found = np.isfinite(t)
+        iFound = iind[found]
+        t2[iFound] = t[found]
+        dz2[iFound], x2[iFound], y2[iFound], z2[iFound] = self.find_dz(
+            local_f, t[found], x[iFound], y[iFound], z[iFound],
+            a[iFound], b[iFound], c[iFound], invertNormal)
+        counts['evaluations'] += len(iFound)
+        ind = ind.copy()
+        ind[iFound] = False
+        return ind
+
     def _use_my_method(
         self, local_f, t1, t2, x, y, z, a, b, c, invertNormal, derivOrder,
-            dz1, dz2, tMin, tMax, x2, y2, z2, ind):
+            dz1, dz2, tMin, tMax, x2, y2, z2, ind, counts):
+        """Secant search for the rays *ind*. The unconverged rays are kept
+        in compact working arrays that shrink at every iteration; the
+        results of each ray are scattered back once, when it converges or
+        when *maxIteration* is reached. The surface evaluations and the
+        unconverged rays are counted in the dict *counts* of
+        :meth:`find_intersection`."""
         numit = 2
-        while (ind.sum() > 0) and (numit < raycing.maxIteration):
-            t = t1[ind]
-            dz = dz1[ind]
-            t1[ind] = t2[ind]
-            dz1[ind] = dz2[ind]
-            t2[ind] = t - (t1[ind]-t) * dz / (dz1[ind]-dz)
-            swap = t2[ind] < tMin
-            t2[np.where(ind)[0][swap]] = tMin
-            swap = t2[ind] > tMax
-            t2[np.where(ind)[0][swap]] = tMax
-            dz2[ind], x2[ind], y2[ind], z2[ind] = self.find_dz(
-                local_f, t2[ind], x[ind], y[ind], z[ind],
-                a[ind], b[ind], c[ind], invertNormal, derivOrder)
-            # swapping using duble slicing:
-            swap = np.sign(dz2[ind]) == np.sign(dz1[ind])
-            t1[np.where(ind)[0][swap]] = t[swap]
-            dz1[np.where(ind)[0][swap]] = dz[swap]
-            ind = ind & (abs(dz2) > raycing.zEps)
+        iact = np.where(ind)[0]
+        wx, wy, wz, wa, wb, wc, wt1, wt2, wdz1, wdz2, wx2, wy2, wz2 = [
+            arr[iact] for arr in
+            (x, y, z, a, b, c, t1, t2, dz1, dz2, x2, y2, z2)]
+        while (len(iact) > 0) and (numit < raycing.maxIteration):
+            t, dz = wt1, wdz1
+            wt1, wdz1 = wt2, wdz2
+            wt2 = t - (wt1-t) * dz / (wdz1-dz)
+            wt2[wt2 < tMin] = tMin
+            wt2[wt2 > tMax] = tMax
+            wdz2, wx2, wy2, wz2 = self.find_dz(
+                local_f, wt2, wx, wy, wz, wa, wb, wc, invertNormal,
+                derivOrder)
+            counts['evaluations'] += len(iact)
+            swap = np.sign(wdz2) == np.sign(wdz1)
+            wt1 = np.where(swap, t, wt1)
+            wdz1 = np.where(swap, dz, wdz1)
             numit += 1
+            going = abs(wdz2) > raycing.zEps
+            if going.all():
+                continue
+            done = ~going
+            _scatter((t1, t2, dz1, dz2, x2, y2, z2),
+                     (wt1, wt2, wdz1, wdz2, wx2, wy2, wz2), iact, done)
+            iact = iact[going]
+            wx, wy, wz, wa, wb, wc, wt1, wt2, wdz1, wdz2, wx2, wy2, wz2 = [
+                arr[going] for arr in
+                (wx, wy, wz, wa, wb, wc, wt1, wt2, wdz1, wdz2, wx2, wy2, wz2)]
+        counts['unconverged'] += len(iact)
+        _scatter((t1, t2, dz1, dz2, x2, y2, z2),
+                 (wt1, wt2, wdz1, wdz2, wx2, wy2, wz2), iact)
+# t2 holds the ray parameter at the intersection point
+        return t2, x2, y2, z2, numit
+
+    def _newton_normal(self, local_f, derivOrder=0):
+        """Returns the normal method that belongs to the surface *local_f*
+        if the Newton search is requested and possible, otherwise None."""
+        if derivOrder != 0 or \
+                str(getattr(self, 'intersectionSolver', 'auto')).lower() != \
+                'newton':
+            return
+        if local_f is None:
+            return self.local_n
+        if getattr(local_f, '__self__', None) is not self:
+            return
+        name = local_f.__name__
+        for surfName in ('local_z', 'local_r'):
+            if name.startswith(surfName):
+                return getattr(self, 'local_n' + name[len(surfName):], None)
+
+    def _distort_normal(self, oeNormal, x, y):
+        """Applies :meth:`local_n_distorted` at (*x*, *y*) to the surface
+        normal -- the last three components of the list *oeNormal*."""
+        n_distorted = self.local_n_distorted(x, y)
+        if n_distorted is not None:
+            if len(n_distorted) == 2:
+                cosX, sinX = np.cos(n_distorted[0]), np.sin(n_distorted[0])
+                oeNormal[-2], oeNormal[-1] = raycing.rotate_x(
+                    oeNormal[-2], oeNormal[-1], cosX, sinX)
+                cosY, sinY = np.cos(n_distorted[1]), np.sin(n_distorted[1])
+                oeNormal[-3], oeNormal[-1] = raycing.rotate_y(
+                    oeNormal[-3], oeNormal[-1], cosY, sinY)
+            elif len(n_distorted) == 3:
+                oeNormal[-3] += n_distorted[0]
+                oeNormal[-2] += n_distorted[1]
+                oeNormal[-1] += n_distorted[2]
+                norm = (oeNormal[-3]**2 + oeNormal[-2]**2 +
+                        oeNormal[-1]**2)**0.5
+                oeNormal[-3] /= norm
+                oeNormal[-2] /= norm
+                oeNormal[-1] /= norm
+            else:
+                raise ValueError(
+                    "wrong length returned by 'local_n_distorted'")
+        return oeNormal
+
+    def _newton_step(self, local_n, t, x, y, z, a, b, c, invertNormal,
+                     dz, u, v, w, counts):
+        """Returns the increment of *t* that brings the ray to the tangent
+        plane of the surface at the point below the ray. (*u*, *v*, *w*) are
+        the coordinates of the ray point as returned by :meth:`find_dz`,
+        i.e. (*s*, *phi*, *r*) for a parametric surface. The normal
+        evaluations are counted in the dict *counts*."""
+        n = self._distort_normal(list(local_n(u, v)), u, v)[-3:]
+        counts['normals'] += len(t)
+        if self.isParametric:
+            sx, sy, sz = self.param_to_xyz(u, v, w + dz*invertNormal)
+            toRay = (n[0]*(x + a*t - sx) + n[1]*(y + b*t - sy) +
+                     n[2]*(z + c*t - sz))
+        else:
+            toRay = n[2] * dz * invertNormal
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return -toRay / (n[0]*a + n[1]*b + n[2]*c)
+
+    def _use_Newton_method(
+        self, local_f, local_n, t1, t2, x, y, z, a, b, c, invertNormal,
+            dz1, dz2, tMin, tMax, x2, y2, z2, ind, counts):
+        """Newton search for the rays *ind* with the normals *local_n*.
+        Each ray keeps the interval [*t1*, *t2*] that brackets its
+        intersection; the first point is found by linear interpolation
+        between its ends and a Newton step that leaves the interval is
+        replaced by bisection. As in :meth:`_use_my_method`, the iterations
+        run over compact working arrays of the unconverged rays."""
+        iact = np.where(ind)[0]
+        wx, wy, wz, wa, wb, wc, lo, hi, flo, fhi = [
+            arr[iact] for arr in (x, y, z, a, b, c, t1, t2, dz1, dz2)]
+        wt = lo - (hi-lo) * flo / (fhi-flo)
+        wdz, wx2, wy2, wz2 = self.find_dz(
+            local_f, wt, wx, wy, wz, wa, wb, wc, invertNormal)
+        counts['evaluations'] += len(iact)
+        numit = 3
+        while True:
+            going = abs(wdz) > raycing.zEps
+            if not going.all():
+                _scatter((t1, t2, dz1, dz2, x2, y2, z2),
+                         (lo, wt, flo, wdz, wx2, wy2, wz2), iact, ~going)
+                iact = iact[going]
+                wx, wy, wz, wa, wb, wc, lo, hi, flo, fhi, wt, wdz, wx2, wy2,\
+                    wz2 = [arr[going] for arr in
+                           (wx, wy, wz, wa, wb, wc, lo, hi, flo, fhi, wt, wdz,
+                            wx2, wy2, wz2)]
+            if (len(iact) == 0) or (numit >= raycing.maxIteration):
+                break
+            above = wdz > 0
+            lo = np.where(above, wt, lo)
+            flo = np.where(above, wdz, flo)
+            hi = np.where(above, hi, wt)
+            fhi = np.where(above, fhi, wdz)
+            tNewton = wt + self._newton_step(
+                local_n, wt, wx, wy, wz, wa, wb, wc, invertNormal,
+                wdz, wx2, wy2, wz2, counts)
+            inside = (tNewton > lo) & (tNewton < hi)
+            wt = np.where(inside, tNewton, (lo+hi) / 2.)
+            wdz, wx2, wy2, wz2 = self.find_dz(
+                local_f, wt, wx, wy, wz, wa, wb, wc, invertNormal)
+            counts['evaluations'] += len(iact)
+            numit += 1
+        counts['unconverged'] += len(iact)
+        _scatter((t1, t2, dz1, dz2, x2, y2, z2),
+                 (lo, wt, flo, wdz, wx2, wy2, wz2), iact)
 # t2 holds the ray parameter at the intersection point
         return t2, x2, y2, z2, numit
 
     def _use_Brent_method(self, local_f, t1, t2, x, y, z, a, b, c,
                           invertNormal, derivOrder, dz1, dz2, tMin, tMax,
-                          x2, y2, z2, ind):
+                          x2, y2, z2, ind, counts):
         """Finds the ray parameter *t* at the intersection point with the
         surface. Requires *t1* and *t2* as input bracketing. The rays are
         determined by the origin points (*x*, *y*, *z*) and the normalized
@@ -653,23 +1000,29 @@ class OE(object):
 
         A description of the Brent's method can be found at
         http://en.wikipedia.org/wiki/Brent%27s_method.
+
+        As in :meth:`_use_my_method`, the iterations run over compact
+        working arrays of the unconverged rays, and the surface evaluations
+        and the unconverged rays are counted in the dict *counts*.
         """
-        swap = abs(dz1[ind]) < abs(dz2[ind])
+        iact = np.where(ind)[0]
+        xa, xb, fa, fb = t1[iact], t2[iact], dz1[iact], dz2[iact]
+        swap = abs(fa) < abs(fb)
         if swap.sum() > 0:
-            t1[np.where(ind)[0][swap]], t2[np.where(ind)[0][swap]] =\
-                t2[np.where(ind)[0][swap]], t1[np.where(ind)[0][swap]]
-            dz1[np.where(ind)[0][swap]], dz2[np.where(ind)[0][swap]] =\
-                dz2[np.where(ind)[0][swap]], dz1[np.where(ind)[0][swap]]
-        t3 = np.copy(t1)  # c:=a
-        dz3 = np.copy(dz1)  # f(c)
-        t4 = np.zeros_like(t1)  # d
-        mflag = np.ones_like(t1, dtype='bool')
+            xa[swap], xb[swap] = xb[swap], xa[swap]
+            fa[swap], fb[swap] = fb[swap], fa[swap]
+        going = abs(fb) > raycing.zEps
+        _scatter((t1, t2, dz1, dz2), (xa, xb, fa, fb), iact)
+        iact = iact[going]
+        xa, xb, fa, fb = xa[going], xb[going], fa[going], fb[going]
+        wx, wy, wz, wa, wb, wc, wx2, wy2, wz2 = [
+            arr[iact] for arr in (x, y, z, a, b, c, x2, y2, z2)]
+        xc = np.copy(xa)  # c:=a
+        fc = np.copy(fa)  # f(c)
+        xd = np.zeros_like(xa)  # d
+        mf = np.ones_like(xa, dtype='bool')
         numit = 2
-        ind = ind & (abs(dz2) > raycing.zEps)
-        while (ind.sum() > 0) and (numit < raycing.maxIteration):
-            xa, xb, xc, xd = t1[ind], t2[ind], t3[ind], t4[ind]
-            fa, fb, fc = dz1[ind], dz2[ind], dz3[ind]
-            mf = mflag[ind]
+        while (len(iact) > 0) and (numit < raycing.maxIteration):
             xs = np.empty_like(xa)
             inq = (fa != fc) & (fb != fc)
             if inq.sum() > 0:
@@ -701,12 +1054,12 @@ class OE(object):
             xs[conds] = (xa[conds] + xb[conds]) / 2.
             mf = conds
 
-            fs, x2[ind], y2[ind], z2[ind] = self.find_dz(
-                local_f, xs, x[ind], y[ind], z[ind], a[ind], b[ind], c[ind],
-                invertNormal, derivOrder)
-            xd[:] = xc[:]
-            xc[:] = xb[:]
-            fc[:] = fb[:]
+            fs, wx2, wy2, wz2 = self.find_dz(
+                local_f, xs, wx, wy, wz, wa, wb, wc, invertNormal, derivOrder)
+            counts['evaluations'] += len(iact)
+            xd = xc
+            xc = np.copy(xb)
+            fc = np.copy(fb)
             fafsNeg = ((fa < 0) & (fs > 0)) | ((fa > 0) & (fs < 0))
             xb[fafsNeg] = xs[fafsNeg]
             fb[fafsNeg] = fs[fafsNeg]
@@ -716,12 +1069,21 @@ class OE(object):
             swap = abs(fa) < abs(fb)
             xa[swap], xb[swap] = xb[swap], xa[swap]
             fa[swap], fb[swap] = fb[swap], fa[swap]
-            t1[ind], t2[ind], t3[ind], t4[ind] = xa, xb, xc, xd
-            dz1[ind], dz2[ind], dz3[ind] = fa, fb, fc
-            mflag[ind] = mf
 
-            ind = ind & (abs(dz2) > raycing.zEps)
             numit += 1
+            going = abs(fb) > raycing.zEps
+            if going.all():
+                continue
+            _scatter((t1, t2, dz1, dz2, x2, y2, z2),
+                     (xa, xb, fa, fb, wx2, wy2, wz2), iact, ~going)
+            iact = iact[going]
+            xa, xb, xc, xd, fa, fb, fc, mf, wx, wy, wz, wa, wb, wc, wx2, wy2,\
+                wz2 = [arr[going] for arr in
+                       (xa, xb, xc, xd, fa, fb, fc, mf, wx, wy, wz, wa, wb, wc,
+                        wx2, wy2, wz2)]
+        counts['unconverged'] += len(iact)
+        _scatter((t1, t2, dz1, dz2, x2, y2, z2),
+                 (xa, xb, fa, fb, wx2, wy2, wz2), iact)
 # t2 holds the ray parameter at the intersection point
         return t2, x2, y2, z2, numit
 
@@ -838,6 +1200,7 @@ class OE(object):
             raise ValueError('Unknown shape of OE {0}!'.format(self.name))
         return locState
 
+    @raycing.flow_outputs('beamGlobal', 'beamLocal')
     def reflect(self, beam=None, needLocal=True, noIntersectionSearch=False,
                 returnLocalAbsorbed=None):
         r"""
@@ -911,6 +1274,7 @@ class OE(object):
         self.footprint = []
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         self.get_orientation()
         # output beam in global coordinates
         gb = rs.Beam(copyFrom=beam)
@@ -949,6 +1313,7 @@ class OE(object):
         lb.parentId = self.name
         return gb, lb  # in global(gb) and local(lb) coordinates
 
+    @raycing.flow_outputs('beamGlobal', 'beamLocal')
     def multiple_reflect(
             self, beam=None, maxReflections=1000, needElevationMap=False,
             returnLocalAbsorbed=None):
@@ -956,6 +1321,12 @@ class OE(object):
         Does the same as :meth:`reflect` but with up to *maxReflections*
         reflection on the same surface.
 
+        The rays that stay on the surface after a reflection are traced
+        further as a compact beam that shrinks as the rays leave the surface,
+        so that the cost scales with the total number of reflections. The
+        returned local beam holds all the rays after the first reflection
+        followed by the rays active in each next reflection.
+
         The returned beam has additional fields: *nRefl* for the number of
         reflections, *elevationD* for the maximum elevation distance between
         the rays and the surface as the ray travels between the impact points,
@@ -971,6 +1342,7 @@ class OE(object):
         self.footprint = []
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         self.get_orientation()
 # output beam in global coordinates
         gb = rs.Beam(copyFrom=beam)
@@ -980,46 +1352,61 @@ class OE(object):
             return gb, lb
 # coordinates in local virgin system:
         raycing.global_to_virgin_local(self.bl, beam, lb, self.center, good)
-        iRefl = 0
-        isMulti = False
-        while iRefl < maxReflections:
-            tmpX, tmpY, tmpZ =\
-                np.copy(lb.x[good]), np.copy(lb.y[good]), np.copy(lb.z[good])
+        if raycing._VERBOSITY_ > 10:
+            print('reflection No 1')
+        tmpX, tmpY, tmpZ =\
+            np.copy(lb.x[good]), np.copy(lb.y[good]), np.copy(lb.z[good])
+        if needElevationMap:
+            lb.elevationD = -np.ones_like(lb.x)
+            lb.elevationX = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
+            lb.elevationY = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
+            lb.elevationZ = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
+        self._reflect_local(good, lb, gb, self.pitch,
+                            self.roll+self.positionRoll, self.yaw,
+                            self.dx, material=self.material,
+                            needElevationMap=needElevationMap)
+        lb.nRefl = np.zeros_like(lb.state)
+        ov = lb.state[good] == 3
+        lb.x[np.where(good)[0][ov]] = tmpX[ov]
+        lb.y[np.where(good)[0][ov]] = tmpY[ov]
+        lb.z[np.where(good)[0][ov]] = tmpZ[ov]
+        good = (lb.state == 1) | (lb.state == 2)
+        lb.nRefl[good] += 1
+        # all local footprints: all rays after the 1st reflection, then only
+        # the rays active in each next one
+        lbN = rs.Beam(copyFrom=lb, withNumberOfReflections=True)
+        reflectionLog = []
+        iRefl = 1
+# the next reflections are traced for the active rays only, in a compact beam
+# that shrinks as the rays leave the surface; the leaving rays are written
+# back to lb:
+        iActive = np.where(good)[0]
+        ab = rs.Beam(copyFrom=lb).filter_by_index(iActive)
+        while len(iActive) > 0 and iRefl < maxReflections:
             if raycing._VERBOSITY_ > 10:
                 print('reflection No {0}'.format(iRefl + 1))
-            if iRefl == 0:
-                if needElevationMap:
-                    lb.elevationD = -np.ones_like(lb.x)
-                    lb.elevationX = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
-                    lb.elevationY = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
-                    lb.elevationZ = -np.ones_like(lb.x)*raycing.maxHalfSizeOfOE
-            self._reflect_local(good, lb, gb, self.pitch,
-                                self.roll+self.positionRoll, self.yaw,
-                                self.dx, material=self.material,
+            tmpX, tmpY, tmpZ = np.copy(ab.x), np.copy(ab.y), np.copy(ab.z)
+            self._reflect_local(np.ones(len(iActive), dtype=bool), ab, ab,
+                                self.pitch, self.roll+self.positionRoll,
+                                self.yaw, self.dx, material=self.material,
                                 needElevationMap=needElevationMap,
-                                isMulti=isMulti)
-            if iRefl == 0:
-                isMulti = True
-                lb.nRefl = np.zeros_like(lb.state)
-            ov = lb.state[good] == 3
-            lb.x[np.where(good)[0][ov]] = tmpX[ov]
-            lb.y[np.where(good)[0][ov]] = tmpY[ov]
-            lb.z[np.where(good)[0][ov]] = tmpZ[ov]
-            good = (lb.state == 1) | (lb.state == 2)
-            lb.nRefl[good] += 1
-            if iRefl == 0:
-                # all local footprints:
-                lbN = rs.Beam(copyFrom=lb, withNumberOfReflections=True)
-            else:
-                lbN.concatenate(lb)
+                                isMulti=True)
+            ov = ab.state == 3
+            ab.x[ov], ab.y[ov], ab.z[ov] = tmpX[ov], tmpY[ov], tmpZ[ov]
+            active = (ab.state == 1) | (ab.state == 2)
+            ab.nRefl[active] += 1
+            reflectionLog.append(rs.Beam(copyFrom=ab))
             iRefl += 1
             if raycing._VERBOSITY_ > 10:
-                print('iRefl=', iRefl, 'remains=', good.sum())
-#                if good.sum() > 0:
-#                    print('y min max ', lb.y[good].min(), lb.y[good].max())
-            if good.sum() == 0:
-                break
-#            gc.collect()
+                print('iRefl=', iRefl, 'remains=', active.sum())
+            left = ~active
+            if left.any():
+                lb.scatter_rays(ab, iActive[left], left)
+                iActive = iActive[active]
+                ab.filter_by_index(active)
+        if len(iActive) > 0:
+            lb.scatter_rays(ab, iActive)
+        lbN.append_rays(reflectionLog)
 # in global coordinate system:
         goodAfter = gb.nRefl > 0
         gb.state[goodAfter] = 1
@@ -1107,12 +1494,13 @@ class OE(object):
         *nrays* of samples are randomly distributed over the surface within
         self.limPhysX limits.
         """
+        rng = raycing.get_rng()
         if rw is None:
             from . import waves as rw
 
         nrays = int(nrays)
         lb = rs.Beam(nrays=nrays, forceState=1, withAmplitudes=True)
-        xy = np.random.rand(nrays, 2)
+        xy = rng.random((nrays, 2))
         if shape == 'auto':
             shape = self.shape
         if shape.startswith('ro'):  # round
@@ -1287,10 +1675,11 @@ class OE(object):
 
     def _grating_deflection(
             self, goodN, lb, g, oeNormal, beamInDotNormal, order=1, sig=None):
+        rng = raycing.get_rng()
         beamInDotG = lb.a[goodN]*g[0] + lb.b[goodN]*g[1] + lb.c[goodN]*g[2]
         G2 = g[0]**2 + g[1]**2 + g[2]**2
         locOrder = order if isinstance(order, int) else \
-            np.array(order)[np.random.randint(len(order), size=goodN.sum())]
+            np.array(order)[rng.integers(len(order), size=goodN.sum())]
         lb.order = np.zeros(len(lb.a))
         lb.order[goodN] = locOrder
         orderLambda = locOrder * CH / lb.E[goodN] * 1e-7
@@ -1312,13 +1701,14 @@ class OE(object):
                   nanSum, strName, self.name))
 
     def local_n_random(self, bLength, chi):
+        rng = raycing.get_rng()
         a = np.zeros(bLength)
         b = np.zeros(bLength)
         c = np.ones(bLength)
 
-        cos_range = np.random.rand(bLength)  # * 2**-0.5
+        cos_range = rng.random(bLength)  # * 2**-0.5
         y_angle = np.arccos(cos_range)
-        z_angle = (chi[1]-chi[0]) * np.random.rand(bLength) + chi[0]
+        z_angle = (chi[1]-chi[0]) * rng.random(bLength) + chi[0]
 
         a, c = raycing.rotate_y(a, c, np.cos(y_angle), np.sin(y_angle))
         a, b = raycing.rotate_z(a, b, np.cos(z_angle), np.sin(z_angle))
@@ -1329,6 +1719,7 @@ class OE(object):
         return [a, b, c]
 
     def _reflect_crystal_cl(self, goodN, lb, matcr, oeNormal):
+        rng = raycing.get_rng()
         DW = self.cl_precisionF(matcr.factDW)
         thickness = self.cl_precisionF(0 if matcr.t is None else matcr.t)
         geometry = np.int32(matcr.geometry)
@@ -1389,7 +1780,7 @@ class OE(object):
                         self.cl_precisionF(oeNormal[-2]*bOnes),  # surfNormalY
                         self.cl_precisionF(oeNormal[-1]*bOnes)]  # surfNormalZ
 
-        slicedROArgs.extend([self.cl_precisionF(np.random.rand(lenGood))])
+        slicedROArgs.extend([self.cl_precisionF(rng.random(lenGood))])
 
         nonSlicedROArgs = [elements_in.flatten(),  # elements
                            f0_in.flatten(),  # f0
@@ -1409,6 +1800,7 @@ class OE(object):
         return a_out, b_out, c_out, curveS, curveP
 
     def _mosaic_normal(self, mat, oeNormal, beamInDotNormal, lb, goodN):
+        rng = raycing.get_rng()
         E = lb.E[goodN]
         theta = mat.get_Bragg_angle(E) - mat.get_dtheta(E)
 
@@ -1426,7 +1818,7 @@ class OE(object):
         n1c = cn*oeNormal[2] - ck*lb.c[goodN]
 
         # this simple solution does the same job as the one in Shadow:
-        phi = np.random.normal(0, mat.mosaicity, len(sinTheta))
+        phi = rng.normal(0, mat.mosaicity, len(sinTheta))
         # this is the Shadow's solution:
 #        import scipy.stats
 #        ss = sinAlpha*sinTheta  # sinTheta = cosThetaD
@@ -1452,7 +1844,7 @@ class OE(object):
 #        cosBeta[cosBeta > 1] = 1 - 1e-20
 
         sinBeta = (1 - cosBeta**2)**0.5
-        signs = np.random.randint(2, size=len(sinTheta))
+        signs = rng.integers(2, size=len(sinTheta))
         signs[signs == 0] = -1
         sinBeta *= signs
         ocosBeta = 1 - cosBeta
@@ -1473,6 +1865,7 @@ class OE(object):
         return [nra, nrb, nrc], beamInDotNormalN
 
     def _mosaic_length(self, mat, beamInDotNormal, lb, goodN):
+        rng = raycing.get_rng()
         Qs, Qp, thetaB = mat.get_kappa_Q(lb.E[goodN])[2:5]  # in cm^-1
         norm = lb.Jss[goodN] + lb.Jpp[goodN]
         norm[norm == 0] = 1.
@@ -1481,7 +1874,7 @@ class OE(object):
         w = np.exp(-0.5*delta**2 / mat.mosaicity**2) / (SQRT2PI*mat.mosaicity)
         rate = w*Q  # in cm^-1
         rate[rate <= 1e-3] = 1e-3
-        length = np.random.exponential(10./rate, size=len(Qs))  # in mm
+        length = rng.exponential(10./rate, size=len(Qs))  # in mm
         if mat.t:
             through = length*beamInDotNormal > mat.t
             length[through] = mat.t / beamInDotNormal[through]
@@ -1508,6 +1901,7 @@ class OE(object):
         :class:`Crystal` or its derivatives. Depending on the geometry used, it
         must have either the method :meth:`get_refractive_index` or the
         :meth:`get_amplitude`."""
+        rng = raycing.get_rng()
 
         def _get_asymmetric_reflection_grating(
                 _gNormal, _oeNormal, _beamInDotSurfaceNormal):
@@ -1530,7 +1924,7 @@ class OE(object):
                 if isinstance(self.order, int):
                     locOrder = self.order
                 else:
-                    locOrder = np.array(self.order)[np.random.randint(
+                    locOrder = np.array(self.order)[rng.integers(
                         len(self.order), size=goodN.sum())]
                 if _gNormal is None:
                     _gNormal = local_g(lb.x[goodN], lb.y[goodN])
@@ -1550,6 +1944,8 @@ class OE(object):
 # lb is truly local coordinates whereas vlb is in virgin local coordinates:
         if local_n is None:
             local_n = self.local_n
+        self.curDistortion = getattr(self, 'distortion2', None) if \
+            is2ndXtal else self.distortion
         raycing.rotate_beam(
             lb, good, rotationSequence=self.rotationSequence,
             pitch=-pitch, roll=-roll, yaw=-yaw)
@@ -1670,34 +2066,15 @@ class OE(object):
 #                n = matSur.get_refractive_index(lb.E[goodN])
 #                mu = abs(n.imag) * lb.E[goodN] / CHBAR * 2e8  # 1/cm
 #                att = np.exp(-mu * tMax[goodN] * 0.1)
-                depth = np.random.rand(len(lb.a[goodN])) * matSur.t
+                depth = rng.random(len(lb.a[goodN])) * matSur.t
                 lb.x[goodN] += lb.a[goodN] * depth
                 lb.y[goodN] += lb.b[goodN] * depth
                 lb.z[goodN] += lb.c[goodN] * depth
             else:
                 oeNormal = list(local_n(lb.x[goodN], lb.y[goodN]))
 
-            n_distorted = self.local_n_distorted(lb.x[goodN], lb.y[goodN])
-            if n_distorted is not None:
-                if len(n_distorted) == 2:
-                    cosX, sinX = np.cos(n_distorted[0]), np.sin(n_distorted[0])
-                    oeNormal[-2], oeNormal[-1] = raycing.rotate_x(
-                        oeNormal[-2], oeNormal[-1], cosX, sinX)
-                    cosY, sinY = np.cos(n_distorted[1]), np.sin(n_distorted[1])
-                    oeNormal[-3], oeNormal[-1] = raycing.rotate_y(
-                        oeNormal[-3], oeNormal[-1], cosY, sinY)
-                elif len(n_distorted) == 3:
-                    oeNormal[-3] += n_distorted[0]
-                    oeNormal[-2] += n_distorted[1]
-                    oeNormal[-1] += n_distorted[2]
-                    norm = (oeNormal[-3]**2 + oeNormal[-2]**2 +
-                            oeNormal[-1]**2)**0.5
-                    oeNormal[-3] /= norm
-                    oeNormal[-2] /= norm
-                    oeNormal[-1] /= norm
-                else:
-                    raise ValueError(
-                        "wrong length returned by 'local_n_distorted'")
+            oeNormal = self._distort_normal(
+                oeNormal, lb.x[goodN], lb.y[goodN])
             if toWhere < 5:
                 isAsymmetric = len(oeNormal) == 6
                 oeNormal = np.asarray(oeNormal, order='F')
@@ -2059,7 +2436,8 @@ class DCM(OE):
             perpendicular and longitudinal translations of the 2nd crystal in
             respect to the 1st one.
 
-        *limPhysX2*, *limPhysY2*, *limOptX2*, *limOptY2*, *material2*:
+        *limPhysX2*, *limPhysY2*, *limOptX2*, *limOptY2*, *material2*,
+        *distortion2*:
             refer to the 2nd crystal and are similar to the same parameters
             of the parent class :class:`OE` without the trailing "2".
 
@@ -2101,6 +2479,7 @@ class DCM(OE):
         self.limOptY2 = kwargs.pop('limOptY2', None)
         self.material = kwargs.get('material', None)
         self.material2 = kwargs.pop('material2', None)
+        self.distortion2 = kwargs.pop('distortion2', None)
         self.fixedOffset = kwargs.pop('fixedOffset', None)
         return kwargs
 
@@ -2126,6 +2505,12 @@ class DCM(OE):
             if raycing.is_sequence(self.limOptY2[0]):
                 self.surfOptY = (self.limOptY2[0][cs], self.limOptY2[1][cs])
 
+    closedFormSurfaces = ('local_z', 'local_z1', 'local_z2')
+
+    def solve_intersection(self, local_f, t1, t2, x, y, z, a, b, c):
+        """Both crystal surfaces are :meth:`local_z`, flat."""
+        return OE.solve_intersection(self, None, t1, t2, x, y, z, a, b, c)
+
     def local_z1(self, x, y):
         """Determines the normal vector of OE at (x, y) position."""
         # just flat:
@@ -2149,6 +2534,7 @@ class DCM(OE):
         if self.fixedOffset not in [0, None]:
             self.cryst2perpTransl = self.fixedOffset/2./np.cos(self.bragg)
 
+    @raycing.flow_outputs('beamGlobal', 'beamLocal1', 'beamLocal2')
     def double_reflect(self, beam=None, needLocal=True,
                        fromVacuum1=True, fromVacuum2=True,
                        returnLocalAbsorbed=None):
@@ -2168,6 +2554,7 @@ class DCM(OE):
         self.footprint = []
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         self.get_orientation()
         gb = rs.Beam(copyFrom=beam)  # output beam in global coordinates
         if needLocal:
@@ -112,6 +112,7 @@ class Screen(object):
     def expose_global(self, beam=None, onlyPositivePath=False):
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         glo = rs.Beam(copyFrom=beam)  # global
         with np.errstate(divide='ignore'):
             path = ((self.center[0]-beam.x) * self.y[0] +
@@ -132,6 +133,7 @@ class Screen(object):
         glo.z[:] = beam.z + path*beam.c
         return glo
 
+    @raycing.flow_outputs('beamLocal')
     def expose(self, beam=None, onlyPositivePath=False):
         """Exposes the screen to the beam. *beam* is in global system, the
         returned beam is in local system of the screen and represents the
@@ -142,6 +144,7 @@ class Screen(object):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         blo = rs.Beam(copyFrom=beam, withNumberOfReflections=True)  # local
         # Converting the beam to the screen local coordinates
         blo.x[:] = beam.x[:] - self.center[0]
@@ -364,11 +367,13 @@ class HemisphericScreen(Screen):
     def expose_global(self, beam=None):
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         glo = self.expose(beam)
         _, _, _, glo.x[:], glo.y[:], glo.z[:] = \
             self.local_to_global(glo.phi, glo.theta)
         return glo
 
+    @raycing.flow_outputs('beamLocal')
     def expose(self, beam=None, onlyPositivePath=False):
         """Exposes the screen to the beam. *beam* is in global system, the
         returned beam is in local system of the screen and represents the
@@ -379,6 +384,7 @@ class HemisphericScreen(Screen):
         """
         if self.bl is not None:
             self.bl.auto_align(self, beam)
+            self.bl.compact_rays(beam)
         blo = rs.Beam(copyFrom=beam, withNumberOfReflections=True)  # local
         sqb_2 = (beam.a * (beam.x-self.center[0]) +
                  beam.b * (beam.y-self.center[1]) +
@@ -27,6 +27,10 @@ components of the coherency matrix of different rays are simply added.
    :members: __init__
 .. autoclass:: HermiteGaussianBeam
    :members: __init__
+.. autoclass:: BeamFile
+   :members: load
+.. autoclass:: BeamFileSource()
+   :members: __init__
 
 .. autofunction:: make_energy
 .. autofunction:: make_polarization
@@ -573,10 +577,10 @@ special definition of the beam size.
 __author__ = "Konstantin Klementiev", "Roman Chernikov"
 __date__ = "03 Jul 2016"
 __all__ = ('GeometricSource', 'MeshSource', 'BendingMagnet', 'Wiggler',
-           'Undulator')
+           'Undulator', 'BeamFileSource')
 
 from .sources_beams import Beam, copy_beam, rotate_coherency_matrix,\
-    defaultEnergy
+    defaultEnergy, BeamFile, BeamFileSource
 from .sources_geoms import GeometricSource, MeshSource, NESWSource,\
     CollimatedMeshSource, shrink_source, make_energy, make_polarization,\
     GaussianBeam, LaguerreGaussianBeam, HermiteGaussianBeam
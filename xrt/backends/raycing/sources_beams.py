@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 __author__ = "Konstantin Klementiev", "Roman Chernikov"
 __date__ = "12 Apr 2016"
+import os
+import json
+import inspect
+import threading
 import numpy as np
 import pickle
 from .. import raycing
@@ -22,6 +26,70 @@ allArguments = ('bl', 'name', 'center', 'pitch', 'yaw', 'nrays',
                 'autoAppendToBL', 'customField', 'gp', 'gIntervals', 'nRK',
                 'targetOpenCL', 'precisionOpenCL')
 
+# per-ray fields of Beam, grouped by the dtype of their buffer
+floatFields = ('x', 'y', 'z', 'a', 'b', 'c', 'path', 'E', 'Jss', 'Jpp',
+               'elevationD', 'elevationX', 'elevationY', 'elevationZ',
+               's', 'phi', 'r', 'theta', 'order')
+complexFields = ('Jsp', 'Es', 'Ep')
+intFields = ('state', 'nRefl', 'rayId')
+fieldGroups = ((float, floatFields), (complex, complexFields),
+               (int, intFields))
+# scalars of Beam stored in the header of a column file; summed on appending
+columnScalars = ('accepted', 'acceptedE', 'seeded', 'seededI')
+columnHeader = 'header.json'
+columnExtension = '.xrtbeam'
+_positionLock = threading.Lock()  # reading position of BeamFileSource
+
+
+def _block_index(rows, indarr):
+    """Index of *rows* x *indarr* in a 2D buffer. Contiguous rows are
+    given as a slice, so that the selection stays a single basic/advanced
+    indexing operation."""
+    if rows == list(range(rows[0], rows[-1]+1)):
+        return slice(rows[0], rows[-1]+1), indarr
+    if isinstance(indarr, slice):
+        return rows, indarr
+    return np.ix_(rows, np.asarray(indarr))
+
+
+def _count_selected(indarr, nrays):
+    if isinstance(indarr, slice):
+        return len(range(*indarr.indices(nrays)))
+    indarr = np.asarray(indarr)
+    if indarr.dtype == bool:
+        return np.count_nonzero(indarr)
+    return indarr.size
+
+
+class _BeamField(object):
+    """A per-ray array of :class:`Beam`. It is stored as a row of a 2D
+    buffer of the beam; reading returns a view of that row, assigning an
+    array of the beam length (or a scalar) makes a new row of it. An array
+    of another length is kept aside as a plain array."""
+
+    def __init__(self, name, dtype):
+        self.name = name
+        self.dtype = dtype
+
+    def __get__(self, beam, owner=None):
+        if beam is None:
+            return self
+        if self.name in beam._detached:
+            return beam._detached[self.name]
+        try:
+            iblock, row = beam._fields[self.name]
+        except KeyError:
+            raise AttributeError(
+                "the beam has no field '{0}'".format(self.name))
+        return beam._blocks[iblock][row]
+
+    def __set__(self, beam, value):
+        beam._set_field(self.name, self.dtype, value)
+
+    def __delete__(self, beam):
+        if not beam._drop_field(self.name):
+            raise AttributeError(self.name)
+
 
 class Beam(object):
     """Container for the beam arrays. *x, y, z* give the starting points.
@@ -38,10 +106,32 @@ class Beam(object):
     highest elevation points. If an OE uses a parametric representation,
     *s*, *phi*, *r* arrays store the impact points in the parametric
     coordinates.
+
+    The per-ray arrays are rows of 2D (fields x rays) buffers, one buffer
+    per dtype (float, complex and int for *state* and *nRefl*); the
+    attributes are views of these rows. Assigning a whole new array (or a
+    scalar) to a field gives it a new buffer row, as with plain attributes:
+    the arrays taken from the field before keep their values. Filtering,
+    copying and concatenation gather all fields of a dtype into one
+    contiguous buffer in a single array operation per block. A field that
+    has not been allocated raises AttributeError, so ``hasattr(beam, 'Es')``
+    works as with plain attributes.
+
+    ``Beam(copyFrom=beam)`` is an independent copy, gathered into one
+    contiguous buffer per dtype.
+
+    :meth:`drop_lost_rays` removes the rays with negative *state* from the
+    beam, see *compactRays* of :class:`BeamLine`. The remaining rays get
+    *rayId*, their indices in the uncompacted beam, and the numbers of the
+    dropped rays are kept per state in the dictionary *droppedStates*.
     """
     def __init__(self, nrays=raycing.nrays, copyFrom=None, forceState=False,
                  withNumberOfReflections=False, withAmplitudes=False,
                  xyzOnly=False, bl=None):
+        self._blocks = []
+        self._fields = {}
+        self._detached = {}
+        self._nrays = None
         self.listOfAttrs = ['x', 'y', 'z', 'sourceSIGMAx', 'sourceSIGMAz',
                             'filamentDX', 'filamentDZ', 'filamentDtheta',
                             'filamentDpsi', 'state', 'a', 'b', 'c', 'path',
@@ -52,9 +142,17 @@ class Beam(object):
                             'area', 'nRefl']
         if type(copyFrom) == type(self):
             try:
+                self._compact(source=copyFrom)
+                self._detached = dict(
+                    (name, np.copy(value)) for name, value in
+                    copyFrom._detached.items())
                 for attr in self.listOfAttrs:
+                    if attr in self._fieldTypes:
+                        continue
                     if hasattr(copyFrom, attr):
                         setattr(self, attr, np.copy(getattr(copyFrom, attr)))
+                if hasattr(copyFrom, 'droppedStates'):
+                    self.droppedStates = dict(copyFrom.droppedStates)
 #                if not withNumberOfReflections and hasattr(self, 'nRefl'):
 #                    delattr(self, 'nRefl')
             except:
@@ -62,15 +160,22 @@ class Beam(object):
                 copyFrom = None
         elif isinstance(copyFrom, raycing.basestring):
             try:
-                if copyFrom.endswith('mat'):
+                if os.path.isdir(copyFrom):
+                    beamFile = BeamFile(copyFrom)
+                    for key in columnScalars:
+                        if key in beamFile.header:
+                            setattr(self, key, beamFile.header[key])
+                    self._load_columns(beamFile)
+                elif copyFrom.endswith('mat'):
                     import scipy.io as io
-                    self.__dict__.update(io.loadmat(copyFrom))
+                    self._update(io.loadmat(copyFrom))
                 elif copyFrom.endswith('npy'):
-                    self.__dict__.update(np.load(copyFrom).item())
+                    self._update(np.load(copyFrom).item())
                 else:
                     pickleFile = open(copyFrom, 'rb')
-                    self.__dict__.update(pickle.load(pickleFile))
+                    self._update(pickle.load(pickleFile))
                     pickleFile.close()
+                self._compact()
                 for key in ['fromOE', 'toOE', 'parentId']:
                     if hasattr(self, key):
                         if bl is not None:
@@ -90,41 +195,167 @@ class Beam(object):
         elif copyFrom is None:
             # coordinates of starting points
             nrays = np.long(nrays)
-            self.x = np.zeros(nrays)
-            self.y = np.zeros(nrays)
-            self.z = np.zeros(nrays)
-            if not xyzOnly:
+            if xyzOnly:
+                self._allocate(floatFields[:3], float, nrays)
+            else:
+                self._allocate(floatFields[:10], float, nrays)
                 self.sourceSIGMAx = 0.
                 self.sourceSIGMAz = 0.
                 self.filamentDtheta = 0.
                 self.filamentDpsi = 0.
                 self.filamentDX = 0.
                 self.filamentDZ = 0.
-                self.state = np.zeros(nrays, dtype=np.int)
+                self._allocate(('state',), int, nrays)
                 # components of direction
-                self.a = np.zeros(nrays)
-                self.b = np.ones(nrays)
-                self.c = np.zeros(nrays)
-                # total ray path
-                self.path = np.zeros(nrays)
+                self.b[:] = 1.
                 # energy
-                self.E = np.ones(nrays) * defaultEnergy
+                self.E[:] = defaultEnergy
                 # components of coherency matrix
-                self.Jss = np.ones(nrays)
-                self.Jpp = np.zeros(nrays)
-                self.Jsp = np.zeros(nrays, dtype=complex)
+                self.Jss[:] = 1.
                 if withAmplitudes:
-                    self.Es = np.zeros(nrays, dtype=complex)
-                    self.Ep = np.zeros(nrays, dtype=complex)
+                    self._allocate(complexFields, complex, nrays)
+                else:
+                    self._allocate(('Jsp',), complex, nrays)
         if type(forceState) == int:
             self.state[:] = forceState
 
-    def export_beam(self, fileName, fformat='npy'):
+    _fieldTypes = dict((name, dtype) for dtype, names in fieldGroups
+                       for name in names)
+
+    def _allocate(self, names, dtype, nrays):
+        """Appends a zeroed buffer block of *dtype* with a row per field in
+        *names*."""
+        self._append_block(
+            np.zeros((len(names), nrays), dtype=dtype), names)
+
+    def _append_block(self, block, names):
+        """Appends the 2D *block* holding the fields *names* as rows."""
+        self._blocks.append(block)
+        iblock = len(self._blocks) - 1
+        for row, name in enumerate(names):
+            self._fields[name] = iblock, row
+        self._nrays = block.shape[1]
+
+    def _release(self, name):
+        """Gives back the buffer row of the field *name*. A block that is
+        no more used by the beam is dropped from it."""
+        iblock, row = self._fields.pop(name)
+        if all(ib != iblock for ib, r in self._fields.values()):
+            self._blocks[iblock] = None
+
+    def _drop_field(self, name):
+        """Forgets the field *name*."""
+        inBuffer = name in self._fields
+        if inBuffer:
+            self._release(name)
+        return self._detached.pop(name, None) is not None or inBuffer
+
+    def _set_field(self, name, dtype, value):
+        arr = np.asarray(value)
+        if self._nrays is None and arr.ndim == 1:
+            self._nrays = len(arr)
+        if (self._nrays is None) or (arr.ndim > 0 and
+                                     arr.shape != (self._nrays,)):
+            self._drop_field(name)
+            self._detached[name] = value
+            return
+        # a whole new value rebinds the field as a plain attribute would do:
+        # the views of the former array keep their values
+        self._drop_field(name)
+        if arr.ndim == 0:
+            self._allocate((name,), dtype, self._nrays)
+            self._blocks[-1][0] = arr
+        else:
+            self._append_block(
+                np.asarray(arr, dtype=dtype)[np.newaxis],
+                (name,))
+
+    def _update(self, fromDict):
+        for key, value in fromDict.items():
+            setattr(self, key, value)
+
+    def _gather(self, names, out, indarr=slice(None)):
+        """Copies the fields *names* for the rays *indarr* into the rows of
+        the 2D array *out*. Rows of one buffer block are copied by a single
+        array operation. The rows of absent fields are left untouched."""
+        byBlock = {}
+        for iname, name in enumerate(names):
+            if name in self._fields:
+                iblock, row = self._fields[name]
+                rows, inames = byBlock.setdefault(iblock, ([], []))
+                rows.append(row)
+                inames.append(iname)
+        for iblock, (rows, inames) in byBlock.items():
+            block = self._blocks[iblock]
+            outIndex = _block_index(inames, slice(None))
+            if rows == list(range(len(block))):
+                out[outIndex] = block[:, indarr]
+            else:
+                out[outIndex] = block[_block_index(rows, indarr)]
+
+    def _set_buffers(self, blocks, blockNames, nrays):
+        """Replaces the per-ray fields by the rows of the new *blocks*."""
+        self._blocks, self._fields = [], {}
+        for block, names in zip(blocks, blockNames):
+            self._blocks.append(block)
+            for row, name in enumerate(names):
+                self._fields[name] = len(self._blocks) - 1, row
+        self._nrays = nrays
+
+    def _compact(self, indarr=slice(None), source=None):
+        """Keeps the rays *indarr* of the beam *source* (of *self* if None)
+        and puts all fields of a dtype into one contiguous buffer."""
+        if source is None:
+            source = self
+        if source._nrays is None:
+            return
+        nrays = _count_selected(indarr, source._nrays)
+        blocks, blockNames = [], []
+        for dtype, groupNames in fieldGroups:
+            names = [name for name in groupNames if name in source._fields]
+            if not names:
+                continue
+            block = np.empty((len(names), nrays), dtype=dtype)
+            source._gather(names, block, indarr)
+            blocks.append(block)
+            blockNames.append(names)
+        self._set_buffers(blocks, blockNames, nrays)
+
+    def _rows_view(self, names):
+        """Returns a 2D view of the buffer rows of the fields *names* if
+        they are consecutive rows of one block, otherwise None."""
+        if any(name not in self._fields for name in names):
+            return
+        iblock, row0 = self._fields[names[0]]
+        for iname, name in enumerate(names):
+            if self._fields[name] != (iblock, row0 + iname):
+                return
+        return self._blocks[iblock][row0:row0+len(names)]
+
+    def export_beam(self, fileName, fformat='npy', append=False):
         """Saves the *beam* to a binary file. File format can be Numpy 'npy',
-        Matlab 'mat' or python 'pickle'. Matlab format should not be used for
-        future imports in xrt as it does not allow correct load."""
-        outputDict = dict()
-        outputDict.update(self.__dict__)
+        Matlab 'mat', python 'pickle' or 'columns'. Matlab format should not
+        be used for future imports in xrt as it does not allow correct load.
+
+        The 'columns' format is a directory (with the extension '.xrtbeam')
+        holding a raw binary file per ray field and a small json header with
+        the field dtypes, the number of rays and the acceptance scalars. If
+        *append* is True, the rays are appended to an existing directory,
+        e.g. from successive repeats, which must have the same fields. The
+        file is read by :class:`BeamFile` that maps the fields into memory
+        only when they are accessed, or by ``Beam(copyFrom=dirName)``, or is
+        replayed by :class:`BeamFileSource`."""
+        if str(fformat).lower() in ['columns', 'column', 'xrtbeam']:
+            if not fileName.endswith(columnExtension):
+                fileName += columnExtension
+            self._export_columns(fileName, append)
+            return
+
+        outputDict = dict((key, value) for key, value in self.__dict__.items()
+                          if not key.startswith('_'))
+        for name in self._fields:
+            outputDict[name] = getattr(self, name)
+        outputDict.update(self._detached)
         for key in ['fromOE', 'toOE', 'parentId']:
             if hasattr(self, key):
                 try:
@@ -157,42 +388,81 @@ class Beam(object):
             except:
                 print("Can't save the beam to", str(fileName))
 
+    def _export_columns(self, dirName, append):
+        names = [name for dtype, groupNames in fieldGroups
+                 for name in groupNames if name in self._fields]
+        headerName = os.path.join(dirName, columnHeader)
+        if append and os.path.exists(headerName):
+            with open(headerName, 'r') as f:
+                header = json.load(f)
+            if sorted(header['fields']) != sorted(names):
+                raise ValueError(
+                    'the fields of the beam differ from those in {0}'.format(
+                        dirName))
+            mode = 'ab'
+        else:
+            if not os.path.exists(dirName):
+                os.makedirs(dirName)
+            header = {'version': 1, 'nrays': 0, 'chunks': [],
+                      'fields': dict((name, np.dtype(getattr(
+                          self, name).dtype).str) for name in names)}
+            mode = 'wb'
+        for name in names:
+            with open(os.path.join(dirName, name + '.raw'), mode) as f:
+                getattr(self, name).astype(header['fields'][name]).tofile(f)
+        for key in columnScalars:
+            if hasattr(self, key):
+                header[key] = header.get(key, 0) + float(getattr(self, key))
+        header['nrays'] += self._nrays
+        header['chunks'].append(self._nrays)
+        with open(headerName, 'w') as f:
+            json.dump(header, f, indent=1)
+
+    def _load_columns(self, beamFile, names=None, start=0, stop=None):
+        """Fills the beam with the rays [*start*:*stop*] of the fields
+        *names* (all if None) of :class:`BeamFile` *beamFile*."""
+        if names is None:
+            names = beamFile.fields
+        start, stop, _ = slice(start, stop).indices(beamFile.nrays)
+        nrays = max(stop - start, 0)
+        blocks, blockNames = [], []
+        for dtype, groupNames in fieldGroups:
+            group = [name for name in groupNames if name in names]
+            if not group:
+                continue
+            block = np.empty((len(group), nrays), dtype=dtype)
+            for row, name in enumerate(group):
+                block[row] = beamFile[name][start:stop]
+            blocks.append(block)
+            blockNames.append(group)
+        self._set_buffers(blocks, blockNames, nrays)
+
     def concatenate(self, beam):
         """Adds *beam* to *self*. Useful when more than one source is
-        presented."""
-        self.state = np.concatenate((self.state, beam.state))
-        self.x = np.concatenate((self.x, beam.x))
-        self.y = np.concatenate((self.y, beam.y))
-        self.z = np.concatenate((self.z, beam.z))
-        self.a = np.concatenate((self.a, beam.a))
-        self.b = np.concatenate((self.b, beam.b))
-        self.c = np.concatenate((self.c, beam.c))
-        self.path = np.concatenate((self.path, beam.path))
-        self.E = np.concatenate((self.E, beam.E))
-        self.Jss = np.concatenate((self.Jss, beam.Jss))
-        self.Jpp = np.concatenate((self.Jpp, beam.Jpp))
-        self.Jsp = np.concatenate((self.Jsp, beam.Jsp))
-        if hasattr(self, 'nRefl') and hasattr(beam, 'nRefl'):
-            self.nRefl = np.concatenate((self.nRefl, beam.nRefl))
-        if hasattr(self, 'elevationD') and hasattr(beam, 'elevationD'):
-            self.elevationD = np.concatenate(
-                (self.elevationD, beam.elevationD))
-            self.elevationX = np.concatenate(
-                (self.elevationX, beam.elevationX))
-            self.elevationY = np.concatenate(
-                (self.elevationY, beam.elevationY))
-            self.elevationZ = np.concatenate(
-                (self.elevationZ, beam.elevationZ))
-        if hasattr(self, 's') and hasattr(beam, 's'):
-            self.s = np.concatenate((self.s, beam.s))
-        if hasattr(self, 'phi') and hasattr(beam, 'phi'):
-            self.phi = np.concatenate((self.phi, beam.phi))
-        if hasattr(self, 'r') and hasattr(beam, 'r'):
-            self.r = np.concatenate((self.r, beam.r))
-        if hasattr(self, 'theta') and hasattr(beam, 'theta'):
-            self.theta = np.concatenate((self.theta, beam.theta))
-        if hasattr(self, 'order') and hasattr(beam, 'order'):
-            self.order = np.concatenate((self.order, beam.order))
+        presented. A field present in only one of the two beams is padded
+        with zeros for the rays of the other one."""
+        n1, n2 = self._nrays, beam._nrays
+        if 'rayId' in self._fields or 'rayId' in beam._fields:
+            rayId = [b.rayId if 'rayId' in b._fields else np.arange(b._nrays)
+                     for b in (self, beam)]
+            rayId[1] = rayId[1] + n1 + sum(
+                getattr(self, 'droppedStates', {}).values())
+        else:
+            rayId = None
+        blocks, blockNames = [], []
+        for dtype, groupNames in fieldGroups:
+            names = [name for name in groupNames
+                     if name in self._fields or name in beam._fields]
+            if not names:
+                continue
+            block = np.zeros((len(names), n1+n2), dtype=dtype)
+            self._gather(names, block[:, :n1])
+            beam._gather(names, block[:, n1:])
+            blocks.append(block)
+            blockNames.append(names)
+        self._set_buffers(blocks, blockNames, n1 + n2)
+        if rayId is not None:
+            self.rayId[:n1], self.rayId[n1:] = rayId
         if hasattr(self, 'accepted') and hasattr(beam, 'accepted'):
             seeded = self.seeded + beam.seeded
             self.accepted = (self.accepted / self.seeded +
@@ -201,81 +471,71 @@ class Beam(object):
                               beam.acceptedE / beam.seeded) * seeded
             self.seeded = seeded
             self.seededI = self.seededI + beam.seededI
-        if hasattr(self, 'Es') and hasattr(beam, 'Es'):
-            self.Es = np.concatenate((self.Es, beam.Es))
-            self.Ep = np.concatenate((self.Ep, beam.Ep))
+        if hasattr(beam, 'droppedStates'):
+            droppedStates = getattr(self, 'droppedStates', {})
+            for state, count in beam.droppedStates.items():
+                droppedStates[state] = droppedStates.get(state, 0) + count
+            self.droppedStates = droppedStates
+
+    def append_rays(self, beams):
+        """Appends the rays of the sequence *beams* to *self*, allocating the
+        buffers once for all of them. A field present in only some of the
+        beams is padded with zeros for the rays of the others. Unlike
+        :meth:`concatenate`, the ray ids and the scalars, e.g. *accepted*,
+        stay those of *self*."""
+        beams = [self] + list(beams)
+        nrays = [beam._nrays for beam in beams]
+        starts = np.cumsum([0] + nrays)
+        blocks, blockNames = [], []
+        for dtype, groupNames in fieldGroups:
+            names = [name for name in groupNames
+                     if any(name in beam._fields for beam in beams)]
+            if not names:
+                continue
+            block = np.zeros((len(names), starts[-1]), dtype=dtype)
+            for beam, start, stop in zip(beams, starts[:-1], starts[1:]):
+                beam._gather(names, block[:, start:stop])
+            blocks.append(block)
+            blockNames.append(names)
+        self._set_buffers(blocks, blockNames, starts[-1])
+        return self
+
+    def scatter_rays(self, beam, indarr, indarrFrom=slice(None)):
+        """Writes the rays *indarrFrom* of *beam* to the rays *indarr* of
+        *self*. The fields of *beam* absent in *self* are added to it as
+        zeros."""
+        for name in beam._fields:
+            if name not in self._fields:
+                self._allocate((name,), self._fieldTypes[name], self._nrays)
+        _copy_fields(self, beam, list(beam._fields), indarr, indarrFrom)
+        return self
 
     def filter_by_index(self, indarr):
-        self.state = self.state[indarr]
-        self.x = self.x[indarr]
-        self.y = self.y[indarr]
-        self.z = self.z[indarr]
-        self.a = self.a[indarr]
-        self.b = self.b[indarr]
-        self.c = self.c[indarr]
-        self.path = self.path[indarr]
-        self.E = self.E[indarr]
-        self.Jss = self.Jss[indarr]
-        self.Jpp = self.Jpp[indarr]
-        self.Jsp = self.Jsp[indarr]
-        if hasattr(self, 'nRefl'):
-            self.nRefl = self.nRefl[indarr]
-        if hasattr(self, 'elevationD'):
-            self.elevationD = self.elevationD[indarr]
-            self.elevationX = self.elevationX[indarr]
-            self.elevationY = self.elevationY[indarr]
-            self.elevationZ = self.elevationZ[indarr]
-        if hasattr(self, 's'):
-            self.s = self.s[indarr]
-        if hasattr(self, 'phi'):
-            self.phi = self.phi[indarr]
-        if hasattr(self, 'r'):
-            self.r = self.r[indarr]
-        if hasattr(self, 'theta'):
-            self.theta = self.theta[indarr]
-        if hasattr(self, 'order'):
-            self.order = self.order[indarr]
-        if hasattr(self, 'Es'):
-            self.Es = self.Es[indarr]
-            self.Ep = self.Ep[indarr]
+        self._compact(indarr)
         return self
 
     def replace_by_index(self, indarr, beam):
-        self.state[indarr] = beam.state[indarr]
-        self.x[indarr] = beam.x[indarr]
-        self.y[indarr] = beam.y[indarr]
-        self.z[indarr] = beam.z[indarr]
-        self.a[indarr] = beam.a[indarr]
-        self.b[indarr] = beam.b[indarr]
-        self.c[indarr] = beam.c[indarr]
-        self.path[indarr] = beam.path[indarr]
-        self.E[indarr] = beam.E[indarr]
-        self.Jss[indarr] = beam.Jss[indarr]
-        self.Jpp[indarr] = beam.Jpp[indarr]
-        self.Jsp[indarr] = beam.Jsp[indarr]
-        if hasattr(self, 'nRefl') and hasattr(beam, 'nRefl'):
-            self.nRefl[indarr] = beam.nRefl[indarr]
-        if hasattr(self, 'elevationD') and hasattr(beam, 'elevationD'):
-            self.elevationD[indarr] = beam.elevationD[indarr]
-            self.elevationX[indarr] = beam.elevationX[indarr]
-            self.elevationY[indarr] = beam.elevationY[indarr]
-            self.elevationZ[indarr] = beam.elevationZ[indarr]
-        if hasattr(self, 's') and hasattr(beam, 's'):
-            self.s[indarr] = beam.s[indarr]
-        if hasattr(self, 'phi') and hasattr(beam, 'phi'):
-            self.phi[indarr] = beam.phi[indarr]
-        if hasattr(self, 'r') and hasattr(beam, 'r'):
-            self.r[indarr] = beam.r[indarr]
-        if hasattr(self, 'theta') and hasattr(beam, 'theta'):
-            self.theta[indarr] = beam.theta[indarr]
-        if hasattr(self, 'order') and hasattr(beam, 'order'):
-            self.order[indarr] = beam.order[indarr]
-        if hasattr(self, 'Es') and hasattr(beam, 'Es'):
-            self.Es[indarr] = beam.Es[indarr]
-        if hasattr(self, 'Ep') and hasattr(beam, 'Ep'):
-            self.Ep[indarr] = beam.Ep[indarr]
+        _copy_fields(self, beam, self._fieldTypes, indarr)
         return self
 
+    def drop_lost_rays(self):
+        """Removes the rays with negative *state* from the beam in place.
+        The kept rays get *rayId* (if not yet present), and the numbers of
+        the removed rays are added per state to *droppedStates*."""
+        if 'state' not in self._fields:
+            return self
+        lost = self.state < 0
+        if not lost.any():
+            return self
+        if 'rayId' not in self._fields:
+            self.rayId = np.arange(self._nrays)
+        droppedStates = getattr(self, 'droppedStates', {})
+        states, counts = np.unique(self.state[lost], return_counts=True)
+        for state, count in zip(states.tolist(), counts.tolist()):
+            droppedStates[state] = droppedStates.get(state, 0) + count
+        self.droppedStates = droppedStates
+        return self.filter_by_index(~lost)
+
     def filter_good(self):
         return self.filter_by_index(self.state == 1)
 
@@ -309,36 +569,56 @@ class Beam(object):
         simultaneous ray tracing of white beam and monochromatic beam parts of
         a beamline.
         """
-        self.E[:] = np.random.uniform(EnewMin, EnewMax, len(self.E))
+        rng = raycing.get_rng()
+        self.E[:] = rng.uniform(EnewMin, EnewMax, len(self.E))
 
     def diffract(self, wave):
         from . import waves as rw
         return rw.diffract(self, wave)
 
 
+for _dtype, _names in fieldGroups:
+    for _name in _names:
+        setattr(Beam, _name, _BeamField(_name, _dtype))
+
+
+def _copy_fields(beamTo, beamFrom, names, indarr, indarrFrom=None):
+    """Copies the fields *names* present in both beams for the rays
+    *indarr* (taken from the rays *indarrFrom* of *beamFrom* if given). The
+    fields lying in the same buffer blocks of the two beams are copied by one
+    array operation per block pair."""
+    if indarrFrom is None:
+        indarrFrom = indarr
+    byBlocks = {}
+    for name in names:
+        if name in beamTo._fields and name in beamFrom._fields:
+            iblockTo, rowTo = beamTo._fields[name]
+            iblockFrom, rowFrom = beamFrom._fields[name]
+            rowsTo, rowsFrom = byBlocks.setdefault(
+                (iblockTo, iblockFrom), ([], []))
+            rowsTo.append(rowTo)
+            rowsFrom.append(rowFrom)
+        elif hasattr(beamTo, name) and hasattr(beamFrom, name):
+            getattr(beamTo, name)[indarr] = \
+                getattr(beamFrom, name)[indarrFrom]
+    for (iblockTo, iblockFrom), (rowsTo, rowsFrom) in byBlocks.items():
+        beamTo._blocks[iblockTo][_block_index(rowsTo, indarr)] =\
+            beamFrom._blocks[iblockFrom][_block_index(rowsFrom, indarrFrom)]
+
+
 def copy_beam(
         beamTo, beamFrom, indarr, includeState=False, includeJspEsp=True):
     """Copies arrays of *beamFrom* to arrays of *beamTo*. The slicing of the
     arrays is given by *indarr*."""
-    beamTo.x[indarr] = beamFrom.x[indarr]
-    beamTo.y[indarr] = beamFrom.y[indarr]
-    beamTo.z[indarr] = beamFrom.z[indarr]
-    beamTo.a[indarr] = beamFrom.a[indarr]
-    beamTo.b[indarr] = beamFrom.b[indarr]
-    beamTo.c[indarr] = beamFrom.c[indarr]
-    beamTo.path[indarr] = beamFrom.path[indarr]
-    beamTo.E[indarr] = beamFrom.E[indarr]
+    names = ['x', 'y', 'z', 'a', 'b', 'c', 'path', 'E', 'nRefl',
+             'elevationD', 'elevationX', 'elevationY', 'elevationZ']
     if includeState:
-        beamTo.state[indarr] = beamFrom.state[indarr]
-    if hasattr(beamFrom, 'nRefl') and hasattr(beamTo, 'nRefl'):
-        beamTo.nRefl[indarr] = beamFrom.nRefl[indarr]
+        names.append('state')
+    if includeJspEsp:
+        names.extend(['Jss', 'Jpp', 'Jsp', 'Es', 'Ep'])
+    _copy_fields(beamTo, beamFrom, names, indarr)
     if hasattr(beamFrom, 'order'):
         beamTo.order = beamFrom.order
-    if hasattr(beamFrom, 'elevationD') and hasattr(beamTo, 'elevationD'):
-        beamTo.elevationD[indarr] = beamFrom.elevationD[indarr]
-        beamTo.elevationX[indarr] = beamFrom.elevationX[indarr]
-        beamTo.elevationY[indarr] = beamFrom.elevationY[indarr]
-        beamTo.elevationZ[indarr] = beamFrom.elevationZ[indarr]
     if hasattr(beamFrom, 'accepted'):
         beamTo.accepted = beamFrom.accepted
         beamTo.acceptedE = beamFrom.acceptedE
@@ -346,13 +626,6 @@ def copy_beam(
         beamTo.seededI = beamFrom.seededI
     if hasattr(beamTo, 'area'):
         beamTo.area = beamFrom.area
-    if includeJspEsp:
-        beamTo.Jss[indarr] = beamFrom.Jss[indarr]
-        beamTo.Jpp[indarr] = beamFrom.Jpp[indarr]
-        beamTo.Jsp[indarr] = beamFrom.Jsp[indarr]
-        if hasattr(beamFrom, 'Es') and hasattr(beamTo, 'Es'):
-            beamTo.Es[indarr] = beamFrom.Es[indarr]
-            beamTo.Ep[indarr] = beamFrom.Ep[indarr]
 
 
 def rotate_coherency_matrix(beam, indarr, roll):
@@ -387,3 +660,141 @@ def rotate_coherency_matrix(beam, indarr, roll):
     JspN = (beam.Jpp[indarr]-beam.Jss[indarr])*cs +\
         beam.Jsp[indarr].real*(c2-s2) + beam.Jsp[indarr].imag*1j
     return JssN, JppN, JspN
+
+
+class BeamFile(object):
+    """Reads a beam saved by :meth:`Beam.export_beam` in the 'columns'
+    format. ``beamFile[name]`` returns the field *name* of all rays as a
+    read-only :class:`numpy.memmap`; a field is mapped only when it is first
+    accessed, so reading a few fields of a big file does not touch the
+    others. :meth:`load` returns a :class:`Beam` with a range of rays."""
+
+    def __init__(self, dirName):
+        if not os.path.isdir(dirName) and\
+                os.path.isdir(dirName + columnExtension):
+            dirName += columnExtension
+        self.dirName = dirName
+        with open(os.path.join(dirName, columnHeader), 'r') as f:
+            self.header = json.load(f)
+        self.nrays = self.header['nrays']
+        self.fields = [name for dtype, groupNames in fieldGroups
+                       for name in groupNames if name in self.header['fields']]
+        self._maps = {}
+
+    def __getitem__(self, name):
+        if name not in self._maps:
+            dtype = np.dtype(self.header['fields'][name])
+            if self.nrays == 0:
+                self._maps[name] = np.zeros(0, dtype=dtype)
+            else:
+                self._maps[name] = np.memmap(
+                    os.path.join(self.dirName, name + '.raw'), dtype=dtype,
+                    mode='r', shape=(self.nrays,))
+        return self._maps[name]
+
+    def __getstate__(self):  # the maps are not pickled but mapped again
+        state = dict(self.__dict__)
+        state['_maps'] = {}
+        return state
+
+    def load(self, fields=None, start=0, stop=None, bl=None):
+        """Returns a :class:`Beam` with the rays [*start*:*stop*] of the
+        *fields* (all if None). The acceptance scalars of the header are
+        scaled by the fraction of the loaded rays."""
+        beam = Beam(nrays=0, xyzOnly=True, bl=bl)
+        beam._load_columns(self, fields, start, stop)
+        fraction = float(beam._nrays) / self.nrays if self.nrays else 0.
+        for key in columnScalars:
+            if key in self.header:
+                setattr(beam, key, self.header[key] * fraction)
+        return beam
+
+
+class BeamFileSource(object):
+    """Replays the rays of a beam file saved by :meth:`Beam.export_beam` in
+    the 'columns' format. Each call of :meth:`shine` returns the next
+    *nrays* rays of the file, starting again from its beginning when the
+    file is exhausted, so that successive repeats go through the whole file
+    chunk by chunk without reading it into memory."""
+
+    nrays = raycing.SourceNrays()
+
+    def __init__(self, bl=None, name='', center=(0, 0, 0), fileName=None,
+                 nrays=raycing.nrays, fields=None, start=0):
+        """
+        *bl*: instance of :class:`~xrt.backends.raycing.BeamLine`
+
+        *name*: str
+
+        *center*: tuple of 3 floats
+            3D point in global system, only used for the beamline layout. The
+            rays are replayed in the global system as they were saved.
+
+        *fileName*: str
+            The directory written by :meth:`Beam.export_beam` with
+            *fformat* = 'columns'.
+
+        *nrays*: int
+            The number of rays returned by one call of :meth:`shine`.
+
+        *fields*: sequence of str or None
+            The fields to read, all if None. A beam without *state* gets
+            all rays good and a beam without *Jsp* gets it zero.
+
+        *start*: int
+            The index of the first ray to replay.
+
+        Each instance keeps its own reading position, shared by the threads
+        of a parallel run, which thus read consecutive chunks. Processes
+        would receive copies of the source and replay the same rays,
+        therefore :func:`~xrt.runner.run_ray_tracing` refuses *processes* >
+        *threads* for a beamline with this source; use several sources with
+        different *start* in separate runs instead.
+
+
+        """
+        self.bl = bl
+        if bl is not None:
+            if self not in bl.sources:
+                bl.sources.append(self)
+                self.ordinalNum = len(bl.sources)
+        raycing.set_name(self, name)
+        self.center = center
+        self.fileName = fileName
+        self.beamFile = BeamFile(fileName)
+        self.nrays = np.long(nrays)
+        self.fields = fields
+        self.position = start
+        if bl is not None:
+            if self.bl.flowSource != 'Qook':
+                bl.oesDict[self.name] = [self, 0]
+
+    @raycing.flow_outputs('beamGlobal')
+    def shine(self, toGlobal=True, withAmplitudes=False, accuBeam=None):
+        u"""
+        Returns the next chunk of rays of the file as a :class:`Beam`. The
+        parameters are accepted for compatibility with the other sources
+        and are ignored: the stored fields are returned as they are.
+
+
+        .. Returned values: beamGlobal
+        """
+        with _positionLock:  # the threads of a run share the source
+            if self.position >= self.beamFile.nrays:
+                self.position = 0
+            start = self.position
+            self.position = min(start + self.nrays, self.beamFile.nrays)
+        bo = self.beamFile.load(self.fields, start, self.position, self.bl)
+        if not hasattr(bo, 'state'):
+            bo.state = np.ones(bo._nrays, dtype=int)
+        if not hasattr(bo, 'Jsp'):
+            bo.Jsp = np.zeros(bo._nrays, dtype=complex)
+        if self.bl is not None:
+            try:
+                self.bl._alignE = float(self.bl.alignE)
+            except ValueError:
+                if hasattr(bo, 'E') and bo._nrays > 0:
+                    self.bl._alignE = float(np.mean(bo.E))
+        raycing.append_to_flow(self.shine, [bo],
+                               inspect.currentframe())
+        return bo
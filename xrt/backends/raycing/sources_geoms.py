@@ -18,16 +18,17 @@ def make_energy(distE, energies, nrays, filamentBeam=False):
     *energies* either determine the limits or is a sequence of discrete
     energies.
     """
+    rng = raycing.get_rng()
     locnrays = 1 if filamentBeam else int(nrays)
     if distE == 'normal':
         try:
-            E = np.random.normal(energies[0], energies[1], locnrays)
+            E = rng.normal(energies[0], energies[1], locnrays)
         except ValueError:
             E = np.zeros(locnrays)
     elif distE == 'flat':
-        E = np.random.uniform(energies[0], energies[1], locnrays)
+        E = rng.uniform(energies[0], energies[1], locnrays)
     elif distE == 'lines':
-        E = np.array(energies)[np.random.randint(len(energies), size=locnrays)]
+        E = np.array(energies)[rng.integers(len(energies), size=locnrays)]
     return E
 
 
@@ -94,13 +95,14 @@ def make_polarization(polarization, bo, nrays=raycing.nrays):
 
         """
     def _fill_beam(Jss, Jpp, Jsp, Es, Ep):
+        rng = raycing.get_rng()
         bo.Jss.fill(Jss)
         bo.Jpp.fill(Jpp)
         bo.Jsp.fill(Jsp)
         if hasattr(bo, 'Es'):
             bo.Es.fill(Es)
             if isinstance(Ep, str):
-                bo.Ep[:] = np.random.uniform(size=int(nrays)) * 2**(-0.5)
+                bo.Ep[:] = rng.uniform(size=int(nrays)) * 2**(-0.5)
             else:
                 bo.Ep.fill(Ep)
 
@@ -132,6 +134,9 @@ def make_polarization(polarization, bo, nrays=raycing.nrays):
 class GeometricSource(object):
     """Implements a geometric source - a source with the ray origin,
     divergence and energy sampled with the given distribution laws."""
+
+    nrays = raycing.SourceNrays()
+
     def __init__(
         self, bl=None, name='', center=(0, 0, 0), nrays=raycing.nrays,
         distx='normal', dx=0.32, disty=None, dy=0, distz='normal', dz=0.018,
@@ -235,11 +240,12 @@ class GeometricSource(object):
         self.yaw = raycing.auto_units_angle(yaw)
 
     def _apply_distribution(self, axis, distaxis, daxis, bo=None):
+        rng = raycing.get_rng()
         if distaxis == 'normal':
             if self.uniformRayDensity:
                 if not isinstance(daxis, (list, tuple)):
                     raise ValueError("Wrong distribution size!")
-                axis[:] = np.random.uniform(-daxis[1], daxis[1], self.nrays)
+                axis[:] = rng.uniform(-daxis[1], daxis[1], self.nrays)
                 amp = np.exp(-axis**2 / daxis[0]**2 / 2) /\
                     PI2**0.5 / daxis[0] * 2 * daxis[1]
                 bo.Jss *= amp
@@ -251,7 +257,7 @@ class GeometricSource(object):
             else:
                 sigma = daxis[0] if isinstance(daxis, (list, tuple)) else daxis
                 try:
-                    axis[:] = np.random.normal(0, sigma, self.nrays)
+                    axis[:] = rng.normal(0, sigma, self.nrays)
                 except ValueError:
                     axis[:] = np.zeros(self.nrays)
         elif (distaxis == 'flat'):
@@ -261,20 +267,22 @@ class GeometricSource(object):
                 if daxis <= 0:
                     return
                 aMin, aMax = -daxis*0.5, daxis*0.5
-            axis[:] = np.random.uniform(aMin, aMax, self.nrays)
+            axis[:] = rng.uniform(aMin, aMax, self.nrays)
 #        else:
 #            axis[:] = 0
 
     def _set_annulus(self, axis1, axis2, rMin, rMax, phiMin, phiMax):
+        rng = raycing.get_rng()
         if rMax > rMin:
             A = 2. / (rMax**2 - rMin**2)
-            r = np.sqrt(2*np.random.uniform(0, 1, self.nrays)/A + rMin**2)
+            r = np.sqrt(2*rng.uniform(0, 1, self.nrays)/A + rMin**2)
         else:
             r = rMax
-        phi = np.random.uniform(phiMin, phiMax, self.nrays)
+        phi = rng.uniform(phiMin, phiMax, self.nrays)
         axis1[:] = r * np.cos(phi)
         axis2[:] = r * np.sin(phi)
 
+    @raycing.flow_outputs('beamGlobal')
     def shine(self, toGlobal=True, withAmplitudes=False, accuBeam=None):
         u"""
         Returns the source beam. If *toGlobal* is True, the output is in
@@ -370,6 +378,9 @@ class GaussianBeam(object):
     It *must* be used for an already available set of 3D points which are
     obtained by :meth:`prepare_wave` of a slit, oe or screen. See a usage
     example in ``\tests\raycing\laguerre_hermite_gaussian_beam.py``."""
+
+    nrays = raycing.SourceNrays()
+
     def __init__(
         self, bl=None, name='', center=(0, 0, 0), w0=0.1,
         distE='lines', energies=(defaultEnergy,), polarization='horizontal',
@@ -438,6 +449,7 @@ class GaussianBeam(object):
             yR = k/2 * self.w0**2
         return self.w0 * (1 + (y/yR)**2)**0.5
 
+    @raycing.flow_outputs('beamGlobal')
     def shine(self, toGlobal=True, wave=None, accuBeam=None):
         u"""
         Returns the source beam. If *toGlobal* is True, the output is in
@@ -655,6 +667,7 @@ class MeshSource(object):
 
         self.polarization = polarization
 
+    @raycing.flow_outputs('beamGlobal')
     def shine(self, toGlobal=True):
         u"""
         Returns the source. If *toGlobal* is True, the output is in the global
@@ -706,6 +719,7 @@ class NESWSource(MeshSource):
     Used internally for matching the maximum divergence to the optical sizes of
     optical elements.
     """
+    @raycing.flow_outputs('beamGlobal')
     def shine(self, toGlobal=True):
         u"""
         Returns the source. If *toGlobal* is True, the output is in the global
@@ -779,6 +793,7 @@ class CollimatedMeshSource(object):
 
         self.polarization = polarization
 
+    @raycing.flow_outputs('beamGlobal')
     def shine(self, toGlobal=True):
         u"""
         Returns the source beam. If *toGlobal* is True, the output is in the
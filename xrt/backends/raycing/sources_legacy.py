@@ -93,6 +93,9 @@ class UndulatorUrgent(object):
     nonetheless can be used for comparison purposes. If you are going to use
     it, the code is freely available as part of XOP package.
     """
+
+    nrays = raycing.SourceNrays()
+
     def __init__(
         self, bl=None, name='UrgentU', center=(0, 0, 0), nrays=raycing.nrays,
         period=32., K=2.668, Kx=0., Ky=0., n=12, eE=6., eI=0.1,
@@ -591,16 +594,17 @@ class UndulatorUrgent(object):
         return Is
 
     def find_electron_path(self, vec, K, npassed):
+        rng = raycing.get_rng()
         anorm = vec * self.gamma / K
         phase = np.empty_like(anorm)
         a1 = np.where(abs(anorm) <= 1)[0]
         phase[a1] = np.arcsin(anorm[a1])
         a1 = np.where(abs(anorm) > 1)[0]
         phase[a1] = np.sign(
-            anorm[a1]) * np.random.normal(PI/2, PI/2/K, len(anorm[a1]))
+            anorm[a1]) * rng.normal(PI/2, PI/2/K, len(anorm[a1]))
         phase[::2] = np.sign(phase[::2]) * PI - phase[::2]
         phase -= np.sign(phase) * PI *\
-            np.random.random_integers(-self.n+1, self.n, npassed)
+            rng.integers(-self.n+1, self.n, npassed, endpoint=True)
         y = self.period / PI2 * phase
         x = K * self.period / PI2 / self.gamma * np.cos(phase)
         a = K / self.gamma * np.sin(phase)
@@ -610,6 +614,7 @@ class UndulatorUrgent(object):
         u"""
         Returns the source beam. If *toGlobal* is True, the output is in the
         global system."""
+        rng = raycing.get_rng()
         bo = None
         length = 0
         seeded = np.long(0)
@@ -618,15 +623,15 @@ class UndulatorUrgent(object):
             bot = Beam(self.nrays)  # beam-out
             seeded += self.nrays
             bot.state[:] = 1  # good
-            bot.E = np.exp(np.random.uniform(self.logeMinRays,
-                                             self.logeMaxRays, self.nrays))
+            bot.E = np.exp(rng.uniform(self.logeMinRays,
+                                       self.logeMaxRays, self.nrays))
 #            bot.E = np.random.uniform(
 #                self.eMinRays, self.eMaxRays, self.nrays)
 # mrad:
             bot.a = np.tan(
-                np.random.uniform(-1, 1, self.nrays)*self.xPrimeMax * 1e-3)
+                rng.uniform(-1, 1, self.nrays)*self.xPrimeMax * 1e-3)
             bot.c = np.tan(
-                np.random.uniform(-1, 1, self.nrays)*self.zPrimeMax * 1e-3)
+                rng.uniform(-1, 1, self.nrays)*self.zPrimeMax * 1e-3)
             coords = np.array(
                 [(bot.E - self.eMin)/(self.eMax - self.eMin) * self.eN,
                  np.abs(bot.a)/(self.xPrimeMax*1e-3)*self.nx + self.extraRows,
@@ -641,7 +646,7 @@ class UndulatorUrgent(object):
                 Icalc[Icalc < 0] = 0
                 I0 = Icalc * 4 * self.xPrimeMax * self.zPrimeMax
             else:
-                I = np.random.uniform(0, 1, self.nrays)
+                I = rng.uniform(0, 1, self.nrays)
                 passed = np.where(I * self.Imax < Icalc)[0]
                 npassed = len(passed)
                 if npassed == 0:
@@ -693,8 +698,8 @@ class UndulatorUrgent(object):
             sigma_r2 = 2 * (CHeVcm / bot.E * 10 * self.period*self.n) / PI2**2
             bot.sourceSIGMAx = ((self.eSigmaX*1e-3)**2 + sigma_r2)**0.5
             bot.sourceSIGMAz = ((self.eSigmaZ*1e-3)**2 + sigma_r2)**0.5
-            bot.x[:] += np.random.normal(0, bot.sourceSIGMAx, npassed)
-            bot.z[:] += np.random.normal(0, bot.sourceSIGMAz, npassed)
+            bot.x[:] += rng.normal(0, bot.sourceSIGMAx, npassed)
+            bot.z[:] += rng.normal(0, bot.sourceSIGMAz, npassed)
 
             if bo is None:
                 bo = bot
@@ -30,6 +30,9 @@ class BendingMagnet(object):
     Bending magnet source. The computation is reasonably fast and thus a GPU
     is not required and is not implemented.
     """
+
+    nrays = raycing.SourceNrays()
+
     def __init__(self, bl=None, name='BM', center=(0, 0, 0),
                  nrays=raycing.nrays,
                  eE=3.0, eI=0.5, eEspread=0., eSigmaX=None, eSigmaZ=None,
@@ -105,6 +108,7 @@ class BendingMagnet(object):
 
 
         """
+        rng = raycing.get_rng()
         self.Ee = eE
         self.gamma = self.Ee * 1e9 * EV2ERG / (M0 * C**2)
         if isinstance(self, Wiggler):
@@ -228,9 +232,9 @@ class BendingMagnet(object):
         precalc = True
         rMax = self.nrays
         if precalc:
-            rE = np.random.uniform(self.E_min, self.E_max, rMax)
-            rTheta = np.random.uniform(0., self.Theta_max, rMax)
-            rPsi = np.random.uniform(0., self.Psi_max, rMax)
+            rE = rng.uniform(self.E_min, self.E_max, rMax)
+            rTheta = rng.uniform(0., self.Theta_max, rMax)
+            rPsi = rng.uniform(0., self.Psi_max, rMax)
             DistI = self.build_I_map(rE, rTheta, rPsi)[0]
             f_max = np.amax(DistI)
             a_max = np.argmax(DistI)
@@ -272,7 +276,7 @@ class BendingMagnet(object):
 
         if self.filamentBeam:
             self.nrepmax = np.floor(rMax / len(np.where(
-                self.Imax * np.random.rand(rMax) < DistI)[0]))
+                self.Imax * rng.random(rMax) < DistI)[0]))
 
         """Preparing to calculate the total flux integral"""
         self.xzE = 4 * (self.E_max-self.E_min) * self.Theta_max * self.Psi_max
@@ -282,14 +286,15 @@ class BendingMagnet(object):
         return '3-BM-xrt'
 
     def build_I_map(self, dde, ddtheta, ddpsi):
+        rng = raycing.get_rng()
         np.seterr(invalid='ignore')
         np.seterr(divide='ignore')
         gamma = self.gamma
         if self.eEspread > 0:
             if np.array(dde).shape:
                 if dde.shape[0] > 1:
-                    gamma += np.random.normal(0, gamma*self.eEspread,
-                                              dde.shape)
+                    gamma += rng.normal(0, gamma*self.eEspread,
+                                        dde.shape)
             gamma2 = gamma**2
         else:
             gamma2 = self.gamma2
@@ -340,6 +345,7 @@ class BendingMagnet(object):
             Pol3 = np.where(s0, 2. * self.Isp / s0, s0)
         return (self.Itotal, Pol1, self.Is*0., Pol3)
 
+    @raycing.flow_outputs('beamGlobal')
     def shine(self, toGlobal=True, withAmplitudes=True, fixedEnergy=False,
               accuBeam=None):
         u"""
@@ -351,6 +357,7 @@ class BendingMagnet(object):
 
         .. Returned values: beamGlobal
         """
+        rng = raycing.get_rng()
         if self.bl is not None:
             try:
                 self.bl._alignE = float(self.bl.alignE)
@@ -370,35 +377,35 @@ class BendingMagnet(object):
             self.nrays
         if self.filamentBeam:
             if accuBeam is None:
-                rE = np.random.random_sample() *\
+                rE = rng.random() *\
                     float(self.E_max - self.E_min) + self.E_min
                 if self.isMPW:
                     sigma_r2 = 2 * (CHeVcm/rE*10*self.L0*self.Np) / PI2**2
                     sourceSIGMAx = self.dx
                     sourceSIGMAz = self.dz
-                    rTheta0 = np.random.random_sample() *\
+                    rTheta0 = rng.random() *\
                         (self.Theta_max - self.Theta_min) + self.Theta_min
                     ryNp = 0.5 * self.L0 *\
                         (np.arccos(rTheta0 * self.gamma / self.K) / PI) +\
                         0.5 * self.L0 *\
-                        np.random.random_integers(0, int(2*self.Np - 1))
+                        rng.integers(0, int(2*self.Np - 1), endpoint=True)
                     rY = ryNp - 0.5*self.L0*self.Np
                     if (ryNp - 0.25*self.L0 <= 0):
                         rY += self.L0*self.Np
                     rX = self.X0 * np.sin(PI2 * rY / self.L0) +\
-                        sourceSIGMAx * np.random.standard_normal()
+                        sourceSIGMAx * rng.standard_normal()
                     rY -= 0.25 * self.L0
-                    rZ = sourceSIGMAz * np.random.standard_normal()
+                    rZ = sourceSIGMAz * rng.standard_normal()
                 else:
-                    rZ = self.dz * np.random.standard_normal()
-                    rTheta0 = np.random.random_sample() *\
+                    rZ = self.dz * rng.standard_normal()
+                    rTheta0 = rng.random() *\
                         (self.Theta_max - self.Theta_min) + self.Theta_min
-                    R1 = self.dx * np.random.standard_normal() +\
+                    R1 = self.dx * rng.standard_normal() +\
                         self.ro * 1000.
                     rX = -R1 * np.cos(rTheta0) + self.ro*1000.
                     rY = R1 * np.sin(rTheta0)
-                dtheta = self.dxprime * np.random.standard_normal()
-                dpsi = self.dzprime * np.random.standard_normal()
+                dtheta = self.dxprime * rng.standard_normal()
+                dpsi = self.dzprime * rng.standard_normal()
             else:
                 rE = accuBeam.E[0]
                 rX = accuBeam.x[0]
@@ -418,7 +425,7 @@ class BendingMagnet(object):
             1: Theta / horizontal
             2: Psi / vertical
             3: Monte-Carlo discriminator"""
-            rnd_r = np.random.rand(mcRays, 4)
+            rnd_r = rng.random((mcRays, 4))
             seeded += mcRays
             if self.filamentBeam:
 #                print(self.Theta_min, rTheta0 - 1. / self.gamma)
@@ -464,14 +471,14 @@ class BendingMagnet(object):
 
             if not self.filamentBeam:
                 if self.dxprime > 0:
-                    dtheta = np.random.normal(0, self.dxprime, npassed)
+                    dtheta = rng.normal(0, self.dxprime, npassed)
                 else:
                     dtheta = 0
                 if not self.isMPW:
-                    dtheta += np.random.normal(0, 1/self.gamma, npassed)
+                    dtheta += rng.normal(0, 1/self.gamma, npassed)
 
                 if self.dzprime > 0:
-                    dpsi = np.random.normal(0, self.dzprime, npassed)
+                    dpsi = rng.normal(0, self.dzprime, npassed)
                 else:
                     dpsi = 0
 
@@ -497,12 +504,12 @@ class BendingMagnet(object):
                     bot.y[:] = rY
                 else:
                     bot.y[:] = ((np.arccos(Theta0*self.gamma/self.K) / PI) +
-                                np.random.randint(
+                                rng.integers(
                                     -int(self.Np), int(self.Np), npassed) -
                                 0.5) * 0.5 * self.L0
                     bot.x[:] = self.X0 * np.sin(PI2 * bot.y / self.L0) +\
-                        np.random.normal(0., bot.sourceSIGMAx, npassed)
-                    bot.z[:] = np.random.normal(0., bot.sourceSIGMAz, npassed)
+                        rng.normal(0., bot.sourceSIGMAx, npassed)
+                    bot.z[:] = rng.normal(0., bot.sourceSIGMAz, npassed)
                 bot.Jsp[:] = np.zeros(npassed)
             else:
                 if self.filamentBeam:
@@ -511,9 +518,9 @@ class BendingMagnet(object):
                     bot.y[:] = rY
                 else:
                     if self.dz > 0:
-                        bot.z[:] = np.random.normal(0., self.dz, npassed)
+                        bot.z[:] = rng.normal(0., self.dz, npassed)
                     if self.dx > 0:
-                        R1 = np.random.normal(self.ro*1e3, self.dx, npassed)
+                        R1 = rng.normal(self.ro*1e3, self.dx, npassed)
                     else:
                         R1 = self.ro * 1e3
                     bot.x[:] = -R1 * np.cos(Theta0) + self.ro*1000.
@@ -661,6 +668,9 @@ class Undulator(object):
     u"""
     Undulator source. The computation is volumnous and thus requires a GPU.
     """
+
+    nrays = raycing.SourceNrays()
+
     def __init__(self, bl=None, name='und', center=(0, 0, 0),
                  nrays=raycing.nrays,
                  eE=6.0, eI=0.1, eEspread=0., eSigmaX=None, eSigmaZ=None,
@@ -1098,6 +1108,7 @@ class Undulator(object):
     def reset(self):
         """This method must be invoked after any changes in the undulator
         parameters."""
+        rng = raycing.get_rng()
         self.wu = PI * (0.01 * C) / self.L0 / 1e-3 / self.gamma2 * \
             (2*self.gamma2 - 1 - 0.5*self.Kx**2 - 0.5*self.Ky**2) / E2W
         # wnu = 2 * PI * (0.01 * C) / self.L0 / 1e-3 / E2W
@@ -1178,15 +1189,15 @@ class Undulator(object):
 
         if self.filamentBeam:
             rMax = self.nrays
-            rE = np.random.uniform(self.E_min, self.E_max, rMax)
-            rTheta = np.random.uniform(self.Theta_min, self.Theta_max, rMax)
-            rPsi = np.random.uniform(self.Psi_min, self.Psi_max, rMax)
+            rE = rng.uniform(self.E_min, self.E_max, rMax)
+            rTheta = rng.uniform(self.Theta_min, self.Theta_max, rMax)
+            rPsi = rng.uniform(self.Psi_min, self.Psi_max, rMax)
             tmpEspread = self.eEspread
             self.eEspread = 0
             DistI = self.build_I_map(rE, rTheta, rPsi)[0]
             self.Imax = np.max(DistI) * 1.2
             self.nrepmax = np.floor(rMax / len(np.where(
-                self.Imax * np.random.rand(rMax) < DistI)[0]))
+                self.Imax * rng.random(rMax) < DistI)[0]))
             self.eEspread = tmpEspread
         else:
             self.Imax = 0.
@@ -1271,6 +1282,7 @@ class Undulator(object):
         within the emittance distribution if *withElectronDivergence* is True
         and an individual random shift to gamma within the energy spread. The
         parameter self.filamentBeam is irrelevant for this method."""
+        rng = raycing.get_rng()
         if isinstance(energy, str):  # i.e. if 'auto'
             energy = np.mgrid[self.E_min:self.E_max + 0.5*self.dE:self.dE]
         nmacroe = 1 if len(np.array(energy).shape) == 0 else len(energy)
@@ -1289,20 +1301,20 @@ class Undulator(object):
             tomesh = energy, theta, psi, harmonic
         mesh = np.meshgrid(*tomesh, indexing='ij')
         if withElectronDivergence and self.dxprime > 0:
-            dthe = np.random.normal(0, self.dxprime, nmacroe)
+            dthe = rng.normal(0, self.dxprime, nmacroe)
             if harmonic is None:
                 mesh[1][:, ...] += dthe[:, np.newaxis, np.newaxis]
             else:
                 mesh[1][:, ...] += dthe[:, np.newaxis, np.newaxis, np.newaxis]
         if withElectronDivergence and self.dzprime > 0:
-            dpsi = np.random.normal(0, self.dzprime, nmacroe)
+            dpsi = rng.normal(0, self.dzprime, nmacroe)
             if harmonic is None:
                 mesh[2][:, ...] += dpsi[:, np.newaxis, np.newaxis]
             else:
                 mesh[2][:, ...] += dpsi[:, np.newaxis, np.newaxis, np.newaxis]
 
         if self.eEspread > 0:
-            spr = np.random.normal(0, self.eEspread, nmacroe) * self.gamma
+            spr = rng.normal(0, self.eEspread, nmacroe) * self.gamma
             dgamma = np.zeros_like(mesh[0])
             if harmonic is None:
                 dgamma[:, ...] = spr[:, np.newaxis, np.newaxis]
@@ -1513,6 +1525,7 @@ class Undulator(object):
     def _build_I_map_conv(self, w, ddtheta, ddpsi, harmonic, dgamma=None):
         #        np.seterr(invalid='ignore')
         #        np.seterr(divide='ignore')
+        rng = raycing.get_rng()
         NRAYS = 1 if len(np.array(w).shape) == 0 else len(w)
         gamma = self.gamma
         if self.eEspread > 0:
@@ -1520,7 +1533,7 @@ class Undulator(object):
                 gamma += dgamma
             else:
                 sz = 1 if self.filamentBeam else NRAYS
-                gamma += gamma * self.eEspread * np.random.normal(size=sz)
+                gamma += gamma * self.eEspread * rng.normal(size=sz)
         gamma = gamma * np.ones(NRAYS)
         gamma2 = gamma**2
 
@@ -1567,6 +1580,7 @@ class Undulator(object):
 
     def _build_I_map_custom(self, w, ddtheta, ddpsi, harmonic, dgamma=None):
         # time1 = time.time()
+        rng = raycing.get_rng()
         NRAYS = 1 if len(np.array(w).shape) == 0 else len(w)
         gamma = self.gamma
         if self.eEspread > 0:
@@ -1574,7 +1588,7 @@ class Undulator(object):
                 gamma += dgamma
             else:
                 sz = 1 if self.filamentBeam else NRAYS
-                gamma += gamma * self.eEspread * np.random.normal(size=sz)
+                gamma += gamma * self.eEspread * rng.normal(size=sz)
         gamma = gamma * np.ones(NRAYS, dtype=self.cl_precisionF)
         gamma2 = gamma**2
 
@@ -1721,6 +1735,7 @@ class Undulator(object):
 
     def _build_I_map_CL(self, w, ddtheta, ddpsi, harmonic, dgamma=None):
         # time1 = time.time()
+        rng = raycing.get_rng()
         NRAYS = 1 if len(np.array(w).shape) == 0 else len(w)
         gamma = self.gamma
         if self.eEspread > 0:
@@ -1728,7 +1743,7 @@ class Undulator(object):
                 gamma += dgamma
             else:
                 sz = 1 if self.filamentBeam else NRAYS
-                gamma += gamma * self.eEspread * np.random.normal(size=sz)
+                gamma += gamma * self.eEspread * rng.normal(size=sz)
         gamma = gamma * np.ones(NRAYS, dtype=self.cl_precisionF)
         gamma2 = gamma**2
 
@@ -1991,6 +2006,7 @@ class Undulator(object):
         return ((self.dxprime**2 + sigmaP_r2)**0.5,
                 (self.dzprime**2 + sigmaP_r2)**0.5)
 
+    @raycing.flow_outputs('beamGlobal')
     def shine(self, toGlobal=True, withAmplitudes=True, fixedEnergy=False,
               wave=None, accuBeam=None):
         u"""
@@ -2012,6 +2028,7 @@ class Undulator(object):
 
         .. Returned values: beamGlobal
         """
+        rng = raycing.get_rng()
         if self.bl is not None:
             try:
                 self.bl._alignE = float(self.bl.alignE)
@@ -2040,12 +2057,12 @@ class Undulator(object):
         np.seterr(divide='warn')
         if self.filamentBeam:
             if accuBeam is None:
-                rsE = np.random.random_sample() * \
+                rsE = rng.random() * \
                     float(self.E_max - self.E_min) + self.E_min
-                rX = self.dx * np.random.standard_normal()
-                rZ = self.dz * np.random.standard_normal()
-                dtheta = self.dxprime * np.random.standard_normal()
-                dpsi = self.dzprime * np.random.standard_normal()
+                rX = self.dx * rng.standard_normal()
+                rZ = self.dz * rng.standard_normal()
+                dtheta = self.dxprime * rng.standard_normal()
+                dpsi = self.dzprime * rng.standard_normal()
             else:
                 rsE = accuBeam.E[0]
                 rX = accuBeam.filamentDX
@@ -2059,8 +2076,8 @@ class Undulator(object):
                 self.theta0 = dtheta
                 self.psi0 = dpsi
             else:
-                self.theta0 = np.random.normal(0, self.dxprime, mcRays)
-                self.psi0 = np.random.normal(0, self.dzprime, mcRays)
+                self.theta0 = rng.normal(0, self.dxprime, mcRays)
+                self.psi0 = rng.normal(0, self.dzprime, mcRays)
 
         if fixedEnergy:
             rsE = fixedEnergy
@@ -2076,7 +2093,7 @@ class Undulator(object):
             if self.filamentBeam or fixedEnergy:
                 rE = rsE * np.ones(mcRays)
             else:
-                rndg = np.random.rand(mcRays)
+                rndg = rng.random(mcRays)
                 rE = rndg * float(self.E_max - self.E_min) + self.E_min
 
             if wave is not None:
@@ -2085,9 +2102,9 @@ class Undulator(object):
                     shiftX = rX
                     shiftZ = rZ
                 else:
-                    shiftX = np.random.normal(
+                    shiftX = rng.normal(
                         0, self.dx, mcRays) if self.dx > 0 else 0
-                    shiftZ = np.random.normal(
+                    shiftZ = rng.normal(
                         0, self.dz, mcRays) if self.dz > 0 else 0
                 x = wave.xDiffr + shiftX
                 y = wave.yDiffr
@@ -2100,14 +2117,14 @@ class Undulator(object):
                     rPsi += dpsi
                 else:
                     if self.dxprime > 0:
-                        rTheta += np.random.normal(0, self.dxprime, mcRays)
+                        rTheta += rng.normal(0, self.dxprime, mcRays)
                     if self.dzprime > 0:
-                        rPsi += np.random.normal(0, self.dzprime, mcRays)
+                        rPsi += rng.normal(0, self.dzprime, mcRays)
             else:
-                rndg = np.random.rand(mcRays)
+                rndg = rng.random(mcRays)
                 rTheta = rndg * (self.Theta_max - self.Theta_min) +\
                     self.Theta_min
-                rndg = np.random.rand(mcRays)
+                rndg = rng.random(mcRays)
                 rPsi = rndg * (self.Psi_max - self.Psi_min) + self.Psi_min
 
             Intensity, mJs, mJp = self.build_I_map(rE, rTheta, rPsi)
@@ -2127,7 +2144,7 @@ class Undulator(object):
                 I_pass = slice(None)
                 npassed = mcRays
             else:
-                rndg = np.random.rand(mcRays)
+                rndg = rng.random(mcRays)
                 I_pass = np.where(self.Imax * rndg < Intensity)[0]
                 npassed = len(I_pass)
             if npassed == 0:
@@ -2156,13 +2173,13 @@ class Undulator(object):
                 if self.full:
                     bot.sourceSIGMAx = self.dx
                     bot.sourceSIGMAz = self.dz
-                    dxR = np.random.normal(0, bot.sourceSIGMAx, npassed)
-                    dzR = np.random.normal(0, bot.sourceSIGMAz, npassed)
+                    dxR = rng.normal(0, bot.sourceSIGMAx, npassed)
+                    dzR = rng.normal(0, bot.sourceSIGMAz, npassed)
                 else:
                     bot.sourceSIGMAx, bot.sourceSIGMAz = self.get_SIGMA(
                         bot.E, onlyOddHarmonics=False)
-                    dxR = np.random.normal(0, bot.sourceSIGMAx, npassed)
-                    dzR = np.random.normal(0, bot.sourceSIGMAz, npassed)
+                    dxR = rng.normal(0, bot.sourceSIGMAx, npassed)
+                    dzR = rng.normal(0, bot.sourceSIGMAz, npassed)
 
             if wave is not None:
                 wave.rDiffr = ((wave.xDiffr - dxR)**2 + wave.yDiffr**2 +
@@ -2183,10 +2200,10 @@ class Undulator(object):
                         bot.c[:] += dpsi
                     else:
                         if self.dxprime > 0:
-                            bot.a[:] += np.random.normal(
+                            bot.a[:] += rng.normal(
                                 0, self.dxprime, npassed)
                         if self.dzprime > 0:
-                            bot.c[:] += np.random.normal(
+                            bot.c[:] += rng.normal(
                                 0, self.dzprime, npassed)
 
             mJs = mJs[I_pass]
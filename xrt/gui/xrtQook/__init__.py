@@ -716,6 +716,7 @@ class XrtQook(qt.QWidget):
         self.isEmpty = True
         self.beamLine = raycing.BeamLine()
         self.beamLine.flowSource = 'Qook'
+        self.beamLine.cacheFlow = True
         self.updateBeamlineBeams(item=None)
         self.updateBeamlineMaterials(item=None)
         self.updateBeamline(item=None)
@@ -2033,6 +2034,7 @@ class XrtQook(qt.QWidget):
                     try:
                         self.beamLine = raycing.BeamLine()
                         self.beamLine.flowSource = 'Qook'
+                        self.beamLine.cacheFlow = True
                         self.progressBar.setFormat(
                             "Populating the beams... %p%")
                         self.updateBeamlineBeams(item=None)
@@ -3346,6 +3348,7 @@ class XrtQook(qt.QWidget):
         try:
             self.beamLine = raycing.BeamLine()
             self.beamLine.flowSource = 'Qook'
+            self.beamLine.cacheFlow = True
             self.updateBeamlineBeams(item=None)
             self.updateBeamlineMaterials(item=None)
             self.updateBeamline(item=None)
@@ -6,6 +6,24 @@ deriving from :mod:`multiprocessing` or :mod:`threading` by selecting the
 corresponding parameter in :func:`~xrt.runner.run_ray_tracing`. The
 multiprocessing is normally faster than multithreading but has an inconvenience
 when the user aborts the execution: the processes have to be killed manually.
+
+The classes :class:`PersistentProcess` and :class:`PersistentThread` are used
+when *persistentWorkers* is set in :func:`~xrt.runner.run_ray_tracing`. Such a
+worker receives the beamline and the plot cards only once, keeps them resident
+and then waits for iteration tokens in its task queue. A token None terminates
+the worker.
+
+If *sharedAccumulation* is set in :func:`~xrt.runner.run_ray_tracing`, the
+processes do not send their histograms through the output queues but add them
+to per-worker accumulators (:class:`SharedAccumulator`) that live in shared
+memory blocks. Only the ray counters go through the queues. The job server
+reduces the accumulators into the plots at redrawing and saving points.
+
+If *raysPerChunk* is set in :func:`~xrt.runner.run_ray_tracing`, a raycing
+worker traces its iteration in chunks of rays (see
+:meth:`GenericProcessOrThread.run_chunks`) and sends the sum of the chunk
+histograms, so that the number of rays per iteration is not limited by the
+memory.
 """
 __author__ = "Konstantin Klementiev, Roman Chernikov"
 __date__ = "26 Mar 2016"
@@ -17,6 +35,10 @@ from threading import Thread
 import numpy as np
 from . import kde
 import matplotlib as mpl
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
 
 from .backends import shadow
 from .backends import dummy
@@ -26,6 +48,204 @@ __fdir__ = os.path.dirname(__file__)
 
 
 _DEBUG = 1
+BLOCK_1D = 65536  # the same as in np.histogram, for identical summation
+
+
+def histogram_bins(x, limits, bins):
+    """
+    Calculates the bin indices of *x* for a histogram with *bins* equal bins
+    within *limits*. The indices are calculated once and then serve all the
+    weights, see :func:`histogram_weights`. The bin assignment exactly repeats
+    that of ``np.histogram`` and ``np.histogram2d``: the right edge belongs to
+    the last bin and the values outside of *limits* are dropped.
+
+    Returns a tuple of the index array, the boolean array of the values within
+    *limits* and the bin edges.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if limits is None:
+        if len(x) > 0:
+            limits = x.min(), x.max()
+        else:
+            limits = 0., 1.
+    xmin, xmax = float(limits[0]), float(limits[1])
+    if xmin == xmax:
+        xmin -= 0.5
+        xmax += 0.5
+    binEdges = np.linspace(xmin, xmax, bins+1)
+    keep = (x >= xmin) & (x <= xmax)
+    xk = np.where(keep, x, xmin)
+    ind = ((xk - xmin) * (bins / (xmax - xmin))).astype(np.intp)
+    ind[ind == bins] -= 1
+    # the index calculation may be inconsistent within ~1 ULP of the edges:
+    ind[xk < binEdges[ind]] -= 1
+    ind[(xk >= binEdges[ind+1]) & (ind != bins-1)] += 1
+    return ind, keep, binEdges
+
+
+def histogram_weights(xBins, weights, size, block=None):
+    """
+    Accumulates each array of the sequence *weights* over the bin indices
+    *xBins* (an output of :func:`histogram_bins` or a flattened 2D version of
+    it) in a single bincount pass per weight. If *block* is given, the
+    summation is done in blocks of this size for an identical result with
+    ``np.histogram``. Returns a list of histograms of length *size*.
+    """
+    ind, keep = xBins[0], xBins[1]
+    if block is None or len(ind) <= block:
+        allKept = keep.all()
+        indk = ind if allKept else ind[keep]
+        return [np.bincount(indk, weights=w if allKept else w[keep],
+                            minlength=size).astype(np.float64)
+                for w in weights]
+
+    hists = [np.zeros(size) for w in weights]
+    for i in range(0, len(ind), block):
+        keepi = keep[i:i+block]
+        indk = ind[i:i+block][keepi]
+        for hist, w in zip(hists, weights):
+            hist += np.bincount(indk, weights=w[i:i+block][keepi],
+                                minlength=size)
+    return hists
+
+
+def is_shared_accumulation_possible(plot):
+    """Returns True if the histograms of *plot* can be accumulated in shared
+    memory. The 4D and PCA histograms are collected in the queues."""
+    if shared_memory is None:
+        return False
+    return not (plot.fluxKind.lower().endswith('4d') or
+                plot.fluxKind.lower().endswith('pca'))
+
+
+def histogram_shape_2D(plot):
+    """Returns the shape of the 2D histogram of *plot* as output by a
+    process or thread: (*yaxis.bins*, *xaxis.bins*) or, for the mutual
+    intensity cuts ('E' *fluxKind* ending with 'xx' or 'zz'), the square of
+    the bins of the cut axis."""
+    fluxKind = plot.fluxKind.lower()
+    if fluxKind.startswith('e'):
+        if fluxKind.endswith('xx'):
+            return plot.xaxis.bins, plot.xaxis.bins
+        elif fluxKind.endswith(('yy', 'zz')):
+            return plot.yaxis.bins, plot.yaxis.bins
+    return plot.yaxis.bins, plot.xaxis.bins
+
+
+def is_hue_binned(plot):
+    """Returns True if the colored histograms of *plot* are accumulated as hue
+    bins (see *hueBins* in :class:`~xrt.plotter.XYCPlot`). The mutual
+    intensity cuts, the logarithmic flux scale and the KDE densities need the
+    per-ray colors and ignore *hueBins*."""
+    if not getattr(plot, 'hueBins', None):
+        return False
+    fluxKind = plot.fluxKind.lower()
+    if fluxKind.startswith('e') and fluxKind.endswith(('xx', 'yy', 'zz')):
+        return False
+    if fluxKind.endswith('log'):
+        return False
+    for axis in (plot.xaxis, plot.yaxis, plot.caxis):
+        if axis.density.lower() == 'kde':
+            return False
+    return True
+
+
+def hue_palette(hueBins, saturation):
+    """Returns the RGB colors of the hue bin centers with value V = 1 as an
+    array of shape (*hueBins*, 3). As the HSV to RGB conversion is linear in
+    V, a hue-binned histogram times this palette gives its RGB histogram."""
+    hues = (np.arange(hueBins) + 0.5) / hueBins
+    hsv = np.dstack((hues, np.ones_like(hues) * saturation,
+                     np.ones_like(hues)))
+    return mpl.colors.hsv_to_rgb(hsv).reshape(-1, 3)
+
+
+def add_chunk(outList, chunkList):
+    """Adds the histograms and the ray counters of *chunkList* to those of
+    *outList*, both lists being in the order of the output queue. The bin
+    edges and the limits are taken from the first chunk."""
+    for key in (0, 1, 3, 4, 6, 7, 9, 10, 12, 13):
+        if outList[key] is not None:
+            outList[key] = outList[key] + chunkList[key]
+    if isinstance(outList[14], tuple):  # raycing ray counters
+        outList[14] = tuple(a + b for a, b in zip(outList[14], chunkList[14]))
+    else:
+        outList[14] += chunkList[14]
+    outList[15] = outList[15] or chunkList[15]
+
+
+class SharedAccumulator(object):
+    """
+    The histograms of one plot accumulated by one worker, laid out as numpy
+    arrays in one shared memory block. The job server creates the block
+    (*name* is None), the workers attach to it by its *name*.
+    """
+    def __init__(self, plot, name=None):
+        self.layout = []
+        self.isHueBinned = is_hue_binned(plot)
+        nColors = plot.hueBins if self.isHueBinned else 3
+        axes = [plot.xaxis, plot.yaxis]
+        if plot.ePos:
+            axes.append(plot.caxis)
+        for iaxis, axis in enumerate(axes):
+            self.layout.append((iaxis*3, (axis.bins,), np.float64))
+            self.layout.append((iaxis*3+1, (axis.bins, nColors), np.float64))
+        shape2D = histogram_shape_2D(plot)
+        dtype2D = np.complex128 if plot.fluxKind.startswith('E') else\
+            np.float64
+        self.layout.append((9, shape2D, dtype2D))
+        self.layout.append((10, shape2D + (nColors,), np.float64))
+
+        offsets = []
+        size = 0
+        for key, shape, dtype in self.layout:
+            offsets.append(size)
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            size += (nbytes + 15) // 16 * 16
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.arrays = {}
+        for (key, shape, dtype), offset in zip(self.layout, offsets):
+            self.arrays[key] = np.ndarray(
+                shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+        if name is None:
+            self.zero()
+
+    def zero(self):
+        for arr in self.arrays.values():
+            arr[:] = 0
+
+    def add(self, outList):
+        """Adds the histograms of *outList* (in the order of the output queue)
+        to the shared arrays."""
+        for key, arr in self.arrays.items():
+            arr += outList[key]
+
+    def reduce_into(self, plot):
+        """Adds the accumulated histograms to the totals of *plot* and zeroes
+        the accumulators."""
+        for iaxis, axis in enumerate([plot.xaxis, plot.yaxis, plot.caxis]):
+            if iaxis*3 in self.arrays:
+                axis.total1D += self.arrays[iaxis*3]
+                if self.isHueBinned:
+                    axis.total1D_hue += self.arrays[iaxis*3+1]
+                else:
+                    axis.total1D_RGB += self.arrays[iaxis*3+1]
+        plot.total2D += self.arrays[9]
+        if self.isHueBinned:
+            plot.total2D_hue += self.arrays[10]
+        else:
+            plot.total2D_RGB += self.arrays[10]
+        self.zero()
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
 
 
 class GenericProcessOrThread(object):
@@ -40,14 +260,16 @@ class GenericProcessOrThread(object):
         if locCard.backend.startswith('shadow'):
             self.runDir = locCard.cwd + os.sep + 'tmp' + str(idLoc)
         self.idN = idLoc
+        self.iteration = locCard.iteration
         self.status = 0
         self.plots = plots
         self.outPlotQueues = outPlotQueues
         self.alarmQueue = alarmQueue
         self.card = locCard
         self.card.beamLine.flow = []
+        self.sharedAccumulators = None
 
-    def do_hist1d(self, x, intensity, cDataRGB, axis):
+    def do_hist1d(self, x, intensity, cDataRGB, axis, xBins=None):
         """
         Calculates the specified 1D histogram.
         *x, intensity*: ndarray, shape(NumberOfRays,)
@@ -55,7 +277,10 @@ class GenericProcessOrThread(object):
         *cDataRGB*: ndarray, shape(NumberOfRays, 3)
             used for weighing the histogram in order to colorize it
         *axis*: XYCAxis instance
-            the abscissa of the 1D histogram."""
+            the abscissa of the 1D histogram.
+        *xBins*: tuple
+            the output of :func:`histogram_bins` for *x* if already
+            calculated."""
         hist1dRGB = np.zeros((axis.bins, 3))
         if axis.density.lower() == 'kde':
             if axis.limits is None:
@@ -74,25 +299,29 @@ class GenericProcessOrThread(object):
                     hist1dRGB[:, i] = kdeobj(binCenters)
                     hist1dRGB[:, i] *= norm / hist1dRGB[:, i].sum()
         else:
-            histogram = np.histogram
-
-            hist1d, binEdges = histogram(
-                x, bins=axis.bins, range=axis.limits, weights=intensity)
+            if xBins is None:
+                xBins = histogram_bins(x, axis.limits, axis.bins)
+            binEdges = xBins[2]
+            weights = [intensity]
+            if cDataRGB is not None:
+                weights += [cDataRGB[:, i] for i in range(3)]
+            hists = histogram_weights(xBins, weights, axis.bins, BLOCK_1D)
+            hist1d = hists[0]
             if cDataRGB is not None:
                 for i in range(3):  # over RGB components
-                    hist1dRGB[:, i], binEdges = histogram(
-                        x, bins=axis.bins, range=axis.limits,
-                        weights=cDataRGB[:, i])
+                    hist1dRGB[:, i] = hists[i+1]
         return hist1d, hist1dRGB, binEdges
 
-    def do_histXXZZ(self, x, intensity, cDataRGB, axis):
+    def do_histXXZZ(self, x, intensity, cDataRGB, axis, xBins=None):
         """
         Used for 2D mutual intensity functions X1X2 or Y1Y2.
         """
+        if xBins is None and axis.density.lower() != 'kde':
+            xBins = histogram_bins(x, axis.limits, axis.bins)
         hist1dr, hist1dRGB, binEdges =\
-            self.do_hist1d(x, intensity.real, None, axis)
+            self.do_hist1d(x, intensity.real, None, axis, xBins)
         hist1di, hist1dRGB, binEdges =\
-            self.do_hist1d(x, intensity.imag, cDataRGB, axis)
+            self.do_hist1d(x, intensity.imag, cDataRGB, axis, xBins)
         xs = hist1dr + 1j*hist1di
         hist2d = np.outer(xs, xs.conjugate())
 
@@ -101,7 +330,8 @@ class GenericProcessOrThread(object):
             hist2dRGB[:, :, i] = np.outer(hist1dRGB[:, i], hist1dRGB[:, i])
         return hist2d, hist2dRGB
 
-    def do_hist2d(self, x, y, intensity, cDataRGB, plot):
+    def do_hist2d(self, x, y, intensity, cDataRGB, plot, xBins=None,
+                  yBins=None):
         """
         Calculates the 2D histogram.
         *x, y, intensity*: ndarray, shape(NumberOfRays,)
@@ -109,6 +339,9 @@ class GenericProcessOrThread(object):
         *cDataRGB*: ndarray, shape(NumberOfRays, 3)
             used for weighing the histogram in order to colorize it
         *plot* instance of :class:`XYCPlot`: the plot hosting the 2D histogram.
+        *xBins, yBins*: tuples
+            the outputs of :func:`histogram_bins` for *x* and *y* if already
+            calculated.
 
         If *plot.fluxKind* starts with 'E' then the field amplitude or mutual
         intensity is accumulated in the 2D histogram:
@@ -130,11 +363,12 @@ class GenericProcessOrThread(object):
 
             - If without these endings, the field aplitudes are simply summed.
 
+        All the weights are accumulated over the bin indices calculated only
+        once per axis, see :func:`histogram_bins`. The result is identical to
+        that of ``np.histogram2d``.
         """
         hist4d = None
-        histogram2d = np.histogram2d
 
-        xyrange = [plot.yaxis.limits, plot.xaxis.limits]
         if not (raycing.is_sequence(plot.xaxis.limits) and
                 raycing.is_sequence(plot.yaxis.limits)):
             raise ValueError()
@@ -142,33 +376,55 @@ class GenericProcessOrThread(object):
 
         if plot.fluxKind.startswith('E'):
             if plot.fluxKind.lower().endswith('xx'):
-                return self.do_histXXZZ(x, intensity, cDataRGB, plot.xaxis)
+                return self.do_histXXZZ(
+                    x, intensity, cDataRGB, plot.xaxis, xBins)
             elif plot.fluxKind.lower().endswith('zz') \
                     or plot.fluxKind.lower().endswith('yy'):
-                return self.do_histXXZZ(y, intensity, cDataRGB, plot.yaxis)
+                return self.do_histXXZZ(
+                    y, intensity, cDataRGB, plot.yaxis, yBins)
 
-            hist2dr, t1, t2 = histogram2d(
-                y, x, bins=xybins, range=xyrange, weights=intensity.real)
-            hist2di, t1, t2 = histogram2d(
-                y, x, bins=xybins, range=xyrange, weights=intensity.imag)
-            hist2d = hist2dr + 1j*hist2di
+        if xBins is None:
+            xBins = histogram_bins(x, plot.xaxis.limits, plot.xaxis.bins)
+        if yBins is None:
+            yBins = histogram_bins(y, plot.yaxis.limits, plot.yaxis.bins)
+        xyBins = (yBins[0]*xybins[1] + xBins[0], yBins[1] & xBins[1])
+        size2D = xybins[0] * xybins[1]
 
+        if plot.fluxKind.startswith('E'):
+            weights = [intensity.real, intensity.imag]
+        else:
+            weights = [intensity]
+        nI = len(weights)
+        if len(x) > 0 and cDataRGB is not None:
+            weights += [cDataRGB[:, i] for i in range(3)]
+        hists = [h.reshape(xybins) for h in
+                 histogram_weights(xyBins, weights, size2D)]
+
+        if plot.fluxKind.startswith('E'):
+            hist2d = hists[0] + 1j*hists[1]
             if plot.fluxKind.lower().endswith('4d'):
                 hist4d = np.outer(hist2d, hist2d.conjugate())
             elif plot.fluxKind.lower().endswith('pca'):
                 hist4d = hist2d.T
-
         else:
-            hist2d, yedges, xedges = histogram2d(
-                y, x, bins=xybins, range=xyrange, weights=intensity)
+            hist2d = hists[0]
 
         hist2dRGB = np.zeros((xybins[0], xybins[1], 3))
-        if len(x) > 0:
+        if len(x) > 0 and cDataRGB is not None:
             for i in range(3):  # over RGB components
-                hist2dRGB[:, :, i], yedges, xedges = histogram2d(
-                    y, x, bins=xybins, range=xyrange, weights=cDataRGB[:, i])
+                hist2dRGB[:, :, i] = hists[nI+i]
         return hist2d, hist2dRGB, hist4d
 
+    def do_hist_hue(self, xBins, hueInd, flux, size, hueBins):
+        """
+        Accumulates *flux* over the bins *xBins* (an output of
+        :func:`histogram_bins` or a flattened 2D version of it) and the hue
+        bins *hueInd*. Returns an array of shape (*size*, *hueBins*).
+        """
+        xhBins = xBins[0]*hueBins + hueInd, xBins[1]
+        return histogram_weights(
+            xhBins, [flux], size*hueBins)[0].reshape(size, hueBins)
+
     def update_limits(self, axis, x):
         """
         Updates the *axis* limits given the data in *x*. Used at the 1st
@@ -225,12 +481,40 @@ class GenericProcessOrThread(object):
         return xaxis.limits[0], xaxis.limits[1], yaxis.limits[0],\
             yaxis.limits[1]
 
-    def run(self):
+    def seed_sequence(self):
         """
-        Starts the chosen ray-tracing backend, invokes the 1D and 2D
-        histogramming routines and puts them into the output queue.
+        Returns the :class:`numpy.random.SeedSequence` of the current
+        iteration of the process or thread. It is derived from the master
+        seed of the run with the spawn key (generator step, iteration,
+        process or thread), preceded by the shard index in a sharded run,
+        therefore any iteration can be replayed exactly."""
+        key = self.card.step, int(self.iteration), self.idN
+        if self.card.shard is not None:
+            key = (self.card.shard[0],) + key
+        return np.random.SeedSequence(self.card.seedEntropy, spawn_key=key)
+
+    def set_rng(self):
+        """
+        Gives the process or thread its own random generator for the current
+        iteration, see :func:`~xrt.backends.raycing.get_rng`. Without
+        :class:`numpy.random.SeedSequence` (numpy < 1.17), the global random
+        state of numpy is used."""
+        if getattr(self.card, 'seedEntropy', None) is None:
+            raycing.set_rng(None)
+            return
+        raycing.set_rng(
+            np.random.Generator(np.random.PCG64(self.seed_sequence())))
+
+    def seed_random(self):
         """
-        seed = int(time.time()) ^ (os.getpid()+self.idN)
+        Seeds the global random state of numpy in the process or thread, used
+        by the shadow and dummy backends and by user functions. The random
+        numbers in raycing are drawn from the generator set by
+        :meth:`set_rng`."""
+        if getattr(self.card, 'seedEntropy', None) is not None:
+            seed = self.seed_sequence().spawn(1)[0].generate_state(4)
+        else:
+            seed = int(time.time()) ^ (os.getpid()+self.idN)
 #        random.seed(seed) - has no effect!
         np.random.seed(seed)
         if _DEBUG > 2:
@@ -238,6 +522,33 @@ class GenericProcessOrThread(object):
         if _DEBUG > 2:
             print('parent process id:{0}, process id{1}'.format(
                   os.getppid(), os.getpid()))
+
+    def run(self):
+        """
+        Starts the chosen ray-tracing backend, invokes the 1D and 2D
+        histogramming routines and puts them into the output queue.
+        """
+        self.seed_random()
+        self.run_iteration()
+        self.close_shared_accumulators()
+
+    def run_iteration(self):
+        """
+        The body of :meth:`run`: one ray-tracing run followed by
+        histogramming of all plots, see :meth:`trace_iteration`. The random
+        generator of the iteration is removed from the thread afterwards, so
+        that it does not leak into the calling thread (e.g. of a pilot run)
+        or into the next iteration."""
+        self.set_rng()
+        try:
+            self.trace_iteration()
+        finally:
+            raycing.set_rng(None)
+
+    def trace_iteration(self):
+        """
+        Runs the backend once and puts the histograms of all plots into the
+        output queues."""
         if self.card.backend.startswith('shadow'):
             self.alarmQueue.put([])
             ret = shadow.run_process(
@@ -261,106 +572,207 @@ class GenericProcessOrThread(object):
             dummy_output = dummy.run_process()
             self.alarmQueue.put([])
         elif self.card.backend.startswith('raycing'):
-            raycing_output = raycing.run.run_process(self.card.beamLine)
-            self.alarmQueue.put(self.card.beamLine.alarms)
-
-        for plot, queue in zip(self.plots, self.outPlotQueues):
-            displayAsAbsorbedPower = False
-            if self.card.backend.startswith('shadow'):
-                x, y, intensity, cData, locNrays, locNraysNeeded = \
-                    shadow.get_output(
-                        plot, self.card.fPolar, self.card.blockNRays,
-                        self.runDir)
-                flux = intensity
-            elif self.card.backend.startswith('raycing'):
-                x, y, intensity, flux, cData, locNrays, locAlive, locGood,\
-                    locOut, locOver, locDead, locAccepted, locAcceptedE,\
-                    locSeeded, locSeededI =\
-                    raycing.get_output(plot, raycing_output)
-                if hasattr(plot, 'displayAsAbsorbedPower'):
-                    displayAsAbsorbedPower = True
-            elif self.card.backend.startswith('dummy'):
-                x, y, intensity, cData, locNrays = dummy_output
-                flux = intensity
-
-            if self.card.iteration == 0:
-                leadingLimits = None
-                xLimitsDefined = (plot.xaxis.limits is not None) and \
-                    (not isinstance(plot.xaxis.limits, str))
-                yLimitsDefined = (plot.yaxis.limits is not None) and \
-                    (not isinstance(plot.yaxis.limits, str))
-                if xLimitsDefined and (not yLimitsDefined):
-                    leadingLimits = 'x'
-                elif yLimitsDefined and (not xLimitsDefined):
-                    leadingLimits = 'y'
-                xmin, xmax = self.update_limits(plot.xaxis, x)
-                ymin, ymax = self.update_limits(plot.yaxis, y)
-                emin, emax = self.update_limits(plot.caxis, cData)
-                if plot.aspect == 'equal' or isinstance(plot.aspect,
-                                                        (int, float)):
-                    xyeq = self.equalize_xy(plot, leadingLimits)
-                    if xyeq is not None:
-                        xmin, xmax, ymin, ymax = xyeq
-
-            limits = plot.caxis.limits
-            cData01 = ((cData - limits[0]) * plot.colorFactor /
-                       (limits[1] - limits[0])).reshape(-1, 1)
-            cData01[cData01 < 0] = 0.
-            cData01[cData01 > 1] = 1.
-            if plot.invertColorMap:
-                cData01 -= 0.5
-                cData01[cData01 < 0] += 1
+            if getattr(self.card, 'raysPerChunk', None):
+                outLists = self.run_chunks()
+            else:
+                raycing_output = raycing.run.run_process(self.card.beamLine)
+                self.alarmQueue.put(self.card.beamLine.alarms)
+                outLists = [self.histogram_plot(plot, raycing_output)
+                            for plot in self.plots]
+        if not self.card.backend.startswith('raycing'):
+            output = dummy_output if self.card.backend.startswith('dummy')\
+                else None
+            outLists = [self.histogram_plot(plot, output)
+                        for plot in self.plots]
+
+        for iplot, (plot, queue, outList) in enumerate(
+                zip(self.plots, self.outPlotQueues, outLists)):
+            if plot.fluxKind.endswith('log'):
+                for key in (0, 1, 3, 4, 6, 7, 9, 10):
+                    if outList[key] is None:
+                        continue
+                    outList[key] = np.log10(outList[key])
+                    outList[key][np.where(np.isnan(outList[key]))] = 0
+            if self.iteration > 0 and self.card.sharedNames:
+                accumulator = self.get_shared_accumulator(iplot, plot)
+                if accumulator is not None:
+                    accumulator.add(outList)
+                    for key in accumulator.arrays:
+                        outList[key] = None
+            queue.put(outList)
 
+    def run_chunks(self):
+        """
+        Runs :func:`run_process` of the raycing backend in several chunks of
+        at most *raysPerChunk* rays per source (see
+        :func:`~xrt.runner.run_ray_tracing`) and sums the histograms and the
+        ray counters of the chunks. The beams of a chunk are released before
+        the next chunk is traced, so the memory does not grow with the number
+        of rays of the iteration."""
+        bl = self.card.beamLine
+        sources = [source for source in bl.sources
+                   # mesh sources have a fixed grid of rays
+                   if hasattr(source, 'nrays') and not hasattr(source, 'nx')]
+        savedNrays = [np.long(source.nrays) for source in sources]
+        nChunks = max([-(-nrays // self.card.raysPerChunk)
+                       for nrays in savedNrays] + [1])
+        outLists = None
+        alarms = []
+        try:
+            for ichunk in range(nChunks):
+                # the sources are shared by the threads, so the chunk sizes
+                # are set per thread, see raycing.SourceNrays
+                raycing.set_chunk_nrays(
+                    [(source, nrays // nChunks +
+                      (1 if ichunk < nrays % nChunks else 0))
+                     for source, nrays in zip(sources, savedNrays)])
+                raycing_output = raycing.run.run_process(bl)
+                for alarm in bl.alarms:
+                    if alarm not in alarms:
+                        alarms.append(alarm)
+                chunkLists = [self.histogram_plot(plot, raycing_output)
+                              for plot in self.plots]
+                raycing_output = None
+                if outLists is None:
+                    outLists = chunkLists
+                else:
+                    for outList, chunkList in zip(outLists, chunkLists):
+                        add_chunk(outList, chunkList)
+        finally:
+            raycing.set_chunk_nrays(None)
+        self.alarmQueue.put(alarms)
+        return outLists
+
+    def histogram_plot(self, plot, output):
+        """
+        Gets the rays of *plot* from the *output* of the backend and returns
+        the list of its histograms and ray counters, as put into the output
+        queue."""
+        displayAsAbsorbedPower = False
+        if self.card.backend.startswith('shadow'):
+            x, y, intensity, cData, locNrays, locNraysNeeded = \
+                shadow.get_output(
+                    plot, self.card.fPolar, self.card.blockNRays,
+                    self.runDir)
+            flux = intensity
+        elif self.card.backend.startswith('raycing'):
+            x, y, intensity, flux, cData, locNrays, locAlive, locGood,\
+                locOut, locOver, locDead, locAccepted, locAcceptedE,\
+                locSeeded, locSeededI =\
+                raycing.get_output(plot, output)
+            if hasattr(plot, 'displayAsAbsorbedPower'):
+                displayAsAbsorbedPower = True
+        elif self.card.backend.startswith('dummy'):
+            x, y, intensity, cData, locNrays = output
+            flux = intensity
+
+        if self.iteration == 0:
+            leadingLimits = None
+            xLimitsDefined = (plot.xaxis.limits is not None) and \
+                (not isinstance(plot.xaxis.limits, str))
+            yLimitsDefined = (plot.yaxis.limits is not None) and \
+                (not isinstance(plot.yaxis.limits, str))
+            if xLimitsDefined and (not yLimitsDefined):
+                leadingLimits = 'x'
+            elif yLimitsDefined and (not xLimitsDefined):
+                leadingLimits = 'y'
+            xmin, xmax = self.update_limits(plot.xaxis, x)
+            ymin, ymax = self.update_limits(plot.yaxis, y)
+            emin, emax = self.update_limits(plot.caxis, cData)
+            if plot.aspect == 'equal' or isinstance(plot.aspect,
+                                                    (int, float)):
+                xyeq = self.equalize_xy(plot, leadingLimits)
+                if xyeq is not None:
+                    xmin, xmax, ymin, ymax = xyeq
+
+        limits = plot.caxis.limits
+        cData01 = ((cData - limits[0]) * plot.colorFactor /
+                   (limits[1] - limits[0])).reshape(-1, 1)
+        cData01[cData01 < 0] = 0.
+        cData01[cData01 > 1] = 1.
+        if plot.invertColorMap:
+            cData01 -= 0.5
+            cData01[cData01 < 0] += 1
+
+        isHueBinned = is_hue_binned(plot)
+        if isHueBinned:  # no per-ray color conversion, only hue indices
+            hueBins = plot.hueBins
+            hueInd = np.minimum((cData01.ravel() * hueBins).astype(
+                np.intp), hueBins-1)
+            cDataRGB = None
+        else:
             cDataHSV = np.dstack(
                 (cData01, np.ones_like(cData01) * plot.colorSaturation,
                  flux.reshape(-1, 1)))
             cDataRGB = (mpl.colors.hsv_to_rgb(cDataHSV)).reshape(-1, 3)
+# bin indices, calculated once per axis
+        xBins = histogram_bins(x, plot.xaxis.limits, plot.xaxis.bins)
+        yBins = histogram_bins(y, plot.yaxis.limits, plot.yaxis.bins)
+        eBins = histogram_bins(cData, plot.caxis.limits, plot.caxis.bins)\
+            if plot.ePos and isHueBinned else None
 # 1D x, y and cData histograms
-            xh, xhRGB, xbe = self.do_hist1d(x, flux, cDataRGB, plot.xaxis)
-            yh, yhRGB, ybe = self.do_hist1d(y, flux, cDataRGB, plot.yaxis)
-            if plot.ePos:
-                eh, ehRGB, ebe = self.do_hist1d(
-                    cData, flux, cDataRGB, plot.caxis)
-            else:
-                eh, ehRGB, ebe = None, None, None
+        xh, xhRGB, xbe = self.do_hist1d(
+            x, flux, cDataRGB, plot.xaxis, xBins)
+        yh, yhRGB, ybe = self.do_hist1d(
+            y, flux, cDataRGB, plot.yaxis, yBins)
+        if plot.ePos:
+            eh, ehRGB, ebe = self.do_hist1d(
+                cData, flux, cDataRGB, plot.caxis, eBins)
+        else:
+            eh, ehRGB, ebe = None, None, None
 # 2D histogram
-            res = self.do_hist2d(x, y, intensity, cDataRGB, plot)
-            xyh, xyhRGB = res[0], res[1]
-            is4d = (plot.fluxKind.lower().endswith('4d') or
-                    plot.fluxKind.lower().endswith('pca'))
-            xyh4 = res[2] if is4d else None
-
-            if plot.fluxKind.endswith('log'):
-                xh = np.log10(xh)
-                xh[np.where(np.isnan(xh))] = 0
-                xhRGB = np.log10(xhRGB)
-                xhRGB[np.where(np.isnan(xhRGB))] = 0
-                yh = np.log10(yh)
-                yh[np.where(np.isnan(yh))] = 0
-                yhRGB = np.log10(yhRGB)
-                yhRGB[np.where(np.isnan(yhRGB))] = 0
-                if plot.ePos:
-                    eh = np.log10(eh)
-                    eh[np.where(np.isnan(eh))] = 0
-                    ehRGB = np.log10(ehRGB)
-                    ehRGB[np.where(np.isnan(ehRGB))] = 0
-                xyh = np.log10(xyh)
-                xyh[np.where(np.isnan(xyh))] = 0
-                xyhRGB = np.log10(xyhRGB)
-                xyhRGB[np.where(np.isnan(xyhRGB))] = 0
-
-            outList = [xh, xhRGB, xbe, yh, yhRGB, ybe,
-                       eh, ehRGB, ebe, xyh, xyhRGB, xyh4, sum(flux), locNrays]
-            if self.card.backend.startswith('shadow'):
-                outList.append(locNraysNeeded)
-            elif self.card.backend.startswith('raycing'):
-                outList.append((locAlive, locGood, locOut, locOver, locDead,
-                                locAccepted, locAcceptedE, locSeeded,
-                                locSeededI))
-            outList.append(displayAsAbsorbedPower)
-            if self.card.iteration == 0:  # needed for multiprocessing
-                outList.append((xmin, xmax, ymin, ymax, emin, emax))
-            queue.put(outList)
+        res = self.do_hist2d(x, y, intensity, cDataRGB, plot, xBins, yBins)
+        xyh, xyhRGB = res[0], res[1]
+        if isHueBinned:  # hue-binned histograms instead of the RGB ones
+            xhRGB = self.do_hist_hue(
+                xBins, hueInd, flux, plot.xaxis.bins, hueBins)
+            yhRGB = self.do_hist_hue(
+                yBins, hueInd, flux, plot.yaxis.bins, hueBins)
+            if plot.ePos:
+                ehRGB = self.do_hist_hue(
+                    eBins, hueInd, flux, plot.caxis.bins, hueBins)
+            xyBins = (yBins[0]*plot.xaxis.bins + xBins[0],
+                      yBins[1] & xBins[1])
+            xyhRGB = self.do_hist_hue(
+                xyBins, hueInd, flux, plot.yaxis.bins*plot.xaxis.bins,
+                hueBins).reshape(plot.yaxis.bins, plot.xaxis.bins,
+                                 hueBins)
+        is4d = (plot.fluxKind.lower().endswith('4d') or
+                plot.fluxKind.lower().endswith('pca'))
+        xyh4 = res[2] if is4d else None
+
+        outList = [xh, xhRGB, xbe, yh, yhRGB, ybe,
+                   eh, ehRGB, ebe, xyh, xyhRGB, xyh4, sum(flux), locNrays]
+        if self.card.backend.startswith('shadow'):
+            outList.append(locNraysNeeded)
+        elif self.card.backend.startswith('raycing'):
+            outList.append((locAlive, locGood, locOut, locOver, locDead,
+                            locAccepted, locAcceptedE, locSeeded,
+                            locSeededI))
+        outList.append(displayAsAbsorbedPower)
+        if self.iteration == 0:  # needed for multiprocessing
+            outList.append((xmin, xmax, ymin, ymax, emin, emax))
+        return outList
+
+    def get_shared_accumulator(self, iplot, plot):
+        """Attaches to the shared memory block of the plot number *iplot*
+        assigned to this worker."""
+        names = self.card.sharedNames[self.idN]
+        if names[iplot] is None:
+            return
+        if self.sharedAccumulators is None:
+            self.sharedAccumulators = {}
+        if iplot not in self.sharedAccumulators:
+            self.sharedAccumulators[iplot] = SharedAccumulator(
+                plot, names[iplot])
+        return self.sharedAccumulators[iplot]
+
+    def close_shared_accumulators(self):
+        if self.sharedAccumulators is None:
+            return
+        for accumulator in self.sharedAccumulators.values():
+            accumulator.close()
+        self.sharedAccumulators = None
 
 
 class BackendProcess(GenericProcessOrThread, Process):
@@ -375,3 +787,48 @@ class BackendThread(GenericProcessOrThread, Thread):
         Thread.__init__(self)
         GenericProcessOrThread.__init__(self, locCard, plots, outPlotQueues,
                                         alarmQueue, idLoc)
+
+
+class GenericPersistentWorker(GenericProcessOrThread):
+    """
+    Defines a long-lived ray tracing process or thread. The beamline and the
+    plot cards are received once at the start; each item got from
+    *taskQueue* is the index of the iteration to run. None stops the worker.
+    """
+    def __init__(self, locCard, plots, outPlotQueues, alarmQueue, idLoc,
+                 taskQueue):
+        GenericProcessOrThread.__init__(self, locCard, plots, outPlotQueues,
+                                        alarmQueue, idLoc)
+        self.taskQueue = taskQueue
+
+    def run(self):
+        """
+        Waits for iteration tokens and runs :meth:`run_iteration` for each of
+        them until the token None is received.
+        """
+        self.seed_random()
+        while True:
+            task = self.taskQueue.get()
+            if task is None:
+                break
+            self.iteration = task
+            self.run_iteration()
+        self.close_shared_accumulators()
+
+
+class PersistentProcess(GenericPersistentWorker, Process):
+    def __init__(self, locCard, plots, outPlotQueues, alarmQueue, idLoc,
+                 taskQueue):
+        Process.__init__(self)
+        GenericPersistentWorker.__init__(
+            self, locCard, plots, outPlotQueues, alarmQueue, idLoc, taskQueue)
+        self.daemon = True
+
+
+class PersistentThread(GenericPersistentWorker, Thread):
+    def __init__(self, locCard, plots, outPlotQueues, alarmQueue, idLoc,
+                 taskQueue):
+        Thread.__init__(self)
+        GenericPersistentWorker.__init__(
+            self, locCard, plots, outPlotQueues, alarmQueue, idLoc, taskQueue)
+        self.daemon = True
@@ -52,6 +52,7 @@ import scipy as sp
 import matplotlib as mpl
 from matplotlib.ticker import MaxNLocator
 from . import runner
+from . import multipro
 # from runner import runCardVals, runCardProcs
 from .backends import raycing
 try:
@@ -83,7 +84,6 @@ mpl.rcParams['axes.linewidth'] = 0.75
 #mpl.rcParams['backend'] = 'Agg'
 #mpl.rcParams['xtick.major.pad'] = '5'
 #mpl.rcParams['ytick.major.pad'] = '5'
-import matplotlib.pyplot as plt
 
 epsHist = 1e-100  # prevents problem with normalization of histograms
 # [Sizes and positions of plots]
@@ -435,6 +435,8 @@ class XYCPlot(object):
     images, this class provides with useful fields like *dx*, *dy*, *dE*
     (FWHM), *cx*, *cy*, *cE* (centers) and *intensity* which can be used in
     scripts for producing scan-like results."""
+    headless = False
+
     def __init__(
         self, beam=None, rayFlag=(1,), xaxis=None, yaxis=None, caxis=None,
         aspect='equal', xPos=1, yPos=1, ePos=1, title='',
@@ -443,7 +445,8 @@ class XYCPlot(object):
         fluxFormatStr='auto', contourLevels=None, contourColors=None,
         contourFmt='%.1f', contourFactor=1., saveName=None,
         persistentName=None, oe=None, raycingParam=0,
-            beamState=None, beamC=None, useQtWidget=False):
+            beamState=None, beamC=None, useQtWidget=False, hueBins=None,
+            errorROI=None):
         u"""
         *beam*: str
             The beam to be visualized.
@@ -672,55 +675,37 @@ class XYCPlot(object):
             The same as *beamState* but refers to colors (when not of
             'category' type).
 
+        *hueBins*: int or None
+            If given, the colored histograms are accumulated not as RGB but as
+            flux histograms over *hueBins* bins of the color value, i.e. of
+            shape (yaxis.bins, xaxis.bins, *hueBins*) for the 2D histogram.
+            The conversion to RGB is done once per pixel at the time of
+            drawing instead of once per ray, which saves a significant time
+            for millions of rays. The color of each ray is thus rounded to
+            the center of its hue bin, a few tens of bins are visually
+            indistinguishable from the exact coloring. Ignored for the
+            mutual intensity cuts ('xx', 'zz'), for the logarithmic
+            *fluxKind* and for the 'kde' densities.
+
+        *errorROI*: [xmin, xmax, ymin, ymax] or None
+            The region of the 2D histogram (in the units of the axes) where
+            the relative statistical error is evaluated when the run is
+            stopped on reaching *targetError*, see
+            :func:`~xrt.runner.run_ray_tracing`. If None, the whole 2D
+            histogram is used.
+
 
         """
+        import matplotlib.pyplot as plt  # not needed by HeadlessPlot
         if not hasQt:
             useQtWidget = False
         if not useQtWidget:
             plt.ion()
         self.colorSaturation = colorSaturation
 
-        self.beam = beam  # binary shadow image: star, mirr or screen
-        if beam is None:
-            self.backend = 'raycing'
-        elif '.' in beam:
-            self.backend = 'shadow'
-        elif ('dummy' in beam) or (beam == ''):
-            self.backend = 'dummy'
-        elif isinstance(rayFlag, (tuple, list)):
-            self.backend = 'raycing'
-        else:
-            self.backend = 'dummy'
-        self.beamState = beamState
-        self.beamC = beamC
-        self.rayFlag = rayFlag
-        self.fluxKind = fluxKind
-        self.fluxUnit = fluxUnit
-        if xaxis is None:
-            self.xaxis = XYCAxis(defaultXTitle, defaultXUnit)
-        else:
-            self.xaxis = xaxis
-        if yaxis is None:
-            self.yaxis = XYCAxis(defaultYTitle, defaultYUnit)
-        else:
-            self.yaxis = yaxis
-        if (caxis is None) or isinstance(caxis, basestring):
-            self.caxis = XYCAxis(defaultCTitle, defaultCUnit, factor=1.,)
-            self.caxis.fwhmFormatStr = defaultFwhmFormatStrForCAxis
-            if isinstance(caxis, basestring):
-                self.caxis.useCategory = True
-                ePos = 0
-        else:
-            self.caxis = caxis
-
-        if self.backend != 'dummy':
-            for axis in self.xaxis, self.yaxis, self.caxis:
-                if axis.data == 'auto':
-                    axis.auto_assign_data(self.backend)
-                if axis.factor is None:
-                    axis.auto_assign_factor(self.backend)
-
-        self.reset_bins2D()
+        ePos = self._init_accumulation(
+            beam, rayFlag, beamState, beamC, fluxKind, fluxUnit, hueBins,
+            errorROI, xaxis, yaxis, caxis, ePos)
 
         if isinstance(aspect, (int, float)):
             if aspect <= 0:
@@ -1046,6 +1031,60 @@ class XYCPlot(object):
             plt.ioff()
         self.fig.canvas.draw()
 
+    def _init_accumulation(self, beam, rayFlag, beamState, beamC, fluxKind,
+                           fluxUnit, hueBins, errorROI, xaxis, yaxis, caxis,
+                           ePos):
+        """
+        The part of :meth:`__init__` that defines the backend, the axes and
+        the histogram arrays, common with :class:`HeadlessPlot`. Returns
+        *ePos*, which is 0 for the 'category' *caxis*.
+        """
+        self.beam = beam  # binary shadow image: star, mirr or screen
+        if beam is None:
+            self.backend = 'raycing'
+        elif '.' in beam:
+            self.backend = 'shadow'
+        elif ('dummy' in beam) or (beam == ''):
+            self.backend = 'dummy'
+        elif isinstance(rayFlag, (tuple, list)):
+            self.backend = 'raycing'
+        else:
+            self.backend = 'dummy'
+        self.beamState = beamState
+        self.beamC = beamC
+        self.rayFlag = rayFlag
+        self.fluxKind = fluxKind
+        self.fluxUnit = fluxUnit
+        self.hueBins = hueBins
+        self.errorROI = errorROI
+        self.statError = None
+        if xaxis is None:
+            self.xaxis = XYCAxis(defaultXTitle, defaultXUnit)
+        else:
+            self.xaxis = xaxis
+        if yaxis is None:
+            self.yaxis = XYCAxis(defaultYTitle, defaultYUnit)
+        else:
+            self.yaxis = yaxis
+        if (caxis is None) or isinstance(caxis, basestring):
+            self.caxis = XYCAxis(defaultCTitle, defaultCUnit, factor=1.,)
+            self.caxis.fwhmFormatStr = defaultFwhmFormatStrForCAxis
+            if isinstance(caxis, basestring):
+                self.caxis.useCategory = True
+                ePos = 0
+        else:
+            self.caxis = caxis
+
+        if self.backend != 'dummy':
+            for axis in self.xaxis, self.yaxis, self.caxis:
+                if axis.data == 'auto':
+                    axis.auto_assign_data(self.backend)
+                if axis.factor is None:
+                    axis.auto_assign_factor(self.backend)
+
+        self.reset_bins2D()
+        return ePos
+
     def reset_bins2D(self):
         if self.fluxKind.startswith('E'):
             dtype = np.complex128
@@ -1063,12 +1102,80 @@ class XYCPlot(object):
         self.isPCA = self.fluxKind.lower().endswith('pca')
         if self.isPCA:
             self.total4D = []
+        if self.hueBins:
+            self.total2D_hue = np.zeros(
+                (self.yaxis.bins, self.xaxis.bins, self.hueBins))
 
         for ax in [self.xaxis, self.yaxis, self.caxis]:
             if isinstance(ax, XYCAxis):
                 ax.binEdges = np.zeros(ax.bins + 1)
                 ax.total1D = np.zeros(ax.bins)
                 ax.total1D_RGB = np.zeros((ax.bins, 3))
+                if self.hueBins:
+                    ax.total1D_hue = np.zeros((ax.bins, self.hueBins))
+
+    def hue_to_RGB(self):
+        """
+        Converts the hue-binned histograms into the RGB histograms that are
+        used for drawing. Does nothing if the plot is not hue-binned, see
+        *hueBins* in :meth:`__init__`.
+        """
+        if not multipro.is_hue_binned(self):
+            return
+        palette = multipro.hue_palette(self.hueBins, self.colorSaturation)
+        for axis in [self.xaxis, self.yaxis, self.caxis]:
+            axis.total1D_RGB[:] = np.dot(axis.total1D_hue, palette)
+        self.total2D_RGB[:] = np.dot(self.total2D_hue, palette)
+
+    def reset_error(self):
+        """
+        Resets the sums over batches (the histograms of one process or thread
+        in one iteration) used for the statistical error, see *targetError*
+        in :func:`~xrt.runner.run_ray_tracing`.
+        """
+        self.errorS1 = np.zeros((self.yaxis.bins, self.xaxis.bins))
+        self.errorS2 = np.zeros((self.yaxis.bins, self.xaxis.bins))
+        self.errorBatches = 0
+        self.statError = None
+
+    def add_error_batch(self, hist2D):
+        """
+        Adds the 2D histogram *hist2D* of one batch to the sums of
+        :meth:`reset_error`. The field amplitude histograms ('E' in
+        *fluxKind*) are not considered.
+        """
+        if self.fluxKind.startswith('E') or (hist2D is None):
+            return
+        self.errorS1 += hist2D
+        self.errorS2 += hist2D**2
+        self.errorBatches += 1
+
+    def update_error(self):
+        """
+        Calculates the relative statistical error *statError* of the 2D
+        histogram within *errorROI* from the scatter between the batches. Of
+        n batches with the sums S1 and S2 of the values and their squares,
+        the error of the accumulated value is (n/(n-1)·(S2 - S1²/n))^0.5,
+        i.e. n^0.5 times the unbiased standard deviation of one batch.
+        *statError* is the sum of these errors over the bins of the region
+        divided by the sum of the histogram over it.
+        """
+        n = self.errorBatches
+        if n < 2:
+            return
+        sigma = np.sqrt(np.maximum(
+            self.errorS2 - self.errorS1**2/n, 0) * n/(n-1.))
+        inROI = np.ones_like(sigma, dtype=bool)
+        if self.errorROI is not None:
+            xmin, xmax, ymin, ymax = self.errorROI
+            xe, ye = self.xaxis.binEdges, self.yaxis.binEdges
+            xc = (xe[:-1] + xe[1:]) * 0.5
+            yc = (ye[:-1] + ye[1:]) * 0.5
+            inROI = np.outer((yc >= ymin) & (yc <= ymax),
+                             (xc >= xmin) & (xc <= xmax))
+        sumROI = self.errorS1[inROI].sum()
+        if sumROI > 0:
+            self.statError = sigma[inROI].sum() / sumROI
 
     def update_user_elements(self):
         return  # 'user message'
@@ -1392,7 +1499,8 @@ class XYCPlot(object):
 
     def plot_hist2d(self):
         """
-        Plots the 2D histogram as imshow.
+        Plots the 2D histogram as imshow. The hue-binned histograms are
+        converted to RGB in :meth:`hue_to_RGB` before any drawing.
         """
         tRGB = self.total2D_RGB
         self.max2D_RGB = float(np.max(tRGB))
@@ -1518,6 +1626,7 @@ class XYCPlot(object):
         """
         Does all graphics update.
         """
+        self.hue_to_RGB()
         self.cx, self.dx = self.plot_hist1d('x')
         self.cy, self.dy = self.plot_hist1d('y')
 
@@ -1647,6 +1756,10 @@ class XYCPlot(object):
             axis.total1D_RGB[:] = np.zeros((axis.bins, 3))
         self.total2D[:] = np.zeros((self.yaxis.bins, self.xaxis.bins))
         self.total2D_RGB[:] = np.zeros((self.yaxis.bins, self.xaxis.bins, 3))
+        if self.hueBins:
+            for axis in [self.xaxis, self.yaxis, self.caxis]:
+                axis.total1D_hue[:] = 0
+            self.total2D_hue[:] = 0
         if self.is4D:
             if self.fluxKind.startswith('E'):
                 dtype = np.complex128
@@ -1749,6 +1862,7 @@ class XYCPlot(object):
         Pickles the accumulated arrays (histograms) and values (like flux) into
         the binary file *persistentName*.
         """
+        self.hue_to_RGB()
         saved = SaveResults(self)
         if runner.runCardVals.globalNorm:
             runner.runCardVals.savedResults.append(saved)
@@ -1757,6 +1871,8 @@ class XYCPlot(object):
                 pn = self.persistentName[0]
             else:
                 pn = self.persistentName
+            pn = runner.shard_name(
+                pn, getattr(runner.runCardVals, 'shard', None))
             if pn.endswith('mat'):
                 import scipy.io as io
                 #if os.path.isfile(self.persistentName):
@@ -1777,6 +1893,9 @@ class XYCPlot(object):
                     pns = self.persistentName
                 else:
                     pns = self.persistentName,
+                # only the stored (the 1st) file is the shard's own one:
+                shard = getattr(runner.runCardVals, 'shard', None)
+                pns = [runner.shard_name(pns[0], shard)] + list(pns[1:])
                 for pn in pns:
                     if pn.endswith('mat'):
                         import scipy.io as io
@@ -1835,6 +1954,138 @@ class XYCPlotWithNumerOfReflections(XYCPlot):
             del self.textUser[:]
 
 
+class HeadlessPlot(XYCPlot):
+    u"""
+    A plot without graphics for batch jobs, e.g. on cluster nodes. It
+    accumulates the same histograms and ray counters as :class:`XYCPlot`
+    with the same binning by :class:`XYCAxis` and gives the same fields *cx*,
+    *dx*, *cy*, *dy*, *cE*, *dE*, *intensity*, *flux* and *power* but
+    neither imports matplotlib.pyplot nor creates a figure. It can be passed
+    to :func:`~xrt.runner.run_ray_tracing` alone or together with
+    :class:`XYCPlot` instances; if all plots are headless, pyplot is never
+    imported. The accumulated results are stored as :class:`SaveResults`.
+    """
+    headless = True
+
+    def __init__(
+        self, beam=None, rayFlag=(1,), xaxis=None, yaxis=None, caxis=None,
+        aspect='equal', ePos=1, title='', fluxKind='total', fluxUnit='auto',
+        saveName=None, persistentName=None, beamState=None, beamC=None,
+            hueBins=None, errorROI=None):
+        u"""
+        The parameters are those of :class:`XYCPlot` of the same names except
+        *saveName*.
+
+        *saveName*: str or None
+            The file name where :meth:`save` writes the accumulated results as
+            :class:`SaveResults`, a Matlab file if it ends with '.mat', a
+            pickle otherwise. Can be changed by a generator at each step.
+        """
+        self.colorSaturation = colorSaturation
+        ePos = self._init_accumulation(
+            beam, rayFlag, beamState, beamC, fluxKind, fluxUnit, hueBins,
+            errorROI, xaxis, yaxis, caxis, ePos)
+        if isinstance(aspect, (int, float)):
+            if aspect <= 0:
+                aspect = 1.
+        self.aspect = aspect
+        self.ePos = ePos
+        self.invertColorMap = False
+        self.saveName = saveName
+        self.persistentName = persistentName
+        if title != '':
+            self.title = title
+        elif isinstance(beam, basestring):
+            self.title = beam
+        else:
+            self.title = ' '
+        self.cx, self.dx = 0, 0
+        self.cy, self.dy = 0, 0
+        self.cE, self.dE = 0, 0
+        self.power = 0.
+        self.flux = 0.
+        self.displayAsAbsorbedPower = False
+        self.reset_counters()
+
+    def reset_counters(self):
+        """Zeroes the ray counters and the flux."""
+        self.nRaysAll = np.long(0)
+        self.nRaysAllRestored = np.long(-1)
+        self.intensity = 0.
+        self.nRaysNeeded = np.long(0)
+        self.nRaysAlive = np.long(0)
+        self.nRaysGood = np.long(0)
+        self.nRaysOut = np.long(0)
+        self.nRaysOver = np.long(0)
+        self.nRaysDead = np.long(0)
+        self.nRaysAccepted = np.long(0)
+        self.nRaysAcceptedE = 0.
+        self.nRaysSeeded = np.long(0)
+        self.nRaysSeededI = 0.
+
+    def get_center_fwhm(self, axis):
+        """Returns the center and the FWHM of the 1D histogram of *axis*,
+        calculated as in :meth:`XYCPlot.plot_hist1d`."""
+        t1D = axis.total1D
+        axis.max1D = float(np.max(t1D))
+        axis.max1D_RGB = float(np.max(axis.total1D_RGB))
+        if axis.max1D > 0:
+            args = np.argwhere(t1D >= axis.max1D * 0.5)
+            fwhm = axis.binEdges[np.max(args) + 1] -\
+                axis.binEdges[np.min(args)]
+        else:
+            fwhm = 0
+        axis.binCenters = (axis.binEdges[:-1]+axis.binEdges[1:]) * 0.5
+        ave = t1D.sum()
+        if ave != 0:
+            ave = (t1D * axis.binCenters).sum() / ave
+        return ave, fwhm
+
+    def plot_plots(self):
+        """
+        Calculates the centers and FWHMs of the 1D histograms and the flux or
+        power, nothing is drawn.
+        """
+        self.hue_to_RGB()
+        self.cx, self.dx = self.get_center_fwhm(self.xaxis)
+        self.cy, self.dy = self.get_center_fwhm(self.yaxis)
+        if self.ePos != 0:
+            self.cE, self.dE = self.get_center_fwhm(self.caxis)
+        self.max2D_RGB = float(np.max(self.total2D_RGB))
+        if self.nRaysAll > 0:
+            self._get_power()
+            if self.nRaysSeeded > 0:
+                self._get_flux()
+
+    def save(self, suffix=''):
+        """
+        Writes :class:`SaveResults` of the plot into *saveName*. The *suffix*
+        of the global normalization is ignored, as the results do not depend
+        on it.
+        """
+        if (self.saveName is None) or suffix:
+            return
+        self.hue_to_RGB()
+        saved = SaveResults(self)
+        if self.saveName.endswith('mat'):
+            import scipy.io as io
+            io.savemat(self.saveName, vars(saved))
+        else:
+            with open(self.saveName, 'wb') as f:
+                pickle.dump(saved, f, protocol=2)
+
+    def clean_plots(self):
+        """
+        Zeroes the accumulated histograms and the ray counters in order to
+        prepare the plot for the next ray tracing.
+        """
+        runner.runCardVals.iteration = 0
+        runner.runCardVals.stop_event.clear()
+        runner.runCardVals.finished_event.clear()
+        self.reset_bins2D()
+        self.reset_counters()
+
+
 class PlotCard2Pickle(object):
     """
     Container for a minimum set of properties (a "card") describing the plot.
@@ -1855,6 +2106,7 @@ class PlotCard2Pickle(object):
         self.colorSaturation = colorSaturation
         self.fluxKind = plot.fluxKind
         self.title = plot.title
+        self.hueBins = plot.hueBins
 
 
 class SaveResults(object):
@@ -1862,6 +2114,14 @@ class SaveResults(object):
     Container for the accumulated arrays (histograms) and values (like flux)
     for subsequent pickling/unpickling or for global flux normalization.
     """
+    summedFields = ['xtotal1D', 'xtotal1D_RGB', 'ytotal1D', 'ytotal1D_RGB',
+                    'etotal1D', 'etotal1D_RGB', 'total2D', 'total2D_RGB',
+                    'xtotal1D_hue', 'ytotal1D_hue', 'etotal1D_hue',
+                    'total2D_hue', 'nRaysAll', 'intensity', 'nRaysNeeded',
+                    'nRaysAlive', 'nRaysGood', 'nRaysOut', 'nRaysOver',
+                    'nRaysDead', 'nRaysAccepted', 'nRaysAcceptedE',
+                    'nRaysSeeded', 'nRaysSeededI']
+
     def __init__(self, plot):
         """
         Stores the arrays and values and finds the global histogram maxima.
@@ -1874,6 +2134,11 @@ class SaveResults(object):
         self.etotal1D_RGB = copy.copy(plot.caxis.total1D_RGB)
         self.total2D = copy.copy(plot.total2D)
         self.total2D_RGB = copy.copy(plot.total2D_RGB)
+        if getattr(plot, 'hueBins', None):
+            self.xtotal1D_hue = copy.copy(plot.xaxis.total1D_hue)
+            self.ytotal1D_hue = copy.copy(plot.yaxis.total1D_hue)
+            self.etotal1D_hue = copy.copy(plot.caxis.total1D_hue)
+            self.total2D_hue = copy.copy(plot.total2D_hue)
 
         axes = [plot.xaxis, plot.yaxis]
         if plot.ePos:
@@ -1908,6 +2173,8 @@ class SaveResults(object):
         self.ybinEdges = plot.yaxis.binEdges
         self.ebinEdges = plot.caxis.binEdges
         self.fluxKind = plot.fluxKind
+        if getattr(plot, 'statError', None) is not None:
+            self.statError = plot.statError
 
     def restore(self, plot):
         """
@@ -1924,6 +2191,11 @@ class SaveResults(object):
         plot.caxis.total1D_RGB += np.squeeze(self.etotal1D_RGB)
         plot.total2D += np.squeeze(self.total2D)
         plot.total2D_RGB += np.squeeze(self.total2D_RGB)
+        if getattr(plot, 'hueBins', None) and hasattr(self, 'total2D_hue'):
+            plot.xaxis.total1D_hue += np.squeeze(self.xtotal1D_hue)
+            plot.yaxis.total1D_hue += np.squeeze(self.ytotal1D_hue)
+            plot.caxis.total1D_hue += np.squeeze(self.etotal1D_hue)
+            plot.total2D_hue += np.squeeze(self.total2D_hue)
 
         plot.nRaysAll += np.squeeze(self.nRaysAll)
         plot.nRaysAllRestored += np.squeeze(self.nRaysAll)
@@ -1950,9 +2222,93 @@ class SaveResults(object):
         plot.yaxis.binEdges = np.copy(np.squeeze(self.ybinEdges))
         plot.caxis.binEdges = np.copy(np.squeeze(self.ebinEdges))
         plot.fluxKind = np.array_str(np.copy(np.squeeze(self.fluxKind)))
+        if hasattr(self, 'statError'):
+            plot.statError = float(np.squeeze(self.statError))
+
+    def add(self, other):
+        """
+        Adds the histograms and the ray counters of *other*, another instance
+        of :class:`SaveResults`, e.g. from a different shard of the same
+        study, see *shard* in :func:`~xrt.runner.run_ray_tracing`. Raises
+        ValueError if the two were not accumulated with the same limits, bin
+        edges and flux kind.
+        """
+        for field in ['xlimits', 'ylimits', 'elimits',
+                      'xbinEdges', 'ybinEdges', 'ebinEdges']:
+            mine = np.squeeze(getattr(self, field))
+            his = np.squeeze(getattr(other, field))
+            if (mine.shape != his.shape) or not np.allclose(mine, his):
+                raise ValueError('cannot merge results with different {0}: '
+                                 '{1} and {2}'.format(field, mine, his))
+        mine = np.array_str(np.squeeze(self.fluxKind))
+        his = np.array_str(np.squeeze(other.fluxKind))
+        if mine != his:
+            raise ValueError('cannot merge results with different fluxKind: '
+                             '{0} and {1}'.format(mine, his))
+        if hasattr(self, 'total2D_hue') != hasattr(other, 'total2D_hue'):
+            raise ValueError('cannot merge results with and without hueBins')
+
+        for field in self.summedFields:
+            if hasattr(other, field):
+                if hasattr(self, field):
+                    setattr(self, field, np.squeeze(getattr(self, field)) +
+                            np.squeeze(getattr(other, field)))
+                else:
+                    setattr(self, field,
+                            np.copy(np.squeeze(getattr(other, field))))
+        # the error of the sum is not known from the errors of the parts:
+        self.__dict__.pop('statError', None)
 
 
 #    def __getstate__(self):
 #        odict = self.__dict__.copy() # copy the dict since we change it
 #        del odict['plot']  # remove plot reference, it cannot be pickled
 #        return odict
+
+
+def load_results(fileName):
+    """
+    Loads an instance of :class:`SaveResults` from the pickle or Matlab file
+    *fileName* written by :meth:`XYCPlot.store_plots`.
+    """
+    if fileName.endswith('mat'):
+        import scipy.io as io
+        saved_dic = {}
+        io.loadmat(fileName, saved_dic)
+        saved = SaveResults.__new__(SaveResults)
+        saved.__dict__.update((key, value) for key, value in
+                               saved_dic.items() if not key.startswith('__'))
+    else:
+        with open(fileName, 'rb') as f:
+            saved = pickle.load(f)
+    return saved
+
+
+def merge_results(fileNames, outName=None):
+    """
+    Sums the results stored in the persistent files *fileNames* (see
+    *persistentName* of :class:`XYCPlot`), typically written by the shards
+    of one study, see *shard* in :func:`~xrt.runner.run_ray_tracing`. The
+    histograms and the ray counters are added up; the limits, the bin edges
+    and the flux kind must be the same in all the files, otherwise
+    ValueError is raised. If *outName* is given, the merged results are
+    written to it (a Matlab file if it ends with '.mat'), which can then be
+    used as *persistentName* of a plot for drawing or for continuing the
+    study. Returns the merged :class:`SaveResults`.
+    """
+    if len(fileNames) == 0:
+        raise ValueError('no files to merge')
+    merged = load_results(fileNames[0])
+    for fileName in fileNames[1:]:
+        try:
+            merged.add(load_results(fileName))
+        except ValueError as e:
+            raise ValueError('{0}: {1}'.format(fileName, e))
+    if outName is not None:
+        if outName.endswith('mat'):
+            import scipy.io as io
+            io.savemat(outName, vars(merged))
+        else:
+            with open(outName, 'wb') as f:
+                pickle.dump(merged, f, protocol=2)
+    return merged
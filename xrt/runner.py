@@ -14,7 +14,6 @@ import inspect
 import pickle
 import numpy as np
 import matplotlib as mpl
-import matplotlib.pyplot as plt
 import multiprocessing
 import errno
 import threading
@@ -30,6 +29,7 @@ from .backends import raycing
 
 # _DEBUG = True
 __fdir__ = os.path.abspath(os.path.dirname(__file__))
+minErrorBatches = 4  # min number of batches for stopping on targetError
 runCardVals = None
 runCardProcs = None
 _plots = []
@@ -58,7 +58,10 @@ class RunCardVals(object):
     objects for passing it to job processes or threads.
     """
     def __init__(self, threads, processes, repeats, updateEvery, pickleEvery,
-                 backend, globalNorm, runfile):
+                 backend, globalNorm, runfile, persistentWorkers=False,
+                 sharedAccumulation=False, pilotRays=None,
+                 scanProcesses=None, shard=None, seed=None,
+                 targetError=None, raysPerChunk=None):
         if threads >= processes:
             self.Event = threading.Event
             self.Queue = Queue.Queue
@@ -79,6 +82,27 @@ class RunCardVals(object):
         self.backend = backend
         self.globalNorm = globalNorm
         self.runfile = runfile
+        self.persistentWorkers = persistentWorkers
+        # the batch statistics for targetError need the histograms of every
+        # batch at the job server:
+        self.sharedAccumulation = sharedAccumulation and not targetError
+        self.targetError = targetError
+        self.converged = False
+        self.sharedNames = None
+        self.pilotRays = pilotRays
+        self.raysPerChunk = raysPerChunk
+        self.scanProcesses = scanProcesses
+        self.shard = shard
+        if shard is not None:
+            self.repeats = shard_repeats(repeats, shard)
+        self.seed = seed
+        self.step = 0  # generator step
+        # common to all workers of the run; their random streams are told
+        # apart by the spawn key (shard, step, iteration, worker):
+        if hasattr(np.random, 'SeedSequence'):  # numpy >= 1.17
+            self.seedEntropy = np.random.SeedSequence(seed).entropy
+        else:
+            self.seedEntropy = None
         self.passNo = 0
         self.savedResults = []
         self.iteration = 0
@@ -118,11 +142,52 @@ class RunCardProcs(object):
         self.afterScriptKWargs = afterScriptKWargs
         self.generatorNorm = None
         self.generatorPlot = None
+        self.generatorScan = None
+        self.workers = []
+        self.taskQueues = []
+        self.workerPlotQueues = []
+        self.workerAlarmQueue = None
+        self.sharedAccumulators = []
 
 
 def set_repeats(repeats=0):
     if runCardVals is not None:
-        runCardVals.repeats = repeats
+        runCardVals.repeats = shard_repeats(repeats, runCardVals.shard)
+
+
+def shard_repeats(repeats, shard):
+    """Returns the number of repeats run by the shard *shard* = (index, count)
+    out of the total *repeats*."""
+    if shard is None:
+        return repeats
+    index, count = shard
+    return repeats // count + (1 if index < repeats % count else 0)
+
+
+def shard_name(fileName, shard):
+    """Inserts the shard suffix into *fileName* before its extension, e.g.
+    'res.pickle' becomes 'res-shard1of4.pickle' for *shard* = (1, 4)."""
+    if shard is None:
+        return fileName
+    base, ext = os.path.splitext(fileName)
+    return '{0}-shard{1}of{2}{3}'.format(base, shard[0], shard[1], ext)
+
+
+def figure_plots():
+    """Returns the plots that have figures, i.e. all except the instances of
+    :class:`~xrt.plotter.HeadlessPlot`."""
+    return [plot for plot in _plots if not plot.headless]
+
+
+def is_interactive():
+    """Tells whether the plots are drawn by an interactive matplotlib backend
+    and thus the iterations are run from a timer of the 1st figure plot.
+    False if there are no figure plots; pyplot is then not imported."""
+    if len(figure_plots()) == 0:
+        return False
+    import matplotlib.pyplot as plt
+    return plt.get_backend().lower() not in (
+        x.lower() for x in mpl.rcsetup.non_interactive_bk)
 
 
 def _simple_generator():
@@ -141,13 +206,17 @@ def start_jobs():
     for plot in _plots:
         if plot.persistentName:
             plot.restore_plots()
+    for plot in figure_plots():
         plot.fig.canvas.set_window_title(plot.title)
+    if runCardVals.sharedAccumulation:
+        create_shared_accumulators()
+    if runCardVals.targetError:
+        for plot in _plots:
+            plot.reset_error()
+    runCardVals.converged = False
 
     runCardVals.iteration = np.long(0)
-    noTimer = len(_plots) == 0 or\
-        (plt.get_backend().lower() in (x.lower() for x in
-                                       mpl.rcsetup.non_interactive_bk))
-    if noTimer:
+    if not is_interactive():
         print("The job is running... ")
         while True:
             msg = '{0} of {1}'.format(
@@ -162,44 +231,202 @@ def start_jobs():
             if res:
                 return
     else:
-        plot = _plots[0]
+        plot = figure_plots()[0]
         plot.areProcessAlreadyRunning = False
         plot.timer = plot.fig.canvas.new_timer()
         plot.timer.add_callback(plot.timer_callback)
         plot.timer.start()
 
 
+def start_workers():
+    """Starts the persistent workers (processes or threads). Each of them gets
+    the beamline and the plot cards only once and then runs the iterations
+    requested via its task queue."""
+    stop_workers()
+    cpus = max(runCardVals.threads, runCardVals.processes)
+    if runCardVals.threads >= runCardVals.processes:
+        Worker = multipro.PersistentThread
+    else:
+        Worker = multipro.PersistentProcess
+    plots2Pickle = [plot.card_copy() for plot in _plots]
+    runCardProcs.workerPlotQueues = [runCardVals.Queue() for plot in _plots]
+    runCardProcs.workerAlarmQueue = runCardVals.Queue()
+    runCardProcs.taskQueues = [runCardVals.Queue() for icpu in range(cpus)]
+    runCardProcs.workers = [
+        Worker(runCardVals, plots2Pickle, runCardProcs.workerPlotQueues,
+               runCardProcs.workerAlarmQueue, icpu, taskQueue)
+        for icpu, taskQueue in enumerate(runCardProcs.taskQueues)]
+    for p in runCardProcs.workers:
+        p.start()
+
+
+def stop_workers():
+    """Sends the stop token to the persistent workers and waits for them."""
+    if runCardProcs is None:
+        return
+    for taskQueue in runCardProcs.taskQueues:
+        taskQueue.put(None)
+    for p in runCardProcs.workers:
+        p.join(60.)
+        if isinstance(p, multiprocessing.Process) and p.is_alive():
+            p.terminate()
+    runCardProcs.workers = []
+    runCardProcs.taskQueues = []
+    runCardProcs.workerPlotQueues = []
+    runCardProcs.workerAlarmQueue = None
+
+
+def create_shared_accumulators():
+    """Creates the shared memory accumulators, one per plot per process. The
+    plots with 4D or PCA histograms keep using the output queues."""
+    free_shared_accumulators()
+    if runCardVals.threads >= runCardVals.processes or\
+            multipro.shared_memory is None:
+        return
+    cpus = max(runCardVals.threads, runCardVals.processes)
+    runCardProcs.sharedAccumulators = [
+        [multipro.SharedAccumulator(plot)
+         if multipro.is_shared_accumulation_possible(plot) else None
+         for plot in _plots] for icpu in range(cpus)]
+    runCardVals.sharedNames = [
+        [acc.name if acc is not None else None for acc in accs]
+        for accs in runCardProcs.sharedAccumulators]
+
+
+def reduce_shared_accumulators():
+    """Adds the histograms accumulated by the processes in shared memory to
+    the plots."""
+    if runCardProcs is None:
+        return
+    for accs in runCardProcs.sharedAccumulators:
+        for acc, plot in zip(accs, _plots):
+            if acc is not None:
+                acc.reduce_into(plot)
+
+
+def free_shared_accumulators():
+    if runCardProcs is None:
+        return
+    for accs in runCardProcs.sharedAccumulators:
+        for acc in accs:
+            if acc is not None:
+                acc.close(unlink=True)
+    runCardProcs.sharedAccumulators = []
+    runCardVals.sharedNames = None
+
+
 def dispatch_jobs():
     """Runs the jobs in separate processes or threads and collects the resulted
     histograms from the output queues. One cannot run this function in a loop
     because the redrawing will not work. Instead, it is started from a timer
     event handler of a qt-graph."""
     if (runCardVals.iteration >= runCardVals.repeats) or \
-            runCardVals.stop_event.is_set():
+            runCardVals.stop_event.is_set() or runCardVals.converged:
         on_finish()
         return True
     one_iteration()
     if (runCardVals.iteration >= runCardVals.repeats) or \
-            runCardVals.stop_event.is_set():
+            runCardVals.stop_event.is_set() or runCardVals.converged:
         on_finish()
         return True
     if runCardVals.iteration % runCardVals.updateEvery == 0:
+        reduce_shared_accumulators()
         for plot in _plots:
             plot.plot_plots()
     if runCardVals.pickleEvery:
         if runCardVals.iteration % runCardVals.pickleEvery == 0:
+            reduce_shared_accumulators()
             for plot in _plots:
                 plot.store_plots()
-    if len(_plots) > 0:
-        _plots[0].areProcessAlreadyRunning = False
+    if is_interactive():
+        figure_plots()[0].areProcessAlreadyRunning = False
 
 
-def one_iteration():
-    """The body of :func:`dispatch_jobs`."""
+def accumulate_output(plot, outList, iteration, backend):
+    """Adds the histograms and ray counters of one process or thread, as put
+    into the output queue by :mod:`multipro`, to *plot*."""
+    plot.nRaysAll += outList[13]
+    if backend.startswith('shadow'):
+        plot.nRaysNeeded += outList[14]
+    elif backend.startswith('raycing'):
+        nRaysVarious = outList[14]
+        plot.nRaysAlive += nRaysVarious[0]
+        plot.nRaysGood += nRaysVarious[1]
+        plot.nRaysOut += nRaysVarious[2]
+        plot.nRaysOver += nRaysVarious[3]
+        plot.nRaysDead += nRaysVarious[4]
+        plot.nRaysAccepted += nRaysVarious[5]
+        plot.nRaysAcceptedE += nRaysVarious[6]
+        plot.nRaysSeeded += nRaysVarious[7]
+        plot.nRaysSeededI += nRaysVarious[8]
+        plot.displayAsAbsorbedPower = outList[15]
+
+    isHueBinned = multipro.is_hue_binned(plot)
+    for iaxis, axis in enumerate([plot.xaxis, plot.yaxis, plot.caxis]):
+        if (iaxis == 2) and (not plot.ePos):
+            continue
+        if outList[0+iaxis*3] is not None:  # else in shared memory
+            axis.total1D += outList[0+iaxis*3]
+            if isHueBinned:
+                axis.total1D_hue += outList[1+iaxis*3]
+            else:
+                axis.total1D_RGB += outList[1+iaxis*3]
+        if iteration == 0:
+            axis.binEdges = outList[2+iaxis*3]
+    if outList[9] is not None:  # else in shared memory
+        plot.total2D += outList[9]
+        if isHueBinned:
+            plot.total2D_hue += outList[10]
+        else:
+            plot.total2D_RGB += outList[10]
+    if plot.fluxKind.lower().endswith('4d'):
+        plot.total4D += outList[11]
+    elif plot.fluxKind.lower().endswith('pca'):
+        plot.total4D.append(outList[11])
+    plot.intensity += outList[12]
+
+    if iteration == 0:  # needed for multiprocessing
+        plot.set_axes_limits(*outList.pop())
+
+
+def run_pilot():
+    """Traces a reduced number of rays (*pilotRays*) once in order to align
+    the beamline and to find the unknown plot limits. The histograms of this
+    run are discarded. After it, the 1st iteration can run in parallel with
+    the already fixed limits."""
+    bl = runCardVals.beamLine
+    savedNrays = []
+    for source in bl.sources:
+        # mesh sources have a fixed grid of rays
+        if hasattr(source, 'nrays') and not hasattr(source, 'nx'):
+            savedNrays.append((source, source.nrays))
+            source.nrays = min(np.long(runCardVals.pilotRays), source.nrays)
     plots2Pickle = [plot.card_copy() for plot in _plots]
-    outPlotQueues = [runCardVals.Queue() for plot in _plots]
-    alarmQueue = runCardVals.Queue()
+    outPlotQueues = [Queue.Queue() for plot in _plots]
+    alarmQueue = Queue.Queue()
+    pilot = multipro.BackendThread(
+        runCardVals, plots2Pickle, outPlotQueues, alarmQueue, 0)
+    pilot.iteration = 0
+    try:
+        pilot.seed_random()
+        pilot.run_iteration()
+    finally:
+        for source, nrays in savedNrays:
+            source.nrays = nrays
+    bl.alarms = alarmQueue.get()
+    for alarm in bl.alarms:
+        print(alarm)
+    for plot, aqueue in zip(_plots, outPlotQueues):
+        outList = aqueue.get()
+        if len(outList) > 0:
+            plot.set_axes_limits(*outList[-1])
+    bl.forceAlign = False
+    if bl.flowSource == 'legacy':
+        bl.flowSource = 'done_once'
 
+
+def one_iteration():
+    """The body of :func:`dispatch_jobs`."""
 # in the 1st iteration the plots may require some of x, y, e limits to be
 # calculated and thus this case is special:
     cpus = max(runCardVals.threads, runCardVals.processes)
@@ -227,6 +454,11 @@ def one_iteration():
                     runCardVals.uniqueFirstRun = True
                     break
 
+        if runCardVals.uniqueFirstRun and runCardVals.pilotRays and\
+                runCardVals.backend.startswith('raycing'):
+            run_pilot()
+            runCardVals.uniqueFirstRun = False
+
         if runCardVals.uniqueFirstRun:
             cpus = 1
 
@@ -236,20 +468,37 @@ def one_iteration():
 
     if cpus < 1:
         cpus = 1
+    # no more runs than still required:
+    cpus = max(min(cpus, runCardVals.repeats - runCardVals.iteration), 1)
 
     if runCardVals.backend.startswith('raycing'):
         runCardVals.beamLine.alarms = []
 
-    if runCardVals.threads >= runCardVals.processes or cpus == 1:
-        BackendOrProcess = multipro.BackendThread
+    if runCardVals.persistentWorkers and cpus > 1:
+        # the workers are started after a possible unique 1st run, i.e. with
+        # the beamline already aligned and the plot limits already known
+        if not runCardProcs.workers:
+            start_workers()
+        outPlotQueues = runCardProcs.workerPlotQueues
+        alarmQueue = runCardProcs.workerAlarmQueue
+        processes = runCardProcs.workers[:cpus]
+        for taskQueue in runCardProcs.taskQueues[:cpus]:
+            taskQueue.put(runCardVals.iteration)
     else:
-        BackendOrProcess = multipro.BackendProcess
-    processes = [BackendOrProcess(runCardVals, plots2Pickle, outPlotQueues,
-                                  alarmQueue, icpu) for icpu in range(cpus)]
-#    print('top process:', os.getpid())
-    for pid, p in enumerate(processes):
-        p.ppid = pid + runCardVals.iteration
-        p.start()
+        plots2Pickle = [plot.card_copy() for plot in _plots]
+        outPlotQueues = [runCardVals.Queue() for plot in _plots]
+        alarmQueue = runCardVals.Queue()
+        if runCardVals.threads >= runCardVals.processes or cpus == 1:
+            BackendOrProcess = multipro.BackendThread
+        else:
+            BackendOrProcess = multipro.BackendProcess
+        processes = [BackendOrProcess(runCardVals, plots2Pickle,
+                                      outPlotQueues, alarmQueue, icpu)
+                     for icpu in range(cpus)]
+#        print('top process:', os.getpid())
+        for pid, p in enumerate(processes):
+            p.ppid = pid + runCardVals.iteration
+            p.start()
 
     for p in processes:
         if runCardVals.backend.startswith('raycing'):
@@ -262,53 +511,29 @@ def one_iteration():
 
             if len(outList) == 0:
                 continue
-            if (runCardVals.iteration >= runCardVals.repeats) or \
-                    runCardVals.stop_event.is_set():
+            if ((runCardVals.iteration >= runCardVals.repeats) or
+                    runCardVals.stop_event.is_set()) and\
+                    outList[9] is not None:  # else already in shared memory
                 continue
             tFromStart = time.time() - runCardVals.tstart
-            plot.textStatus.set_text(
-                "{0} of {1} in {2:.1f} s (right click to stop)".format(
-                    runCardVals.iteration+1, runCardVals.repeats, tFromStart))
-
-            plot.nRaysAll += outList[13]
-            if runCardVals.backend.startswith('shadow'):
-                plot.nRaysNeeded += outList[14]
-            elif runCardVals.backend.startswith('raycing'):
-                nRaysVarious = outList[14]
-                plot.nRaysAlive += nRaysVarious[0]
-                plot.nRaysGood += nRaysVarious[1]
-                plot.nRaysOut += nRaysVarious[2]
-                plot.nRaysOver += nRaysVarious[3]
-                plot.nRaysDead += nRaysVarious[4]
-                plot.nRaysAccepted += nRaysVarious[5]
-                plot.nRaysAcceptedE += nRaysVarious[6]
-                plot.nRaysSeeded += nRaysVarious[7]
-                plot.nRaysSeededI += nRaysVarious[8]
-                plot.displayAsAbsorbedPower = outList[15]
-
-            for iaxis, axis in enumerate(
-                    [plot.xaxis, plot.yaxis, plot.caxis]):
-                if (iaxis == 2) and (not plot.ePos):
-                    continue
-                axis.total1D += outList[0+iaxis*3]
-                axis.total1D_RGB += outList[1+iaxis*3]
-                if runCardVals.iteration == 0:
-                    axis.binEdges = outList[2+iaxis*3]
-            plot.total2D += outList[9]
-            plot.total2D_RGB += outList[10]
-            if plot.fluxKind.lower().endswith('4d'):
-                plot.total4D += outList[11]
-            elif plot.fluxKind.lower().endswith('pca'):
-                plot.total4D.append(outList[11])
-            plot.intensity += outList[12]
-
-            if runCardVals.iteration == 0:  # needed for multiprocessing
-                plot.set_axes_limits(*outList.pop())
+            if not plot.headless:
+                plot.textStatus.set_text(
+                    "{0} of {1} in {2:.1f} s (right click to stop)".format(
+                        runCardVals.iteration+1, runCardVals.repeats,
+                        tFromStart))
+
+            accumulate_output(plot, outList, runCardVals.iteration,
+                              runCardVals.backend)
+            if runCardVals.targetError:
+                plot.add_error_batch(outList[9])
 #            aqueue.task_done()
         if len(outList) > 0:
             runCardVals.iteration += 1
-    for p in processes:
-        p.join(60.)
+    if runCardVals.targetError:
+        check_convergence()
+    if not (runCardVals.persistentWorkers and cpus > 1):
+        for p in processes:
+            p.join(60.)
     if hasattr(runCardVals, 'beamLine'):
         bl = runCardVals.beamLine
         bl.forceAlign = False
@@ -316,14 +541,38 @@ def one_iteration():
             bl.flowSource = 'done_once'
 
 
+def check_convergence():
+    """Updates the statistical errors of the plots, shows them in the status
+    text and sets the *converged* flag of the run if all the errors are below
+    *targetError*, see :func:`run_ray_tracing`."""
+    errors = []
+    enoughBatches = True
+    for plot in _plots:
+        plot.update_error()
+        if plot.statError is None:
+            continue
+        errors.append(plot.statError)
+        if not plot.headless:
+            plot.textStatus.set_text("{0}, error {1:.2%}".format(
+                plot.textStatus.get_text(), plot.statError))
+        if plot.errorBatches < minErrorBatches:
+            enoughBatches = False
+    if enoughBatches and errors and max(errors) <= runCardVals.targetError:
+        runCardVals.converged = True
+        print('converged to error {0:.2%} after {1} iteration{2}'.format(
+              max(errors), runCardVals.iteration,
+              's' if runCardVals.iteration > 1 else ''))
+
+
 def on_finish():
     """Executed on exit from the ray-tracing iteration loop."""
-    if len(_plots) > 0:
-        plot = _plots[0]
-        if plt.get_backend().lower() not in (
-                x.lower() for x in mpl.rcsetup.non_interactive_bk):
-            plot.timer.stop()
-            plot.timer.remove_callback(plot.timer_callback)
+    stop_workers()
+    reduce_shared_accumulators()
+    free_shared_accumulators()
+    if is_interactive():
+        plot = figure_plots()[0]
+        plot.timer.stop()
+        plot.timer.remove_callback(plot.timer_callback)
         plot.areProcessAlreadyRunning = False
     for plot in _plots:
         if plot.fluxKind.startswith('E') and \
@@ -331,8 +580,13 @@ def on_finish():
             xbin, zbin = plot.xaxis.bins, plot.yaxis.bins
             plot.total4D = np.concatenate(plot.total4D).reshape(-1, xbin, zbin)
             plot.field3D = plot.total4D
-        plot.textStatus.set_text('')
-        plot.fig.canvas.mpl_disconnect(plot.cidp)
+        if not plot.headless:
+            if plot.statError is not None:
+                plot.textStatus.set_text(
+                    "error {0:.2%}".format(plot.statError))
+            else:
+                plot.textStatus.set_text('')
+            plot.fig.canvas.mpl_disconnect(plot.cidp)
         plot.plot_plots()
         plot.save()
     runCardVals.tstop = time.time()
@@ -340,6 +594,9 @@ def on_finish():
     print('The ray tracing with {0} iteration{1} took {2:0.1f} s'.format(
           runCardVals.iteration, 's' if runCardVals.iteration > 1 else '',
           runCardVals.tstop-runCardVals.tstart))
+    if getattr(getattr(runCardVals, 'beamLine', None), 'alignTime', 0) > 0:
+        print('of which the automatic alignment took {0:0.3f} s'.format(
+              runCardVals.beamLine.alignTime))
     runCardVals.finished_event.set()
     for plot in _plots:
         if runCardVals.globalNorm or plot.persistentName:
@@ -357,11 +614,18 @@ def on_finish():
     except StopIteration:
         pass
     else:
+        runCardVals.step += 1
         for plot in _plots:
             plot.clean_plots()
         start_jobs()
         return
 
+    finish_run()
+
+
+def finish_run():
+    """Executed after the last step of the generator: does the global
+    normalization, if requested, and runs *afterScript*."""
     if runCardVals.globalNorm:
         aSavedResult = -1
         print('normalizing ...')
@@ -371,7 +635,8 @@ def on_finish():
                 saved = runCardVals.savedResults[aSavedResult]
                 plot.clean_plots()
                 saved.restore(plot)
-                plot.fig.canvas.set_window_title(plot.title)
+                if not plot.headless:
+                    plot.fig.canvas.set_window_title(plot.title)
                 for runCardVals.passNo in [1, 2]:
                     plot.plot_plots()
                     plot.save('_norm' + str(runCardVals.passNo))
@@ -393,6 +658,154 @@ def on_finish():
             *runCardProcs.afterScriptArgs, **runCardProcs.afterScriptKWargs)
 
 
+class ScanStepCard(object):
+    """
+    A minimal run card for ray tracing one generator step in a separate
+    process in the scan-parallel mode, see *scanProcesses* in
+    :func:`run_ray_tracing`.
+    """
+    def __init__(self, beamLine, shard=None, seedEntropy=None, step=0):
+        self.backend = 'raycing'
+        self.beamLine = beamLine
+        self.iteration = np.long(0)
+        self.sharedNames = None
+        self.shard = shard
+        self.seedEntropy = seedEntropy
+        self.step = step
+
+
+def run_scan_step(stepData):
+    """Ray traces one generator step in a separate process. *stepData* is the
+    pickled tuple (beamLine, plot cards, repeats, shard, seedEntropy, step)
+    taken at the generator step. Returns a list of
+    :class:`~xrt.plotter.SaveResults`, one per plot."""
+    from . import plotter
+    beamLine, plotCards, repeats, shard, seedEntropy, step = \
+        pickle.loads(stepData)
+    card = ScanStepCard(beamLine, shard, seedEntropy, step)
+    stepPlots = [plotter.HeadlessPlot(
+        beam=plotCard.beam, rayFlag=plotCard.rayFlag, xaxis=plotCard.xaxis,
+        yaxis=plotCard.yaxis, caxis=plotCard.caxis, aspect=plotCard.aspect,
+        ePos=plotCard.ePos, title=plotCard.title, fluxKind=plotCard.fluxKind,
+        beamState=plotCard.beamState, beamC=plotCard.beamC,
+        hueBins=plotCard.hueBins) for plotCard in plotCards]
+    outPlotQueues = [Queue.Queue() for plotCard in plotCards]
+    alarmQueue = Queue.Queue()
+    worker = multipro.BackendThread(
+        card, plotCards, outPlotQueues, alarmQueue, 0)
+    worker.seed_random()
+    beamLine.forceAlign = False
+    for oe in beamLine.oes + beamLine.slits + beamLine.screens:
+        if raycing.is_auto_align_required(oe):
+            beamLine.forceAlign = True
+            break
+    for iteration in range(repeats):
+        worker.iteration = iteration
+        beamLine.alarms = []
+        worker.run_iteration()
+        for alarm in alarmQueue.get():
+            print(alarm)
+        for plot, aqueue in zip(stepPlots, outPlotQueues):
+            outList = aqueue.get()
+            if len(outList) > 0:
+                accumulate_output(plot, outList, iteration, card.backend)
+        beamLine.forceAlign = False
+        if beamLine.flowSource == 'legacy':
+            beamLine.flowSource = 'done_once'
+    return [plotter.SaveResults(plot) for plot in stepPlots]
+
+
+def limits_pending(job):
+    """Returns the results of *job* if any plot has undefined limits, which
+    requires waiting for the job, otherwise an empty list."""
+    for plot in _plots:
+        axes = [plot.xaxis, plot.yaxis]
+        if plot.ePos:
+            axes.append(plot.caxis)
+        for axis in axes:
+            if (axis.limits is None) or isinstance(axis.limits, str):
+                return job.get()
+    return []
+
+
+def run_scan_parallel():
+    """
+    The scan-parallel mode, see *scanProcesses* in :func:`run_ray_tracing`.
+    The generator is run twice. In the 1st pass, the beamline and the plot
+    cards are snapshot at each step and sent to a process pool; a step with
+    undefined plot limits is waited for in order to pass its limits to the
+    next steps, as in a sequential run. In the 2nd
+    pass, the generator is restarted and at each of its steps the step
+    results are restored into the plots, which are then drawn, saved and
+    stored exactly as after a sequential run.
+    """
+    pool = multiprocessing.Pool(runCardVals.scanProcesses)
+    jobs = []
+    while True:
+        stepData = pickle.dumps(
+            (runCardVals.beamLine, [plot.card_copy() for plot in _plots],
+             runCardVals.repeats, runCardVals.shard,
+             runCardVals.seedEntropy, len(jobs)), protocol=2)
+        jobs.append(pool.apply_async(run_scan_step, (stepData,)))
+        # as in a sequential run, the limits found in this step are kept for
+        # the next steps:
+        for plot, saved in zip(_plots, limits_pending(jobs[-1])):
+            plot.xaxis.limits = list(saved.xlimits)
+            plot.yaxis.limits = list(saved.ylimits)
+            plot.caxis.limits = list(saved.elimits)
+        try:
+            if sys.version_info < (3, 1):
+                runCardProcs.generatorPlot.next()
+            else:
+                next(runCardProcs.generatorPlot)
+        except StopIteration:
+            break
+    pool.close()
+    print("{0} generator step{1} sent to {2} processes".format(
+          len(jobs), 's' if len(jobs) > 1 else '', runCardVals.scanProcesses))
+
+    generator = runCardProcs.generatorScan
+    if sys.version_info < (3, 1):
+        generator.next()
+    else:
+        next(generator)
+    for ijob, job in enumerate(jobs):
+        savedResults = job.get()
+        for plot, saved in zip(_plots, savedResults):
+            plot.clean_plots()
+            if plot.persistentName:
+                plot.restore_plots()
+            saved.restore(plot)
+            if not plot.headless:
+                plot.fig.canvas.set_window_title(plot.title)
+            plot.plot_plots()
+            plot.save()
+            if runCardVals.globalNorm or plot.persistentName:
+                plot.store_plots()
+        runCardVals.iteration = np.long(runCardVals.repeats)
+        if ijob < len(jobs) - 1:
+            if sys.version_info < (3, 1):
+                generator.next()
+            else:
+                next(generator)
+        else:  # run the code after the last yield
+            try:
+                if sys.version_info < (3, 1):
+                    generator.next()
+                else:
+                    next(generator)
+            except StopIteration:
+                pass
+    pool.join()
+    runCardVals.tstop = time.time()
+    runCardVals.tstopLong = time.localtime()
+    print('The scan of {0} step{1} took {2:0.1f} s'.format(
+          len(jobs), 's' if len(jobs) > 1 else '',
+          runCardVals.tstop-runCardVals.tstart))
+    runCardVals.finished_event.set()
+    finish_run()
+
+
 def normalize_sibling_plots(plots):
     print('normalization started')
     max1Dx = 0
@@ -438,7 +851,10 @@ def run_ray_tracing(
     plots=[], repeats=1, updateEvery=1, pickleEvery=None, energyRange=None,
     backend='raycing', beamLine=None, threads=1, processes=1,
     generator=None, generatorArgs=[], generatorKWargs='auto', globalNorm=0,
-        afterScript=None, afterScriptArgs=[], afterScriptKWargs={}):
+        afterScript=None, afterScriptArgs=[], afterScriptKWargs={},
+        persistentWorkers=False, sharedAccumulation=False, pilotRays=None,
+        scanProcesses=None, shard=None, seed=None, targetError=None,
+        raysPerChunk=None):
     u"""
     This function is the entry point of xrt.
     Parameters are all optional except the 1st one. Please use them as keyword
@@ -487,6 +903,11 @@ def run_ray_tracing(
                 OpenCL. You will get an error if *processes* > 1. You can still
                 use *threads* > 1 but with a little gain.
 
+            .. note::
+                A :class:`~xrt.backends.raycing.sources.BeamFileSource` can
+                only be used with threads, as the processes would replay the
+                same rays of the file.
+
             .. note::
                 For the :mod:`shadow` backend you must create ``tmp0``,
                 ``tmp1`` etc. directories (counted by *threads* or *processes*)
@@ -559,6 +980,110 @@ def run_ray_tracing(
         *afterScriptArgs*, *afterScriptKWargs*: list and dictionary
             args and kwargs for *afterScript*.
 
+        *persistentWorkers*: bool
+            If True, the parallel processes or threads are started only once
+            per generator step and stay alive between the iterations. Each of
+            them receives the beamline and the plots once and is then only
+            sent the index of the next iteration. This saves the per-iteration
+            spawning, pickling and joining of the workers, which is noticeable
+            for studies with many short repeats. The workers are stopped on
+            user interrupt and at the end of each generator step.
+
+        *sharedAccumulation*: bool
+            Only with *processes* > *threads* and Python >= 3.8. If True, each
+            process adds its histograms to its own accumulators in shared
+            memory blocks instead of sending them to the job server through
+            the output queues. The server sums the accumulators into the
+            plots only when redrawing (see *updateEvery*), saving (see
+            *pickleEvery*) and at the end. This removes the pickling of
+            histograms on every iteration, which dominates multiprocessing
+            runs with many plots and/or big bin numbers. The 1st iteration and
+            the plots with 4D or PCA *fluxKind* still use the queues.
+
+        *pilotRays*: int or None
+            Only in `raycing` backend. If the plot limits are not fully
+            defined (None or 'symmetric') or if an optical element needs
+            auto-alignment, the 1st iteration is normally run by a single
+            process or thread and only the later ones are parallelized. If
+            *pilotRays* is given, a pilot run with this number of rays per
+            source (mesh sources are not reduced) is done before the 1st
+            iteration: it aligns the beamline and defines the limits, its
+            histograms are discarded. The 1st iteration is then run by all
+            the processes or threads. The pilot should have enough rays to
+            give representative limits and centroids for the alignment,
+            typically a few thousand.
+
+        *scanProcesses*: int or None
+            Only in `raycing` backend and with a *generator*. If given, the
+            generator steps are considered independent and are distributed
+            over a pool of *scanProcesses* processes, each step running its
+            *repeats* in one process. The generator is first run through to
+            take a snapshot of the beamline and the plots at each step. It is
+            then restarted and, at each of its steps, the step results are
+            put into the plots, which are drawn, saved and stored (also for
+            *globalNorm*) as in a sequential run. Therefore, like with
+            *globalNorm*, the generator must be restartable and its code after
+            ``yield`` must tolerate the still empty plots of the first pass.
+            The 4D and PCA histograms are not collected in this mode. The
+            beamline and its materials must be pickleable, i.e. OpenCL cannot
+            be used.
+
+        *shard*: tuple (index, count) or None
+            Runs only the part *index* (counted from 0) of *count* parts of the
+            study, e.g. on one of *count* computers or as one of *count*
+            local processes. The shard runs its share of *repeats* (the
+            remainder of the division goes to the first shards) and draws
+            its random numbers from streams independent of the other shards,
+            see *seed*. The plots with a defined *persistentName* are
+            stored under the name with the suffix ``-shard<index>of<count>``
+            inserted before the extension, so that a repeated run of the
+            same shard continues its own file. The shard files are combined
+            by :func:`~xrt.plotter.merge_results`.
+
+        *seed*: int or None
+            The master seed of the random numbers. Each iteration of each
+            process or thread draws from its own random generator
+            (:class:`numpy.random.Generator`) seeded by
+            :class:`numpy.random.SeedSequence` of *seed* with the spawn key
+            (generator step, iteration, process), preceded by the shard
+            index in a sharded run. The threads therefore do not share the
+            random state and a run with a given *seed* and given numbers of
+            threads or processes can be reproduced, also in parts. If None,
+            the master seed is taken from the operating system. Note that
+            continuing a study stored in *persistentName* files with the
+            same *seed* repeats the same rays. Requires
+            numpy >= 1.17, otherwise the global random state of numpy is
+            seeded by time.
+
+        *targetError*: float or None
+            If given, the iterations are stopped before *repeats* is reached
+            when the relative statistical error of every plot is below
+            *targetError*, e.g. 0.01. The error is estimated from the
+            scatter between the 2D histograms of the individual batches (a
+            batch is the output of one process or thread in one iteration)
+            within the plot's *errorROI*, see
+            :meth:`~xrt.plotter.XYCPlot.update_error`. At least
+            *minErrorBatches* (module variable, 4) batches are required. The
+            error is shown in the status text of the plots and is stored in
+            their saved results. The field amplitude plots ('E' in
+            *fluxKind*) are not considered. *sharedAccumulation* is not
+            applied in this mode and the mode is not available with
+            *scanProcesses*.
+
+        *raysPerChunk*: int or None
+            Only in `raycing` backend. If given, each process or thread runs
+            its iteration as a sequence of :func:`run_process` calls with at
+            most *raysPerChunk* rays per source (the *nrays* of the sources
+            is split into equal chunks; mesh sources are not split). The
+            histograms and ray counters of each chunk are added up and its
+            beams are released before the next chunk, so one iteration can
+            trace many more rays (e.g. 1e8) than fit into memory, without
+            the per-iteration overhead of the job server. The chunks draw
+            consecutive random numbers from the generator of the iteration,
+            see *seed*. The plots whose histograms are not additive (the
+            'E' *fluxKind* ending with 'xx', 'zz', '4D' or 'PCA') are not
+            allowed in this mode.
+
 
     """
     global runCardVals, runCardProcs, _plots
@@ -579,6 +1104,19 @@ def run_ray_tracing(
                 plot.caxis.limits = [raycing.hueMin, raycing.hueMax]
             if isinstance(plot.rayFlag, int):
                 plot.rayFlag = plot.rayFlag,
+            if raysPerChunk and plot.fluxKind.startswith('E') and\
+                    plot.fluxKind.lower().endswith(
+                        ('xx', 'zz', 'yy', '4d', 'pca')):
+                raise ValueError(
+                    'the fluxKind {0} cannot be used with raysPerChunk'.format(
+                        plot.fluxKind))
+            # the mutual intensity cuts are square, see histogram_shape_2D
+            if plot.fluxKind.startswith('E') and\
+                    plot.fluxKind.lower().endswith(('xx', 'zz', 'yy')) and\
+                    plot.xaxis.bins != plot.yaxis.bins:
+                raise ValueError(
+                    'the fluxKind {0} needs equal bins of xaxis and '
+                    'yaxis'.format(plot.fluxKind))
     if updateEvery < 1:
         updateEvery = 1
     if (repeats > 1) and (updateEvery > repeats):
@@ -595,7 +1133,10 @@ def run_ray_tracing(
         else:
             threads = max(cpuCount // 2, 1)
     runCardVals = RunCardVals(threads, processes, repeats, updateEvery,
-                              pickleEvery, backend, globalNorm, runfile)
+                              pickleEvery, backend, globalNorm, runfile,
+                              persistentWorkers, sharedAccumulation,
+                              pilotRays, scanProcesses, shard, seed,
+                              targetError, raysPerChunk)
     runCardProcs = RunCardProcs(
         afterScript, afterScriptArgs, afterScriptKWargs)
 
@@ -608,6 +1149,13 @@ def run_ray_tracing(
             shadow.init_shadow(cpuCount, runCardVals.cwd, energyRange)
     elif backend == 'raycing':
         runCardVals.beamLine = beamLine
+        if processes > threads:
+            for source in getattr(beamLine, 'sources', []):
+                # each process would replay the same rays of the file
+                if hasattr(source, 'beamFile'):
+                    raise ValueError(
+                        'the beam file source {0} cannot be used with '
+                        'processes, use threads'.format(source.name))
 
     if generator is None:
         runCardProcs.generatorPlot = _simple_generator()
@@ -625,6 +1173,8 @@ def run_ray_tracing(
         runCardProcs.generatorPlot = generator(*generatorArgs, **kwargs)
         if globalNorm:
             runCardProcs.generatorNorm = generator(*generatorArgs, **kwargs)
+        if scanProcesses and backend == 'raycing':
+            runCardProcs.generatorScan = generator(*generatorArgs, **kwargs)
 
     if runCardProcs.generatorPlot is not None:
         if sys.version_info < (3, 1):
@@ -634,5 +1184,13 @@ def run_ray_tracing(
 
     runCardVals.tstart = time.time()
     runCardVals.tstartLong = time.localtime()
-    start_jobs()
-    plt.show()
+    if hasattr(getattr(runCardVals, 'beamLine', None), 'alignTimes'):
+        runCardVals.beamLine.alignTime = 0.
+        runCardVals.beamLine.alignTimes.clear()
+    if runCardProcs.generatorScan is not None:
+        run_scan_parallel()
+    else:
+        start_jobs()
+    if figure_plots():
+        import matplotlib.pyplot as plt
+        plt.show()